@@ -0,0 +1,40 @@
+import unittest
+
+import tornado.ioloop
+
+from tornadoshortener.analytics import ClickCounter
+from tornadoshortener.memory import MemoryRedis
+
+
+class FailingRedis(object):
+    def pipeline(self, transaction=True):
+        raise ConnectionError('Redis is down')
+
+
+class ClickCounterTest(unittest.TestCase):
+    def test_record(self):
+        counter = ClickCounter(None, max_keys=4)
+        counter.record('a', 'ios')
+        counter.record('a', 'ios')
+        counter.record('a', 'android')
+        self.assertEqual(len(counter), 2)
+        for url_hash in 'bcd':
+            counter.record(url_hash, 'desktop')
+        self.assertEqual(len(counter), 4)
+        self.assertEqual(counter.dropped, 1)
+
+    def test_flush_failure(self):
+        counter = ClickCounter(FailingRedis(), max_keys=10)
+        counter.record('a', 'ios')
+        counter.record('a', 'ios')
+        tornado.ioloop.IOLoop.current().run_sync(counter.flush)
+        self.assertEqual(len(counter), 1)
+        self.assertEqual(list(counter._counts.values()), [2])
+
+    def test_hot(self):
+        counter = ClickCounter(MemoryRedis(), hot_links=1)
+        for url_hash, device in (('a', 'ios'), ('b', 'ios'), ('b', 'android'), ('c', 'ios'), ('c', 'ios'),
+                                 ('c', 'desktop')):
+            counter.record(url_hash, device)
+        tornado.ioloop.IOLoop.current().run_sync(counter.flush)
+        self.assertEqual(tornado.ioloop.IOLoop.current().run_sync(lambda: counter.hot(2)), ['c', 'b'])
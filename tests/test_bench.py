@@ -0,0 +1,24 @@
+import unittest
+
+from tornadoshortener.bench import BENCH_URLS, benchmark_urls, parse_weights, percentile
+
+
+class BenchTest(unittest.TestCase):
+    def test_parse_weights(self):
+        self.assertEqual(parse_weights('redirect=90, expand=5,shorten=5'),
+                         {'redirect': 90, 'expand': 5, 'shorten': 5})
+
+    def test_percentile(self):
+        latencies = [i / 100.0 for i in range(100)]
+        self.assertEqual(percentile(latencies, 50), 0.5)
+        self.assertEqual(percentile(latencies, 99), 0.99)
+        self.assertEqual(percentile(latencies, 100), 0.99)
+        self.assertIsNone(percentile([], 50))
+
+    def test_benchmark_urls(self):
+        results = benchmark_urls(calls=20)
+        self.assertEqual(len(results['latency']), len(BENCH_URLS) * 2)
+        for stats in results['latency'].values():
+            self.assertEqual(stats['count'], 20)
+            self.assertLessEqual(stats['p50'], stats['p95'])
+            self.assertLessEqual(stats['p95'], stats['p99'])
@@ -0,0 +1,61 @@
+import unittest
+
+import tornado.gen
+import tornado.ioloop
+import tornado.util
+
+from tornadoshortener.breaker import CircuitBreaker, CircuitOpenError
+
+
+async def fail():
+    raise ConnectionError('Redis is down')
+
+
+async def succeed():
+    return 'OK'
+
+
+async def hang():
+    await tornado.gen.sleep(1)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def call(self, breaker, function):
+        return tornado.ioloop.IOLoop.current().run_sync(lambda: breaker.call(function))
+
+    def test_open_and_close(self):
+        breaker = CircuitBreaker(max_failures=2, reset_timeout=0.05)
+        for i in range(2):
+            with self.assertRaises(ConnectionError):
+                self.call(breaker, fail)
+        self.assertTrue(breaker.is_open)
+
+        # Calls fail fast while the breaker is open.
+        with self.assertRaises(CircuitOpenError):
+            self.call(breaker, succeed)
+        self.assertEqual(breaker.rejected, 1)
+
+        # A failed trial call opens the breaker again, a successful one closes it.
+        tornado.ioloop.IOLoop.current().run_sync(lambda: tornado.gen.sleep(0.06))
+        with self.assertRaises(ConnectionError):
+            self.call(breaker, fail)
+        with self.assertRaises(CircuitOpenError):
+            self.call(breaker, succeed)
+        tornado.ioloop.IOLoop.current().run_sync(lambda: tornado.gen.sleep(0.06))
+        self.assertEqual(self.call(breaker, succeed), 'OK')
+        self.assertFalse(breaker.is_open)
+        self.assertEqual(breaker.failures, 0)
+
+    def test_timeout(self):
+        breaker = CircuitBreaker(max_failures=1, timeout=0.01)
+        with self.assertRaises(tornado.util.TimeoutError):
+            self.call(breaker, hang)
+        self.assertEqual(breaker.timeouts, 1)
+        self.assertTrue(breaker.is_open)
+
+    def test_disabled(self):
+        breaker = CircuitBreaker(max_failures=0)
+        for i in range(10):
+            with self.assertRaises(ConnectionError):
+                self.call(breaker, fail)
+        self.assertFalse(breaker.is_open)
@@ -0,0 +1,124 @@
+import asyncio
+import time
+import unittest
+
+import tornado.gen
+import tornado.ioloop
+
+from tornadoshortener.cache import CallCancelledError, LinkCache, SingleFlight
+
+URLS = ('http://www.familo.net/', None, None, None, None)
+
+
+class LinkCacheTest(unittest.TestCase):
+    def test_hit_and_miss(self):
+        cache = LinkCache(max_entries=10)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', URLS)
+        self.assertEqual(cache.get('a'), URLS)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_lru_eviction(self):
+        cache = LinkCache(max_entries=2)
+        cache.set('a', URLS)
+        cache.set('b', URLS)
+        cache.get('a')
+        cache.set('c', URLS)
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_max_bytes(self):
+        cache = LinkCache(max_entries=100, max_bytes=1000)
+        for key in 'abcdefgh':
+            cache.set(key, URLS)
+        self.assertLessEqual(cache.size, 1000)
+        self.assertLess(len(cache), 8)
+
+    def test_ttl(self):
+        cache = LinkCache(max_entries=10, ttl=60)
+        cache.set('a', URLS, ttl=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+
+    def test_negative_caching(self):
+        cache = LinkCache(max_entries=10)
+        cache.set('a', None)
+        self.assertEqual(cache.get('a'), ())
+        cache.invalidate('a')
+        self.assertIsNone(cache.get('a'))
+
+    def test_stale(self):
+        cache = LinkCache(max_entries=10, ttl=60, stale_ttl=60)
+        cache.set('a', URLS, ttl=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get_stale('a'), URLS)
+        self.assertIsNone(cache.get_stale('b'))
+
+        # Without stale_ttl expired entries are gone.
+        cache = LinkCache(max_entries=10, ttl=60)
+        cache.set('a', URLS, ttl=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get_stale('a'))
+
+
+class SingleFlightTest(unittest.TestCase):
+    def test_coalescing(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        async def load(key):
+            calls.append(key)
+            await tornado.gen.sleep(0.01)
+            return key.upper()
+
+        results = tornado.ioloop.IOLoop.current().run_sync(
+            lambda: tornado.gen.multi([single_flight.do(key, load, key) for key in ('a', 'a', 'b', 'a')]))
+        self.assertEqual(results, ['A', 'A', 'B', 'A'])
+        self.assertEqual(calls, ['a', 'b'])
+        self.assertEqual(single_flight.coalesced, 2)
+        self.assertEqual(len(single_flight), 0)
+
+    def test_error(self):
+        single_flight = SingleFlight()
+
+        async def fail():
+            await tornado.gen.sleep(0.01)
+            raise ValueError('Redis is down')
+
+        async def run():
+            calls = [single_flight.do('a', fail) for i in range(2)]
+            return await tornado.gen.multi([tornado.gen.convert_yielded(call) for call in calls],
+                                           quiet_exceptions=ValueError)
+
+        with self.assertRaises(ValueError):
+            tornado.ioloop.IOLoop.current().run_sync(run)
+        self.assertEqual(single_flight.coalesced, 1)
+        self.assertEqual(len(single_flight), 0)
+
+    def test_cancelled(self):
+        single_flight = SingleFlight()
+
+        async def load():
+            await tornado.gen.sleep(0.05)
+            return 'A'
+
+        async def run(cancel):
+            calls = [asyncio.ensure_future(single_flight.do('a', load)) for i in range(3)]
+            await tornado.gen.sleep(0.01)
+            calls[cancel].cancel()
+            return await asyncio.gather(*calls, return_exceptions=True)
+
+        # Callers waiting for a cancelled call fail with an error.
+        results = tornado.ioloop.IOLoop.current().run_sync(lambda: run(0))
+        self.assertIsInstance(results[0], asyncio.CancelledError)
+        self.assertIsInstance(results[1], CallCancelledError)
+        self.assertIsInstance(results[2], CallCancelledError)
+        self.assertEqual(len(single_flight), 0)
+
+        # A cancelled waiting caller does not cancel the call.
+        results = tornado.ioloop.IOLoop.current().run_sync(lambda: run(1))
+        self.assertEqual(results[0], 'A')
+        self.assertIsInstance(results[1], asyncio.CancelledError)
+        self.assertEqual(results[2], 'A')
@@ -0,0 +1,51 @@
+import unittest
+
+from tornadoshortener import device
+from tornadoshortener.device import DeviceClassifier
+
+ANDROID_UA = ('Mozilla/5.0 (Linux; Android 10; SM-G973F) AppleWebKit/537.36 (KHTML, like Gecko) '
+              'Chrome/83.0.4103.106 Mobile Safari/537.36')
+IPHONE_UA = ('Mozilla/5.0 (iPhone; CPU iPhone OS 13_5 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+             'Version/13.1.1 Mobile/15E148 Safari/604.1')
+IPOD_UA = ('Mozilla/5.0 (iPod touch; CPU iPhone OS 12_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+           'Mobile/15E148')
+FACEBOOK_IOS_UA = ('Mozilla/5.0 (iPhone; CPU iPhone OS 13_5 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+                   'Mobile/15E148 [FBAN/FBIOS;FBAV/275.0.0.49.116;FBBV/220695493]')
+GOOGLEBOT_MOBILE_UA = ('Mozilla/5.0 (Linux; Android 6.0.1; Nexus 5X Build/MMB29P) AppleWebKit/537.36 '
+                       '(KHTML, like Gecko) Chrome/83.0.4103.118 Mobile Safari/537.36 '
+                       '(compatible; Googlebot/2.1; +http://www.google.com/bot.html)')
+CUBOT_UA = ('Mozilla/5.0 (Linux; Android 10; CUBOT X30) AppleWebKit/537.36 (KHTML, like Gecko) '
+            'Chrome/83.0.4103.106 Mobile Safari/537.36')
+DESKTOP_UA = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+              'Chrome/83.0.4103.116 Safari/537.36')
+
+
+class DeviceClassifierTest(unittest.TestCase):
+    def test_classify(self):
+        classifier = DeviceClassifier()
+        self.assertEqual(classifier.classify(ANDROID_UA), device.ANDROID)
+        self.assertEqual(classifier.classify(IPHONE_UA), device.IOS)
+        self.assertEqual(classifier.classify(IPOD_UA), device.IOS)
+        self.assertEqual(classifier.classify(FACEBOOK_IOS_UA), device.IOS)
+        self.assertEqual(classifier.classify(GOOGLEBOT_MOBILE_UA), device.BOT)
+        self.assertEqual(classifier.classify('facebookexternalhit/1.1'), device.BOT)
+        self.assertEqual(classifier.classify('Mozilla/5.0 (compatible; bingbot/2.0)'), device.BOT)
+        self.assertEqual(classifier.classify(CUBOT_UA), device.ANDROID)
+        self.assertEqual(classifier.classify(DESKTOP_UA), device.DESKTOP)
+        self.assertEqual(classifier.classify(''), device.DESKTOP)
+
+    def test_cache(self):
+        classifier = DeviceClassifier(max_entries=2)
+        classifier.classify(ANDROID_UA)
+        classifier.classify(ANDROID_UA)
+        self.assertEqual((classifier.hits, classifier.misses), (1, 1))
+        classifier.classify(IPHONE_UA)
+        classifier.classify(DESKTOP_UA)
+        self.assertEqual(len(classifier), 2)
+        self.assertEqual(classifier.classify(ANDROID_UA), device.ANDROID)
+        self.assertEqual(classifier.misses, 4)
+
+    def test_custom_patterns(self):
+        classifier = DeviceClassifier(patterns=(('tv', r'SmartTV'),) + device.DEFAULT_PATTERNS)
+        self.assertEqual(classifier.classify('Mozilla/5.0 (SmartTV; Linux)'), 'tv')
+        self.assertEqual(classifier.classify(ANDROID_UA), device.ANDROID)
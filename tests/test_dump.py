@@ -0,0 +1,99 @@
+import time
+import unittest
+
+import redis
+
+from tornadoshortener.dump import dump_records, load_records, load_sharded, reshard
+from tornadoshortener.storage import HashRing
+
+
+class DumpTest(unittest.TestCase):
+    source = 'TEST:DUMP:'
+    target = 'TEST:LOAD:'
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            redis.StrictRedis().ping()
+        except redis.exceptions.ConnectionError:
+            raise unittest.SkipTest('Needs redis on localhost')
+
+    def setUp(self):
+        self.redis = redis.StrictRedis(decode_responses=True)
+        self.tearDown()
+
+    def tearDown(self):
+        for namespace in (self.source, self.target):
+            keys = list(self.redis.scan_iter(namespace + '*'))
+            if keys:
+                self.redis.delete(*keys)
+
+    def test_dump_and_load(self):
+        self.redis.hset(self.source + 'LINK:a', mapping={'l': 'http://www.familo.net/', 'i': 'familonet://'})
+        self.redis.hset(self.source + 'LINK:b', mapping={'l': 'http://www.familo.net/b'})
+        self.redis.expire(self.source + 'LINK:b', 3600)
+        self.redis.set(self.source + 'URLS:c', 'http://www.familo.net/c')
+        self.redis.set(self.source + 'URLS:c:android_url', 'familonet://')
+        self.redis.set(self.source + 'HI:18000', 1000)
+        self.redis.set(self.target + 'HI:18000', 2000)
+        self.redis.set(self.target + 'HI:18001', 10)
+        self.redis.set(self.source + 'HI:18001', 500)
+
+        records = list(dump_records(self.redis, self.source, batch=1))
+        self.assertEqual(len([record for record in records if record['type'] == 'link']), 3)
+        counts = load_records(self.redis, self.target, records, batch=2)
+        self.assertEqual(counts, {'link': 3, 'counter': 2})
+
+        self.assertEqual(self.redis.hgetall(self.target + 'LINK:a'),
+                         {'l': 'http://www.familo.net/', 'i': 'familonet://'})
+        self.assertEqual(self.redis.ttl(self.target + 'LINK:a'), -1)
+        self.assertGreater(self.redis.ttl(self.target + 'LINK:b'), 3500)
+        self.assertEqual(self.redis.hgetall(self.target + 'LINK:c'),
+                         {'l': 'http://www.familo.net/c', 'a': 'familonet://'})
+        # Day counters are never lowered.
+        self.assertEqual(self.redis.get(self.target + 'HI:18000'), '2000')
+        self.assertEqual(self.redis.get(self.target + 'HI:18001'), '500')
+
+    def test_skip_expired(self):
+        records = [{'type': 'link', 'hash': 'a', 'urls': {'l': 'http://www.familo.net/'},
+                    'expire_at': int(time.time() * 1000) - 1}]
+        self.assertEqual(load_records(self.redis, self.target, records), {})
+
+    def test_reshard(self):
+        # Two nodes, one of them in another db.
+        other = redis.StrictRedis(db=1, decode_responses=True)
+        self.addCleanup(lambda: [other.delete(key) for key in other.scan_iter(self.source + '*')])
+        for i in range(20):
+            self.redis.hset(self.source + 'LINK:' + str(i), mapping={'l': 'http://www.familo.net/' + str(i)})
+        self.redis.set(self.source + 'DIGEST:d', '1')
+        connections = {'a': self.redis, 'b': other}
+        ring = HashRing(['a', 'b'])
+        moved = reshard(connections, self.source, ring, batch=5)
+        self.assertGreater(moved['a'], 0)
+        self.assertEqual(moved['b'], 0)
+        for i in range(20):
+            key = self.source + 'LINK:' + str(i)
+            owner = ring.get(str(i))
+            self.assertEqual(connections[owner].hget(key, 'l'), 'http://www.familo.net/' + str(i))
+            self.assertFalse(connections['b' if owner == 'a' else 'a'].exists(key))
+        self.assertEqual(connections[ring.get('d')].get(self.source + 'DIGEST:d'), '1')
+
+    def test_load_sharded(self):
+        other = redis.StrictRedis(db=1, decode_responses=True)
+        self.addCleanup(lambda: [other.delete(key) for key in other.scan_iter(self.target + '*')])
+        for i in range(20):
+            self.redis.hset(self.source + 'LINK:' + str(i), mapping={'l': 'http://www.familo.net/' + str(i)})
+        self.redis.set(self.source + 'DIGEST:d', '1')
+        self.redis.set(self.source + 'HI:18000', 1000)
+        connections = {'a': self.redis, 'b': other}
+        ring = HashRing(['a', 'b'])
+        records = list(dump_records(self.redis, self.source, types=('link', 'digest')))
+        self.assertEqual(len(records), 21)
+        records += list(dump_records(self.redis, self.source, types=('counter',)))
+        counts = load_sharded(connections, self.target, records, ring, 'a', batch=3)
+        self.assertEqual(counts, {'link': 20, 'digest': 1, 'counter': 1})
+        for i in range(20):
+            self.assertEqual(connections[ring.get(str(i))].hget(self.target + 'LINK:' + str(i), 'l'),
+                             'http://www.familo.net/' + str(i))
+        self.assertEqual(connections[ring.get('d')].get(self.target + 'DIGEST:d'), '1')
+        self.assertEqual(self.redis.get(self.target + 'HI:18000'), '1000')
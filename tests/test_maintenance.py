@@ -0,0 +1,109 @@
+import time
+import unittest
+from unittest import mock
+
+import redis
+
+from tornadoshortener.maintenance import Throttle, apply_ttl, expire_counters, on_domain, purge, purge_digests
+from tornadoshortener.utils import get_hashids
+
+
+class ThrottleTest(unittest.TestCase):
+    def test_batch_size(self):
+        throttle = Throttle(rate=0, budget=0.01, max_batch=100)
+        throttle.pace(100, 0.05)
+        throttle.pace(50, 0.05)
+        self.assertEqual(throttle.batch, 25)
+        self.assertEqual(throttle.slow_round_trips, 2)
+        throttle.pace(25, 0.001)
+        self.assertEqual(throttle.batch, 50)
+        for i in range(3):
+            throttle.pace(50, 0.001)
+        self.assertEqual(throttle.batch, 100)
+
+    def test_rate(self):
+        throttle = Throttle(rate=1000, budget=0)
+        with mock.patch('time.sleep') as sleep:
+            throttle.pace(100, 0.02)
+        sleep.assert_called_once_with(0.08)
+
+    def test_on_domain(self):
+        self.assertTrue(on_domain('http://www.Familo.net/en/', 'familo.net'))
+        self.assertTrue(on_domain('https://familo.net', 'familo.net'))
+        self.assertFalse(on_domain('http://notfamilo.net/', 'familo.net'))
+        self.assertFalse(on_domain('familonet://', 'familo.net'))
+
+
+class MaintenanceTest(unittest.TestCase):
+    namespace = 'TEST:MAINTAIN:'
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            redis.StrictRedis().ping()
+        except redis.exceptions.ConnectionError:
+            raise unittest.SkipTest('Needs redis on localhost')
+
+    def setUp(self):
+        self.redis = redis.StrictRedis(decode_responses=True)
+        self.throttle = Throttle(rate=0, max_batch=5)
+        self.tearDown()
+
+    def tearDown(self):
+        keys = list(self.redis.scan_iter(self.namespace + '*'))
+        if keys:
+            self.redis.delete(*keys)
+
+    def test_expire_counters(self):
+        today = int(time.time() / 86400)
+        for day in range(today - 10, today + 1):
+            self.redis.set(self.namespace + 'HI:' + str(day), 1000)
+            self.redis.set(self.namespace + 'HI:' + str(day) + ':unused', 10)
+        self.assertEqual(expire_counters(self.redis, self.namespace, self.throttle, 2), 16)
+        self.assertEqual(sorted(self.redis.scan_iter(self.namespace + 'HI:*:unused')),
+                         [self.namespace + 'HI:' + str(day) + ':unused' for day in range(today - 2, today + 1)])
+
+    def test_apply_ttl(self):
+        today = int(time.time() / 86400)
+        old, new = get_hashids().encode(today - 10, 1), get_hashids().encode(today, 1)
+        for url_hash in (old, new, 'vanity'):
+            self.redis.hset(self.namespace + 'LINK:' + url_hash, mapping={'l': 'http://www.familo.net/'})
+            self.redis.hincrby(self.namespace + 'STATS:' + url_hash, '2020-07-01:ios', 1)
+            self.redis.set(self.namespace + 'DIGEST:' + url_hash, url_hash)
+        self.assertEqual(apply_ttl(self.redis, self.namespace, 5, self.throttle, changelog_size=100), 9)
+        # Links older than the ttl are gone right away.
+        self.assertFalse(self.redis.exists(self.namespace + 'LINK:' + old, self.namespace + 'STATS:' + old,
+                                           self.namespace + 'DIGEST:' + old))
+        self.assertLessEqual(self.redis.ttl(self.namespace + 'LINK:' + new), 5 * 86400)
+        self.assertGreater(self.redis.ttl(self.namespace + 'LINK:vanity'), 5 * 86400 - 10)
+        # Local stores learn about the changed links.
+        self.assertEqual(sorted(fields['h'] for entry_id, fields in self.redis.xrange(self.namespace + 'CHANGES')),
+                         sorted((old, new, 'vanity')))
+        # Custom hashes keep an earlier expiry instead of getting a new one on every run.
+        self.redis.expire(self.namespace + 'LINK:vanity', 100)
+        self.redis.expire(self.namespace + 'DIGEST:vanity', 10 * 86400)
+        self.assertEqual(apply_ttl(self.redis, self.namespace, 5, self.throttle), 6)
+        self.assertLessEqual(self.redis.ttl(self.namespace + 'LINK:vanity'), 100)
+        self.assertLessEqual(self.redis.ttl(self.namespace + 'DIGEST:vanity'), 5 * 86400)
+
+        self.assertEqual(apply_ttl(self.redis, self.namespace, 0, self.throttle), 6)
+        self.assertEqual(self.redis.ttl(self.namespace + 'DIGEST:vanity'), -1)
+
+    def test_purge(self):
+        for i in range(12):
+            self.redis.hset(self.namespace + 'LINK:a' + str(i),
+                            mapping={'l': 'http://{}familo.net/'.format('www.' if i % 2 else '')})
+            self.redis.hset(self.namespace + 'LINK:b' + str(i), mapping={'l': 'http://www.familo.de/'})
+            self.redis.set(self.namespace + 'DIGEST:a' + str(i), 'a' + str(i))
+        self.redis.set(self.namespace + 'URLS:c', 'http://familo.net/c')
+        self.redis.set(self.namespace + 'URLS:c:ios_url', 'familonet://')
+        self.redis.hincrby(self.namespace + 'STATS:c', '2020-07-01:ios', 1)
+
+        self.assertEqual(purge(self.redis, self.namespace, self.throttle, domain='familo.net', dry_run=True), 13)
+        self.assertEqual(purge(self.redis, self.namespace, self.throttle, 'a1*', 'familo.net', changelog_size=100), 3)
+        self.assertEqual(sorted(fields['h'] for entry_id, fields in self.redis.xrange(self.namespace + 'CHANGES')),
+                         ['a1', 'a10', 'a11'])
+        self.assertEqual(purge(self.redis, self.namespace, self.throttle, domain='familo.net'), 10)
+        self.assertEqual(len(list(self.redis.scan_iter(self.namespace + 'LINK:*'))), 12)
+        self.assertFalse(self.redis.exists(self.namespace + 'URLS:c:ios_url', self.namespace + 'STATS:c'))
+        self.assertEqual(purge_digests({'node': self.redis}, self.namespace, self.throttle), 12)
@@ -0,0 +1,118 @@
+import time
+import unittest
+
+import redis.exceptions
+import tornado.ioloop
+
+from tornadoshortener.memory import MemoryRedis
+from tornadoshortener.storage import RedisStorage
+
+
+class MemoryRedisTest(unittest.TestCase):
+    def setUp(self):
+        self.redis = MemoryRedis()
+
+    def run_sync(self, awaitable):
+        return tornado.ioloop.IOLoop.current().run_sync(lambda: awaitable)
+
+    def test_strings(self):
+        self.assertTrue(self.run_sync(self.redis.set('a', 1)))
+        self.assertIsNone(self.run_sync(self.redis.set('a', 2, nx=True)))
+        self.assertEqual(self.run_sync(self.redis.get('a')), '1')
+        self.assertEqual(self.run_sync(self.redis.incrby('a', 10)), 11)
+        self.assertEqual(self.run_sync(self.redis.incrby('b', 5)), 5)
+        self.assertEqual(self.run_sync(self.redis.exists('a', 'b', 'c')), 2)
+        self.assertEqual(self.run_sync(self.redis.delete('a', 'c')), 1)
+        self.assertIsNone(self.run_sync(self.redis.get('a')))
+
+    def test_expiry(self):
+        self.run_sync(self.redis.set('a', 'x'))
+        self.assertEqual(self.run_sync(self.redis.ttl('a')), -1)
+        self.assertEqual(self.run_sync(self.redis.ttl('missing')), -2)
+        self.assertFalse(self.run_sync(self.redis.expire('missing', 10)))
+        self.assertTrue(self.run_sync(self.redis.expire('a', 10)))
+        self.assertEqual(self.run_sync(self.redis.ttl('a')), 10)
+
+        # Writing a hash field or incrementing keeps the TTL, SET removes it.
+        self.run_sync(self.redis.hset('h', mapping={'l': 'x'}))
+        self.run_sync(self.redis.expireat('h', int(time.time()) + 100))
+        self.run_sync(self.redis.hset('h', 'i', 'y'))
+        self.assertGreater(self.run_sync(self.redis.ttl('h')), 90)
+        self.run_sync(self.redis.set('a', 'y'))
+        self.assertEqual(self.run_sync(self.redis.ttl('a')), -1)
+
+        # Expired keys are gone.
+        self.run_sync(self.redis.set('a', 'x', px=10))
+        time.sleep(0.02)
+        self.assertIsNone(self.run_sync(self.redis.get('a')))
+        self.assertEqual(self.run_sync(self.redis.pttl('a')), -2)
+        self.run_sync(self.redis.expireat('h', int(time.time()) - 1))
+        self.assertEqual(self.run_sync(self.redis.hgetall('h')), {})
+
+    def test_hashes(self):
+        self.assertEqual(self.run_sync(self.redis.hset('h', mapping={'l': 'x', 'i': 'y'})), 2)
+        self.assertEqual(self.run_sync(self.redis.hincrby('h', 'c', 2)), 2)
+        self.assertEqual(self.run_sync(self.redis.hgetall('h')), {'l': 'x', 'i': 'y', 'c': '2'})
+        with self.assertRaises(redis.exceptions.ResponseError):
+            self.run_sync(self.redis.get('h'))
+
+    def test_pipeline(self):
+        pipe = self.redis.pipeline()
+        pipe.set('a', 'x').incrby('b', 2)
+        pipe.hset('h', mapping={'l': 'x'})
+        pipe.get('h')
+        self.assertEqual(len(pipe), 4)
+        result = self.run_sync(pipe.execute(raise_on_error=False))
+        self.assertEqual(result[:3], [True, 2, 1])
+        self.assertIsInstance(result[3], redis.exceptions.ResponseError)
+        self.assertEqual(self.redis.commands, 4)
+
+    def test_sorted_sets(self):
+        for member, amount in (('a', 3), ('b', 1), ('c', 2), ('a', 2)):
+            self.run_sync(self.redis.zincrby('z', amount, member))
+        self.assertEqual(self.run_sync(self.redis.zrevrange('z', 0, 1)), ['a', 'c'])
+        self.assertEqual(self.run_sync(self.redis.zrevrange('z', 0, -1, withscores=True)),
+                         [('a', 5.0), ('c', 2.0), ('b', 1.0)])
+        # Keeps the two highest scores.
+        self.assertEqual(self.run_sync(self.redis.zremrangebyrank('z', 0, -3)), 1)
+        self.assertEqual(self.run_sync(self.redis.zrevrange('z', 0, -1)), ['a', 'c'])
+        with self.assertRaises(redis.exceptions.ResponseError):
+            self.run_sync(self.redis.hgetall('z'))
+
+    def test_reserve(self):
+        storage = RedisStorage(self.redis, ttl=1)
+        links = [('a', ('http://www.familo.net/', None, None, 'familonet://', None)),
+                 ('a', ('http://www.familo.de/', None, None, None, None))]
+        self.assertEqual(self.run_sync(storage.reserve_many(links)), [True, False])
+        self.assertEqual(self.run_sync(self.redis.hgetall('SHORT:LINK:a')),
+                         {'l': 'http://www.familo.net/', 'i': 'familonet://'})
+        self.assertGreater(self.run_sync(self.redis.ttl('SHORT:LINK:a')), 86000)
+        # Links in the legacy layout are taken as well.
+        self.run_sync(self.redis.set('SHORT:URLS:b', 'http://www.familo.net/'))
+        self.assertEqual(self.run_sync(storage.reserve_many(links[1:] + [('b', links[1][1])])), [False, False])
+        # One command per reservation.
+        self.assertEqual(self.redis.commands, 7)
+
+    def test_digests(self):
+        storage = RedisStorage(self.redis, ttl=1)
+        self.run_sync(self.redis.set('SHORT:DIGEST:d', 'a', ex=100))
+        self.run_sync(storage.store_digests(['b', 'c'], ['d', 'e']))
+        self.assertEqual(self.redis.commands, 3)
+        # The existing digest keeps both its link and its expiry.
+        self.assertEqual(self.run_sync(self.redis.get('SHORT:DIGEST:d')), 'a')
+        self.assertLessEqual(self.run_sync(self.redis.ttl('SHORT:DIGEST:d')), 100)
+        self.assertGreater(self.run_sync(self.redis.ttl('SHORT:DIGEST:e')), 86000)
+
+    def test_streams(self):
+        ids = [self.run_sync(self.redis.xadd('s', {'h': str(i)}, maxlen=3)) for i in range(5)]
+        entries = self.run_sync(self.redis.xrange('s'))
+        self.assertEqual([fields['h'] for entry_id, fields in entries], ['2', '3', '4'])
+        self.assertEqual(self.run_sync(self.redis.xrevrange('s', count=1))[0][0], ids[-1])
+        self.assertEqual(self.run_sync(self.redis.xread({'s': ids[3]})), [['s', [(ids[4], {'h': '4'})]]])
+        self.assertEqual(self.run_sync(self.redis.xread({'s': ids[4]})), [])
+
+    def test_latency(self):
+        self.redis.latency = 0.02
+        start = time.monotonic()
+        self.run_sync(self.redis.pipeline().set('a', 'x').get('a').execute())
+        self.assertGreaterEqual(time.monotonic() - start, 0.02)
@@ -0,0 +1,42 @@
+import tempfile
+import unittest
+
+from tornadoshortener.metrics import Metrics, merge, render
+
+
+class MetricsTest(unittest.TestCase):
+    def test_render(self):
+        metrics = Metrics()
+        metrics.inc('requests_total', (('handler', 'RedirectHandler'), ('code', 301)))
+        metrics.inc('requests_total', (('handler', 'RedirectHandler'), ('code', 301)))
+        metrics.set('active_requests', 3)
+        metrics.observe('request_duration_seconds', 0.002)
+        metrics.observe('request_duration_seconds', 10)
+        text = metrics.render()
+        self.assertIn('# TYPE tornadoshortener_requests_total counter', text)
+        self.assertIn('tornadoshortener_requests_total{handler="RedirectHandler",code="301"} 2', text)
+        self.assertIn('tornadoshortener_active_requests 3', text)
+        self.assertIn('tornadoshortener_request_duration_seconds_bucket{le="0.001"} 0', text)
+        self.assertIn('tornadoshortener_request_duration_seconds_bucket{le="0.0025"} 1', text)
+        self.assertIn('tornadoshortener_request_duration_seconds_bucket{le="+Inf"} 2', text)
+        self.assertIn('tornadoshortener_request_duration_seconds_count 2', text)
+
+    def test_merge(self):
+        first, second = Metrics(), Metrics()
+        for metrics in (first, second):
+            metrics.inc('redirects_total', (('outcome', 'ios'),))
+            metrics.set('cache_entries', 5)
+            metrics.observe('redis_duration_seconds', 0.001)
+        old = second.snapshot()
+        old['time'] = 0
+        counters, gauges, histograms = merge([first.snapshot(), old], gauges_since=1)
+        self.assertEqual(counters[('redirects_total', (('outcome', 'ios'),))], 2)
+        self.assertEqual(gauges[('cache_entries', ())], 5)
+        self.assertEqual(sum(histograms[('redis_duration_seconds', ())].counts), 2)
+
+    def test_snapshots(self):
+        with tempfile.TemporaryDirectory() as path:
+            metrics = Metrics(path)
+            metrics.inc('requests_total')
+            metrics.stop()
+            self.assertIn('tornadoshortener_requests_total 1', render(merge(metrics.read_snapshots())))
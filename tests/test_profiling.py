@@ -0,0 +1,52 @@
+import time
+import unittest
+
+import tornado.ioloop
+
+from tornadoshortener import profiling
+
+
+def busy(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+class RequestTraceTest(unittest.TestCase):
+    def test_format(self):
+        trace = profiling.RequestTrace()
+        trace.add('redis:load_urls', 0.002)
+        trace.add('json', 0.0005)
+        trace.add('redis:load_urls', 0.001)
+        self.assertEqual(trace.format(0.01), 'json=0.50ms redis:load_urls=3.00ms other=6.50ms')
+
+    def test_record_phase(self):
+        # Nothing is recorded without a trace.
+        profiling.record_phase('render', 1)
+        trace = profiling.RequestTrace()
+        token = profiling.current_trace.set(trace)
+        try:
+            profiling.record_phase('render', 1)
+        finally:
+            profiling.current_trace.reset(token)
+        profiling.record_phase('render', 1)
+        self.assertEqual(trace.phases, {'render': 1})
+
+
+class SamplingProfilerTest(unittest.TestCase):
+    def test_profile(self):
+        profiler = profiling.SamplingProfiler(interval=0.001)
+
+        async def profile():
+            tornado.ioloop.IOLoop.current().call_later(0.01, busy, 0.1)
+            return await profiler.profile(0.2)
+
+        stacks = tornado.ioloop.IOLoop.current().run_sync(profile)
+        self.assertFalse(profiler.running)
+        samples = {}
+        for line in stacks.splitlines():
+            stack, count = line.rsplit(' ', 1)
+            samples[stack] = int(count)
+        busy_samples = sum(count for stack, count in samples.items()
+                           if stack.endswith('test_profiling.py:busy'))
+        self.assertGreater(busy_samples, 10)
@@ -0,0 +1,85 @@
+import unittest
+
+import tornado.ioloop
+
+from tornadoshortener.ratelimit import RateLimiter
+
+
+class SharedRedis(object):
+    """
+    Just enough of a redis client to share counters between rate limiters.
+    """
+    def __init__(self):
+        self.hashes = {}
+
+    def pipeline(self, transaction=True):
+        return SharedPipeline(self)
+
+
+class SharedPipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def hincrby(self, key, field, amount):
+        self.commands.append(('hincrby', key, field, amount))
+
+    def expire(self, key, seconds):
+        self.commands.append(('expire', key, seconds))
+
+    def execute(self):
+        result = []
+        for command in self.commands:
+            if command[0] == 'hincrby':
+                fields = self.redis.hashes.setdefault(command[1], {})
+                fields[command[2]] = fields.get(command[2], 0) + command[3]
+                result.append(fields[command[2]])
+            else:
+                result.append(True)
+        return result
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_consume(self):
+        limiter = RateLimiter(None, {'shorten': (1, 3), 'redirect': (0, 0)})
+        for i in range(3):
+            self.assertEqual(limiter.consume('shorten', '10.0.0.1'), 0)
+        self.assertGreater(limiter.consume('shorten', '10.0.0.1'), 0)
+        self.assertEqual(limiter.rejected, 1)
+        # Other clients and unlimited routes are not affected.
+        self.assertEqual(limiter.consume('shorten', '10.0.0.2'), 0)
+        self.assertEqual(limiter.consume('redirect', '10.0.0.1'), 0)
+        self.assertEqual(limiter.consume('expand', '10.0.0.1'), 0)
+        self.assertEqual(len(limiter), 2)
+
+    def test_consume_many(self):
+        limiter = RateLimiter(None, {'shorten': (1, 3)})
+        # Never more than the burst is taken at once.
+        self.assertEqual(limiter.consume('shorten', '10.0.0.1', 100), 0)
+        self.assertGreater(limiter.consume('shorten', '10.0.0.1'), 0)
+
+    def test_max_buckets(self):
+        limiter = RateLimiter(None, {'shorten': (1, 3)}, max_buckets=2)
+        for client in ('a', 'b', 'c'):
+            limiter.consume('shorten', client)
+        self.assertEqual(len(limiter), 2)
+
+    def test_sync(self):
+        redis = SharedRedis()
+        first = RateLimiter(redis, {'shorten': (1, 10)})
+        second = RateLimiter(redis, {'shorten': (1, 10)})
+        for i in range(4):
+            first.consume('shorten', '10.0.0.1')
+        for i in range(3):
+            second.consume('shorten', '10.0.0.1')
+        io_loop = tornado.ioloop.IOLoop.current()
+        io_loop.run_sync(first.sync)
+        io_loop.run_sync(second.sync)
+        io_loop.run_sync(first.sync)
+        # Both processes know about all 7 requests.
+        for limiter in (first, second):
+            self.assertAlmostEqual(limiter._buckets[('shorten', '10.0.0.1')].tokens, 3, delta=0.1)
+        self.assertEqual(list(redis.hashes.values()), [{'10.0.0.1': 7}])
@@ -1,13 +1,19 @@
 import json
+import os
+import time
 
+from tornado import gen
 from tornado.testing import AsyncHTTPTestCase, gen_test
 
 from tornadoshortener.app import Application
+from tornadoshortener.ratelimit import RateLimiter
+from tornadoshortener.utils import get_hashids
 
 
 class MyHTTPTest(AsyncHTTPTestCase):
     def get_app(self):
-        return Application()
+        # Set TEST_STORAGE=redis to test against redis on localhost.
+        return Application(storage=os.environ.get('TEST_STORAGE', 'memory'))
 
     async def shorten(self):
         # Shorten an URL.
@@ -67,12 +73,187 @@ class MyHTTPTest(AsyncHTTPTestCase):
     async def test_shortening_mobile(self):
         await self.shorten_mobile()
 
+    @gen_test(timeout=5)
+    async def test_shortening_batch(self):
+        entries = [
+            {'longUrl': 'http://www.familo.net/en/'},
+            {'longUrl': 'invalid'},
+            {'longUrl': 'http://www.familo.net/de/', 'iosUrl': 'familonet://', 'domain': 'short.familo.net'},
+        ]
+        for body in (json.dumps(entries), '\n'.join(json.dumps(entry) for entry in entries)):
+            response = await self.http_client.fetch(self.get_url('/shorten/batch'), method='POST', body=body)
+            response.json = json.loads(response.body)
+            self.assertEqual(response.json.get('status_code'), 200)
+            results = response.json['data']['shorten']
+            self.assertEqual(len(results), 3)
+            self.assertEqual(results[0]['long_url'], 'http://www.familo.net/en/')
+            self.assertEqual(results[1], {'error': 'INVALID_URI', 'long_url': 'invalid'})
+            self.assertEqual(results[2]['ios_url'], 'familonet://')
+            self.assertEqual(results[2]['url'], 'http://short.familo.net/' + results[2]['hash'])
+            self.assertNotEqual(results[0]['hash'], results[2]['hash'])
+
+            # The links are stored.
+            response = await self.http_client.fetch(self.get_url('/expand?hash=' + results[2]['hash']))
+            self.assertEqual(json.loads(response.body)['data']['expand'][0]['long_url'], 'http://www.familo.net/de/')
+
+        response = await self.http_client.fetch(self.get_url('/shorten/batch'), method='POST', body='{')
+        self.assertEqual(json.loads(response.body).get('status_txt'), 'INVALID_ARG_BATCH')
+
+        # Invalid domains are rejected per entry like by /shorten, a missing one is the default.
+        entries = [{'longUrl': 'http://www.familo.net/', 'domain': domain} for domain in (42, ['a'], '', None)]
+        response = await self.http_client.fetch(self.get_url('/shorten/batch'), method='POST',
+                                                body=json.dumps(entries))
+        results = json.loads(response.body)['data']['shorten']
+        self.assertEqual(results[:3], [{'error': 'INVALID_ARG_DOMAIN', 'long_url': 'http://www.familo.net/'}] * 3)
+        self.assertEqual(results[3]['url'], 'http://localhost/' + results[3]['hash'])
+        response = await self.http_client.fetch(self.get_url('/shorten?longUrl=http%3A%2F%2Fwww.familo.net%2F'
+                                                             '&domain='))
+        self.assertEqual(json.loads(response.body).get('status_txt'), 'INVALID_ARG_DOMAIN')
+
+    @gen_test(timeout=5)
+    async def test_shortening_alias(self):
+        url = self.get_url('/shorten?longUrl=http%3A%2F%2Fwww.familo.net%2F&alias=')
+        response = await self.http_client.fetch(url + 'familo')
+        data = json.loads(response.body)['data']
+        self.assertEqual((data['hash'], data['url']), ('familo', 'http://localhost/familo'))
+        response = await self.http_client.fetch(self.get_url('/familo'), follow_redirects=False, raise_error=False)
+        self.assertEqual(response.headers['Location'], 'http://www.familo.net/')
+
+        # Aliases are never overwritten.
+        response = await self.http_client.fetch(self.get_url('/shorten?longUrl=http%3A%2F%2Fwww.familo.de%2F'
+                                                             '&alias=familo'))
+        self.assertEqual(json.loads(response.body)['status_txt'], 'ALIAS_TAKEN')
+        response = await self.http_client.fetch(self.get_url('/expand?hash=familo'))
+        self.assertEqual(json.loads(response.body)['data']['expand'][0]['long_url'], 'http://www.familo.net/')
+
+        # Generated hashes, other endpoints and invalid characters are rejected.
+        generated = await self.shorten()
+        for alias in (generated, 'stats', 'fa-milo', 'x' * 65):
+            response = await self.http_client.fetch(url + alias)
+            self.assertEqual(json.loads(response.body)['status_txt'], 'INVALID_ARG_ALIAS')
+
+        entries = [{'longUrl': 'http://www.familo.net/a', 'alias': 'familoA'},
+                   {'longUrl': 'http://www.familo.net/b', 'alias': 'familoA'},
+                   {'longUrl': 'http://www.familo.net/c'}]
+        response = await self.http_client.fetch(self.get_url('/shorten/batch'), method='POST',
+                                                body=json.dumps(entries))
+        results = json.loads(response.body)['data']['shorten']
+        self.assertEqual(results[0]['hash'], 'familoA')
+        self.assertEqual(results[1], {'error': 'ALIAS_TAKEN', 'long_url': 'http://www.familo.net/b'})
+        self.assertEqual(results[2]['long_url'], 'http://www.familo.net/c')
+
+    @gen_test(timeout=5)
+    async def test_shortening_dedup(self):
+        self._app.settings['dedup'] = True
+        url_hash = await self.shorten()
+        self.assertEqual(await self.shorten(), url_hash)
+        self.assertEqual(await self.shorten_mobile(), await self.shorten_mobile())
+        self.assertNotEqual(await self.shorten_mobile(), url_hash)
+
+        entries = [{'longUrl': 'http://www.familo.net/en/?ref=http%3A%2F%2Ffamilo.net%2F'},
+                   {'longUrl': 'http://www.familo.net/dedup/'},
+                   {'longUrl': 'http://www.familo.net/dedup/'},
+                   {'longUrl': 'http://www.familo.net/dedup/', 'domain': 'short.familo.net'}]
+        response = await self.http_client.fetch(self.get_url('/shorten/batch'), method='POST',
+                                                body=json.dumps(entries))
+        hashes = [result['hash'] for result in json.loads(response.body)['data']['shorten']]
+        self.assertEqual(hashes[0], url_hash)
+        self.assertEqual(hashes[1], hashes[2])
+        self.assertNotEqual(hashes[1], hashes[3])
+
+    @gen_test(timeout=5)
+    async def test_hash_block_lease(self):
+        day = int(time.time() / 86400)
+        counter_key = 'SHORT:HI:' + str(day)
+        before = int(await self._app.redis.get(counter_key) or 0)
+        unused_before = int(await self._app.redis.get(counter_key + ':unused') or 0)
+
+        # Only the first hash leases a block of indices from Redis.
+        first = get_hashids().decode(await self.shorten())
+        second = get_hashids().decode(await self.shorten())
+        self.assertEqual(first, (day, before + 1))
+        self.assertEqual(second, (day, before + 2))
+        self.assertEqual(int(await self._app.redis.get(counter_key)), before + 1000)
+
+        # Releasing the lease accounts for the unused indices.
+        await self._app.hash_generator.release()
+        self.assertEqual(int(await self._app.redis.get(counter_key + ':unused')), unused_before + 998)
+
     @gen_test(timeout=5)
     async def test_redirection(self):
         url_hash = await self.shorten()
         response = await self.http_client.fetch(self.get_url('/' + url_hash))
         self.assertIn('www.familo.net/en/?ref=http%3A%2F%2Ffamilo.net%2F', response.effective_url)
 
+    @gen_test(timeout=5)
+    async def test_redirection_cached(self):
+        url_hash = await self.shorten()
+        for i in range(2):
+            response = await self.http_client.fetch(self.get_url('/' + url_hash), follow_redirects=False,
+                                                    raise_error=False)
+            self.assertEqual(response.code, 301)
+            self.assertEqual(response.headers.get('Location'),
+                             'http://www.familo.net/en/?ref=http%3A%2F%2Ffamilo.net%2F')
+        self.assertEqual(self._app.link_cache.hits, 1)
+
+        # Unknown hashes are cached as well.
+        for i in range(2):
+            response = await self.http_client.fetch(self.get_url('/unknown'), raise_error=False)
+            self.assertEqual(response.code, 404)
+        self.assertEqual(self._app.link_cache.hits, 2)
+
+    @gen_test(timeout=5)
+    async def test_redirection_headers(self):
+        self._app.settings['redirect_status'] = 302
+        self._app.settings['redirect_max_age'] = 3600
+        url_hash = await self.shorten()
+        response = await self.http_client.fetch(self.get_url('/' + url_hash), follow_redirects=False,
+                                                raise_error=False)
+        self.assertEqual(response.code, 302)
+        self.assertEqual(response.headers.get('Cache-Control'), 'max-age=3600')
+        self.assertNotIn('Access-Control-Allow-Origin', response.headers)
+        self.assertEqual(len(self._app.page_cache), 0)
+
+        # Changed settings apply to the next redirect.
+        self._app.settings['redirect_max_age'] = 60
+        response = await self.http_client.fetch(self.get_url('/' + url_hash), follow_redirects=False,
+                                                raise_error=False)
+        self.assertEqual(response.headers.get('Cache-Control'), 'max-age=60')
+
+        # Redirects of links with alternative URLs depend on the device.
+        url_hash = await self.shorten_mobile()
+        response = await self.http_client.fetch(self.get_url('/' + url_hash), follow_redirects=False,
+                                                raise_error=False)
+        self.assertEqual(response.code, 302)
+        self.assertNotIn('Cache-Control', response.headers)
+
+    @gen_test(timeout=5)
+    async def test_redirection_outage(self):
+        self._app.link_cache.stale_ttl = 3600
+        url_hash = await self.shorten()
+        # The link expires in the cache right away.
+        self._app.link_cache.set(url_hash, (await self._app.storage.load_many([url_hash]))[0], 0.01)
+        await gen.sleep(0.02)
+
+        async def fail(url_hashes, with_expiry=False):
+            await gen.sleep(0.01)
+            raise ConnectionError('Redis is down')
+        self._app.storage.load_many = fail
+
+        # Links expired in the cache are still served, unknown links are unavailable.
+        responses = await gen.multi([self.http_client.fetch(self.get_url('/' + path), follow_redirects=False,
+                                                            raise_error=False)
+                                     for path in (url_hash, url_hash, 'unknown', 'unknown')])
+        self.assertEqual([response.code for response in responses], [301, 301, 503, 503])
+        self.assertEqual(responses[0].headers.get('Location'),
+                         'http://www.familo.net/en/?ref=http%3A%2F%2Ffamilo.net%2F')
+        self.assertEqual(self._app.single_flight.coalesced, 2)
+
+    def test_redirection_status(self):
+        for status in (200, 3080):
+            with self.assertRaises(ValueError):
+                Application(storage='memory', redirect_status=status)
+
     @gen_test(timeout=5)
     async def test_redirection_mobile(self):
         url_hash = await self.shorten_mobile()
@@ -99,6 +280,153 @@ class MyHTTPTest(AsyncHTTPTestCase):
         response = await self.http_client.fetch(self.get_url('/' + url_hash))
         self.assertIn('www.familo.net/en/', response.effective_url)
 
+        # Bots get a plain redirect even with a mobile User-Agent.
+        response = await self.http_client.fetch(self.get_url('/' + url_hash), follow_redirects=False,
+                                                raise_error=False,
+                                                user_agent='Mozilla/5.0 (Linux; Android 6.0.1) Googlebot/2.1')
+        self.assertEqual(response.code, 301)
+
+    @gen_test(timeout=5)
+    async def test_redirection_mobile_etag(self):
+        url_hash = await self.shorten_mobile()
+        response = await self.http_client.fetch(self.get_url('/' + url_hash), user_agent='Android')
+        etag = response.headers.get('Etag')
+        self.assertIsNotNone(etag)
+        self.assertEqual(response.headers.get_list('Vary'), ['Accept-Encoding'])
+        self.assertIn(b'familonet://', response.body)
+        self.assertEqual(len(self._app.page_cache), 1)
+
+        # The cached page is served again and revalidated with the ETag.
+        response = await self.http_client.fetch(self.get_url('/' + url_hash), user_agent='Android')
+        self.assertEqual(response.headers.get('Etag'), etag)
+        self.assertIn(b'familonet://', response.body)
+        response = await self.http_client.fetch(self.get_url('/' + url_hash), user_agent='Android',
+                                                headers={'If-None-Match': etag}, raise_error=False)
+        self.assertEqual(response.code, 304)
+        self.assertEqual(self._app.page_cache.hits, 2)
+
+    @gen_test(timeout=5)
+    async def test_metrics(self):
+        url_hash = await self.shorten()
+        await self.http_client.fetch(self.get_url('/' + url_hash), follow_redirects=False, raise_error=False)
+        response = await self.http_client.fetch(self.get_url('/metrics'))
+        self.assertIn('text/plain', response.headers.get('Content-Type', ''))
+        body = response.body.decode()
+        self.assertIn('tornadoshortener_redirects_total{device="desktop",outcome="301"} 1', body)
+        self.assertIn('tornadoshortener_requests_total{handler="ShortHandler",method="GET",code="200"} 1', body)
+        self.assertIn('tornadoshortener_redis_duration_seconds_count{operation="load_urls"} 1', body)
+        self.assertIn('tornadoshortener_cache_misses_total{cache="link"} 1', body)
+
+    @gen_test(timeout=5)
+    async def test_rate_limit(self):
+        # Buckets of 3 requests that hardly refill during the test.
+        self._app.rate_limiter = RateLimiter(self._app.redis, {'shorten': (0.01, 3), 'expand': (0.01, 3)})
+        entries = json.dumps([{'longUrl': 'http://www.familo.net/en/'}, {'longUrl': 'http://www.familo.net/de/'}])
+        response = await self.http_client.fetch(self.get_url('/shorten/batch'), method='POST', body=entries)
+        results = json.loads(response.body)['data']['shorten']
+        self.assertEqual(len(results), 2)
+
+        # Every entry of a batch takes a token, one is left.
+        response = await self.http_client.fetch(self.get_url('/shorten/batch'), method='POST', body=entries,
+                                                raise_error=False)
+        self.assertEqual(response.code, 429)
+        self.assertEqual(response.headers.get('Retry-After'), '100')
+        self.assertEqual(json.loads(response.body).get('status_txt'), 'RATE_LIMIT_EXCEEDED')
+
+        # Batches of expand are charged per entry as well.
+        hashes = json.dumps([result['hash'] for result in results] + ['unknown'])
+        response = await self.http_client.fetch(self.get_url('/expand'), method='POST', body=hashes)
+        self.assertEqual(len(json.loads(response.body)['data']['expand']), 3)
+        response = await self.http_client.fetch(self.get_url('/expand?hash=' + results[0]['hash']),
+                                                raise_error=False)
+        self.assertEqual(response.code, 429)
+        self.assertEqual(self._app.rate_limiter.rejected, 2)
+
+    @gen_test(timeout=5)
+    async def test_slow_requests(self):
+        self._app.settings['slow_request_threshold'] = 1e-9
+        with self.assertLogs('tornadoshortener.slow') as logs:
+            url_hash = await self.shorten()
+            await self.http_client.fetch(self.get_url('/' + url_hash), follow_redirects=False, raise_error=False)
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn('normalize=', logs.output[0])
+        self.assertIn('json=', logs.output[0])
+        self.assertIn('redis:store_urls=', logs.output[0])
+        self.assertIn('redis:load_urls=', logs.output[1])
+
+    @gen_test(timeout=5)
+    async def test_admin_profile(self):
+        # Admin endpoints do not exist without a token.
+        response = await self.http_client.fetch(self.get_url('/admin/profile?seconds=0.05'), raise_error=False)
+        self.assertEqual(response.code, 404)
+        self._app.settings['admin_token'] = 'secret'
+        response = await self.http_client.fetch(self.get_url('/admin/profile?seconds=0.05'), raise_error=False,
+                                                headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(response.code, 403)
+        response = await self.http_client.fetch(self.get_url('/admin/profile?seconds=0.1&interval=0.001'),
+                                                headers={'Authorization': 'Bearer secret'})
+        self.assertIn('attachment', response.headers.get('Content-Disposition', ''))
+        self.assertIn('base_events.py:run_forever', response.body.decode())
+
+    @gen_test(timeout=5)
+    async def test_readiness(self):
+        response = await self.http_client.fetch(self.get_url('/healthz'))
+        self.assertEqual(response.body, b'OK')
+        response = await self.http_client.fetch(self.get_url('/readyz'), raise_error=False)
+        self.assertEqual(response.code, 503)
+        await self._app.warm_up()
+        response = await self.http_client.fetch(self.get_url('/readyz'))
+        self.assertEqual(response.body, b'READY')
+        self.assertIn('warm_up', self._app.startup)
+
+    @gen_test(timeout=5)
+    async def test_preload(self):
+        url_hash = await self.shorten()
+        click_counter = self._app.click_counter
+        click_counter.hot_links = 10
+        click_counter.record(url_hash, 'desktop')
+        click_counter.record('missing', 'desktop')
+        await click_counter.flush()
+        self.assertEqual(await self._app.preload(10), 1)
+        self.assertEqual(self._app.link_cache.get(url_hash)[0],
+                         'http://www.familo.net/en/?ref=http%3A%2F%2Ffamilo.net%2F')
+
+    @gen_test(timeout=5)
+    async def test_stats(self):
+        url_hash = await self.shorten_mobile()
+        for user_agent in ('Android', 'Android', 'iPhone', 'curl/7.68.0'):
+            await self.http_client.fetch(self.get_url('/' + url_hash), user_agent=user_agent,
+                                         follow_redirects=False, raise_error=False)
+        await self._app.click_counter.flush()
+        response = await self.http_client.fetch(self.get_url('/stats?hash=' + url_hash))
+        response.json = json.loads(response.body)
+        self.assertEqual(response.json.get('status_code'), 200)
+        data = response.json['data']
+        self.assertEqual(data['clicks'], 4)
+        self.assertEqual(list(data['days'].values()), [{'android': 2, 'ios': 1, 'bot': 1}])
+
+        response = await self.http_client.fetch(self.get_url('/stats'))
+        self.assertEqual(json.loads(response.body).get('status_txt'), 'MISSING_ARG_SHORTURL_OR_HASH')
+
+    @gen_test(timeout=5)
+    async def test_stats_single_click(self):
+        # An empty click counter still counts and serves clicks.
+        url_hash = await self.shorten()
+        response = await self.http_client.fetch(self.get_url('/stats?hash=' + url_hash))
+        response.json = json.loads(response.body)
+        self.assertEqual(response.json.get('status_code'), 200)
+        self.assertEqual(response.json['data']['clicks'], 0)
+
+        await self.http_client.fetch(self.get_url('/' + url_hash), follow_redirects=False, raise_error=False)
+        self.assertEqual(len(self._app.click_counter), 1)
+        await self._app.click_counter.flush()
+        self.assertEqual(len(self._app.click_counter), 0)
+        response = await self.http_client.fetch(self.get_url('/stats?hash=' + url_hash))
+        response.json = json.loads(response.body)
+        self.assertEqual(response.json.get('status_code'), 200)
+        self.assertEqual(response.json['data']['clicks'], 1)
+        self.assertEqual(list(response.json['data']['days'].values()), [{'desktop': 1}])
+
     @gen_test(timeout=5)
     async def test_expand_hash(self):
         url_hash = await self.shorten()
@@ -118,6 +446,47 @@ class MyHTTPTest(AsyncHTTPTestCase):
         self.assertEqual(url_hash, url_hash)
         self.assertEqual(data.get('long_url'), 'http://www.familo.net/en/?ref=http%3A%2F%2Ffamilo.net%2F')
 
+    @gen_test(timeout=5)
+    async def test_expand_batch(self):
+        first = await self.shorten()
+        second = await self.shorten_mobile()
+
+        # Repeated arguments.
+        response = await self.http_client.fetch(self.get_url(
+            '/expand?shortUrl=http%3A%2F%2Flocalhost%2F' + first + '&hash=unknown&hash=' + second))
+        expand = json.loads(response.body)['data']['expand']
+        self.assertEqual([data.get('hash') for data in expand], [first, 'unknown', second])
+        self.assertEqual(expand[0].get('short_url'), 'http://localhost/' + first)
+        self.assertEqual(expand[1].get('error'), 'NOT_FOUND')
+        self.assertEqual(expand[2].get('ios_url'), 'familonet://')
+
+        # JSON body.
+        body = json.dumps([second, {'shortUrl': 'http://localhost/' + first}, {'hash': 'unknown'}])
+        response = await self.http_client.fetch(self.get_url('/expand'), method='POST', body=body)
+        expand = json.loads(response.body)['data']['expand']
+        self.assertEqual([data.get('hash') for data in expand], [second, first, 'unknown'])
+        self.assertEqual(expand[1].get('long_url'), 'http://www.familo.net/en/?ref=http%3A%2F%2Ffamilo.net%2F')
+        self.assertEqual(expand[2].get('error'), 'NOT_FOUND')
+
+    @gen_test(timeout=5)
+    async def test_expand_legacy_layout(self):
+        # Store a link in the legacy layout with one key per URL.
+        redis = self._app.redis
+        await redis.set('SHORT:URLS:legacy', 'http://www.familo.net/')
+        await redis.set('SHORT:URLS:legacy:ios_url', 'familonet://')
+        await redis.expire('SHORT:URLS:legacy', 3600)
+
+        response = await self.http_client.fetch(self.get_url('/expand?hash=legacy'))
+        data = json.loads(response.body)['data']['expand'][0]
+        self.assertEqual(data.get('long_url'), 'http://www.familo.net/')
+        self.assertEqual(data.get('ios_url'), 'familonet://')
+        self.assertIsNone(data.get('android_url'))
+
+        # The link has been migrated to a single hash keeping its TTL.
+        self.assertEqual(await redis.exists('SHORT:URLS:legacy', 'SHORT:URLS:legacy:ios_url'), 0)
+        self.assertEqual(await redis.hgetall('SHORT:LINK:legacy'), {'l': 'http://www.familo.net/', 'i': 'familonet://'})
+        self.assertGreater(await redis.ttl('SHORT:LINK:legacy'), 0)
+
     @gen_test(timeout=5)
     async def test_expand_hash_mobile(self):
         url_hash = await self.shorten_mobile()
@@ -0,0 +1,115 @@
+import os
+import tempfile
+import unittest
+
+import tornado.ioloop
+
+from tornadoshortener.storage import HashRing, LocalStore, ShardedStorage, TieredStorage, parse_node, stream_id
+
+URLS = ('http://www.familo.net/', 'familonet://', None, None, None)
+
+
+class RemoteStorage(object):
+    """
+    A storage backend keeping links in a dict, counting loads.
+    """
+    ttl = 0
+
+    def __init__(self):
+        self.links = {}
+        self.digests = {}
+        self.loads = 0
+
+    async def store_many(self, links, digests=None):
+        self.links.update(links)
+        self.digests.update(zip(digests or (), (url_hash for url_hash, urls in links)))
+
+    async def store_digests(self, url_hashes, digests):
+        self.digests.update(zip(digests, url_hashes))
+
+    async def find_digests(self, digests):
+        return [self.digests.get(digest) for digest in digests]
+
+    async def load_many(self, url_hashes, with_expiry=False):
+        self.loads += 1
+        results = [(self.links.get(url_hash, (None,) * 5), None) for url_hash in url_hashes]
+        return results if with_expiry else [urls for urls, expires_in in results]
+
+
+class LocalStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = LocalStore(os.path.join(self.directory.name, 'links.db'))
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_put_and_get(self):
+        self.store.put_many([('a', URLS, None), ('b', URLS, 60), ('c', URLS, -1)])
+        found = self.store.get_many(['a', 'b', 'c', 'd'])
+        self.assertEqual(found['a'], (URLS, None))
+        self.assertEqual(found['b'][0], URLS)
+        self.assertLessEqual(found['b'][1], 60)
+        self.assertEqual(set(found), {'a', 'b'})
+        self.store.delete_many(['a'])
+        self.assertEqual(set(self.store.get_many(['a', 'b'])), {'b'})
+
+    def test_meta(self):
+        self.assertIsNone(self.store.get_meta('changelog_id'))
+        self.store.set_meta('changelog_id', '1-0')
+        self.assertEqual(self.store.get_meta('changelog_id'), '1-0')
+
+    def test_tiered(self):
+        remote = RemoteStorage()
+        storage = TieredStorage(remote, self.store, sync_interval=0)
+        io_loop = tornado.ioloop.IOLoop.current()
+        io_loop.run_sync(lambda: storage.store_many([('a', URLS)]))
+        self.assertEqual(io_loop.run_sync(lambda: storage.load_many(['a'])), [URLS])
+        self.assertEqual(remote.loads, 0)
+
+        # Links not found locally are loaded from the remote storage once.
+        remote.links['b'] = URLS
+        for i in range(2):
+            self.assertEqual(io_loop.run_sync(lambda: storage.load_many(['a', 'b', 'c'])),
+                             [URLS, URLS, (None,) * 5])
+        self.assertEqual(remote.loads, 2)
+
+    def test_stream_id(self):
+        self.assertLess(stream_id('1526919030474-9'), stream_id('1526919030474-10'))
+
+
+class ShardingTest(unittest.TestCase):
+    def test_hash_ring(self):
+        keys = [str(i) for i in range(3000)]
+        ring = HashRing(['a', 'b', 'c'])
+        owners = [ring.get(key) for key in keys]
+        for node in 'abc':
+            self.assertGreater(owners.count(node), 700)
+        # The order of the nodes does not matter.
+        ring = HashRing(['c', 'a', 'b'])
+        self.assertEqual(owners, [ring.get(key) for key in keys])
+
+        # Adding a node only moves keys to the new node.
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        for key, owner in zip(keys, owners):
+            self.assertIn(ring.get(key), (owner, 'd'))
+
+    def test_sharded(self):
+        nodes = {'a': RemoteStorage(), 'b': RemoteStorage()}
+        storage = ShardedStorage(nodes)
+        io_loop = tornado.ioloop.IOLoop.current()
+        links = [(str(i), URLS) for i in range(20)]
+        digests = ['digest' + str(i) for i in range(20)]
+        io_loop.run_sync(lambda: storage.store_many(links, digests))
+        for name, node in nodes.items():
+            self.assertTrue(node.links)
+            self.assertTrue(all(storage.ring.get(url_hash) == name for url_hash in node.links))
+            self.assertTrue(all(storage.ring.get(digest) == name for digest in node.digests))
+
+        self.assertEqual(io_loop.run_sync(lambda: storage.load_many(['3', 'x', '7'])), [URLS, (None,) * 5, URLS])
+        self.assertEqual(io_loop.run_sync(lambda: storage.find_digests(['digest5', 'x'])), ['5', None])
+
+    def test_parse_node(self):
+        self.assertEqual(parse_node('redis1'), ('redis1', 6379, 0))
+        self.assertEqual(parse_node(' redis1:6380/2'), ('redis1', 6380, 2))
@@ -0,0 +1,45 @@
+import unittest
+
+from tornadoshortener.utils import parse_url, validate_url
+
+
+class ParseUrlTest(unittest.TestCase):
+    def test_web_urls(self):
+        self.assertEqual(parse_url('http://www.familo.net/en/?ref=http%3A%2F%2Ffamilo.net%2F'),
+                         'http://www.familo.net/en/?ref=http%3A%2F%2Ffamilo.net%2F')
+        self.assertEqual(parse_url('HTTPS://WWW.Familo.net'), 'https://www.familo.net')
+        self.assertEqual(parse_url('http://de.wikipedia.org/wiki/Elf (Begriffsklärung)'),
+                         'http://de.wikipedia.org/wiki/Elf%20(Begriffskl%C3%A4rung)')
+        self.assertEqual(parse_url('http://münchen.de/'), 'http://xn--mnchen-3ya.de/')
+        self.assertEqual(parse_url('http://localhost:8888/a'), 'http://localhost:8888/a')
+        self.assertEqual(parse_url('ftp://127.0.0.1/a'), 'ftp://127.0.0.1/a')
+        # Non-ASCII letters matching ASCII ones ignoring case are IDNA encoded.
+        self.assertEqual(parse_url('http://\u017fhop.com/'), 'http://shop.com/')
+
+    def test_invalid_urls(self):
+        for url in ('', None, 'invalid', 'www.familo.net', 'http:/www.familo.net', 'http://familo',
+                    'http://-familo.net', 'http://familo-.net', 'http://familo..net', 'http://familo.n',
+                    'http://user@familo.net', 'http://familo.net:0', 'http://familo.net:123456',
+                    'http://1.2.3/', 'familonet://', 'http://example.com:\uff18\uff10/'):
+            with self.assertRaises(ValueError, msg=url):
+                parse_url(url)
+
+    def test_app_urls(self):
+        self.assertEqual(parse_url('familonet://', app=True), 'familonet://')
+        self.assertEqual(parse_url('intent://scan/#Intent;scheme=zxing;end', app=True),
+                         'intent://scan/#Intent;scheme=zxing;end')
+        self.assertEqual(parse_url('http://www.familo.net', app=True), 'http://www.familo.net')
+        for url in ('javascript:alert(1)', 'JavaScript:alert(1)', 'data:text/html,x', '1app://'):
+            with self.assertRaises(ValueError, msg=url):
+                parse_url(url, app=True)
+
+    def test_linear_time(self):
+        # Crafted hosts are rejected without catastrophic backtracking.
+        with self.assertRaises(ValueError):
+            parse_url('http://' + ('a' * 30 + '.') * 10000 + 'a' * 100 + '!')
+
+    def test_validate_url(self):
+        self.assertTrue(validate_url('http://localhost:8888'))
+        self.assertTrue(validate_url('http://short.familo.net'))
+        self.assertFalse(validate_url('http://short.familo.net/a b'))
+        self.assertFalse(validate_url('familonet://'))
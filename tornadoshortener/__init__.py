@@ -0,0 +1,5 @@
+import time
+
+# Time the package was first imported, right after the process started, to
+# measure the startup time.
+START_TIME = time.monotonic()
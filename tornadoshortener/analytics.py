@@ -0,0 +1,158 @@
+import logging
+import time
+
+import tornado.ioloop
+
+from . import utils
+
+
+class ClickCounter(object):
+    """
+    Counts clicks per link, day and device class. Clicks are aggregated in
+    process memory and flushed periodically, or once half of max_keys distinct
+    counters are buffered, with one HINCRBY per counter in a single redis
+    pipeline.
+    Clicks of a link are stored in the redis hash STATS:<hash> with one field
+    <day>:<device> per counter, day being the UTC date like 2020-07-01.
+    If hot_links is set the links are ranked by clicks per day as well, in the
+    sorted set HOT:<day> trimmed to the ten times as many most clicked links
+    and kept for two days, to preload the hottest links at startup.
+
+    At most flush_interval seconds of clicks are lost if the process crashes.
+    While redis is unavailable clicks are kept up to max_keys counters and
+    dropped beyond that.
+    """
+
+    def __init__(self, redis_connection, redis_namespace='SHORT:', ttl=0, flush_interval=5, max_keys=10000,
+                 metrics=None, hot_links=0):
+        self.redis = redis_connection
+        self.redis_namespace = redis_namespace
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.max_keys = max(max_keys, 1)
+        self.metrics = metrics
+        self.hot_links = hot_links
+        self.dropped = 0
+        self._counts = {}
+        self._day = None
+        self._day_str = None
+        self._flushing = False
+        self._scheduled = False
+        self._periodic = None
+
+    def __len__(self):
+        return len(self._counts)
+
+    def record(self, url_hash, device):
+        """
+        Counts a click on the given link. Never touches redis itself.
+        """
+        day = int(time.time() / 86400)
+        if day != self._day:
+            self._day, self._day_str = day, time.strftime('%Y-%m-%d', time.gmtime(day * 86400))
+        key = (url_hash, self._day_str, device)
+        count = self._counts.get(key)
+        if count is not None:
+            self._counts[key] = count + 1
+            return
+        if len(self._counts) >= self.max_keys:
+            self.dropped += 1
+            return
+        self._counts[key] = 1
+        if len(self._counts) >= self.max_keys // 2 and not self._scheduled:
+            self._scheduled = True
+            tornado.ioloop.IOLoop.current().add_callback(self.flush)
+
+    async def flush(self):
+        """
+        Writes all buffered counters to redis in a single pipeline. Counters
+        are put back into the buffer if redis fails.
+        """
+        if self._flushing or not self._counts:
+            return
+        self._flushing = True
+        self._scheduled = False
+        counts, self._counts = self._counts, {}
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            keys = set()
+            for (url_hash, day, device), count in counts.items():
+                key = self.redis_namespace + 'STATS:' + url_hash
+                pipe.hincrby(key, day + ':' + device, count)
+                keys.add(key)
+            if self.ttl:
+                for key in keys:
+                    pipe.expire(key, self.ttl * 24 * 60 * 60)
+            if self.hot_links:
+                self._rank(pipe, counts)
+            if self.metrics:
+                await self.metrics.execute(pipe, 'flush_clicks')
+            else:
+                await utils.maybe_await(pipe.execute())
+        except Exception:
+            logging.warning('Could not flush {} click counters'.format(len(counts)), exc_info=1)
+            for key, count in counts.items():
+                if key in self._counts or len(self._counts) < self.max_keys:
+                    self._counts[key] = self._counts.get(key, 0) + count
+                else:
+                    self.dropped += count
+        finally:
+            self._flushing = False
+
+    def _rank(self, pipe, counts):
+        clicks = {}
+        for (url_hash, day, device), count in counts.items():
+            key = (self.redis_namespace + 'HOT:' + day, url_hash)
+            clicks[key] = clicks.get(key, 0) + count
+        for (key, url_hash), count in clicks.items():
+            pipe.zincrby(key, count, url_hash)
+        for key in {key for key, url_hash in clicks}:
+            pipe.zremrangebyrank(key, 0, -self.hot_links * 10 - 1)
+            pipe.expire(key, 2 * 24 * 60 * 60)
+
+    async def hot(self, count):
+        """
+        Loads the most clicked links of today and yesterday, see hot_links.
+
+        @returns: Returns a list of up to count link hashes, most clicked first.
+        """
+        day = int(time.time() / 86400)
+        pipe = self.redis.pipeline(transaction=False)
+        for past in (day, day - 1):
+            pipe.zrevrange(self.redis_namespace + 'HOT:' + time.strftime('%Y-%m-%d', time.gmtime(past * 86400)),
+                           0, count - 1, withscores=True)
+        clicks = {}
+        for entries in await utils.maybe_await(pipe.execute()):
+            for url_hash, score in entries:
+                clicks[url_hash] = clicks.get(url_hash, 0) + score
+        return sorted(clicks, key=clicks.get, reverse=True)[:count]
+
+    async def load(self, url_hash):
+        """
+        Loads the flushed counters of a link.
+
+        @returns: Returns a dict {day: {device: clicks}}.
+        """
+        fields = await utils.maybe_await(self.redis.hgetall(self.redis_namespace + 'STATS:' + url_hash))
+        days = {}
+        for field, count in fields.items():
+            day, device = field.split(':', 1)
+            days.setdefault(day, {})[device] = int(count)
+        return days
+
+    def start(self):
+        """
+        Starts flushing periodically.
+        """
+        if not self._periodic:
+            self._periodic = tornado.ioloop.PeriodicCallback(self.flush, self.flush_interval * 1000)
+            self._periodic.start()
+
+    async def stop(self):
+        """
+        Stops flushing periodically and flushes the remaining counters.
+        """
+        if self._periodic:
+            self._periodic.stop()
+            self._periodic = None
+        await self.flush()
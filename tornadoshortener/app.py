@@ -1,12 +1,35 @@
+import glob
 import logging
 import os
+import signal
+import sys
+import time
 
 import redis
+import redis.asyncio
 import tornado
+import tornado.gen
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.options
+import tornado.template
 
-from .handler import IndexHandler, RedirectHandler, ExpandHandler, ShortHandler
+from . import START_TIME
+from . import utils
+from .analytics import ClickCounter
+from .breaker import CircuitBreaker
+from .cache import LinkCache, SingleFlight
+from .device import DeviceClassifier
+from .handler import (IndexHandler, RedirectHandler, ExpandHandler, ShortHandler, BatchShortHandler, MetricsHandler,
+                      ProfileHandler, StatsHandler, HealthHandler, ReadyHandler)
+from .memory import MemoryRedis
+from .metrics import Metrics
+from .storage import GuardedStorage, LocalStore, RedisStorage, ShardedStorage, TieredStorage, parse_node
+from .process import fork_workers
+from .profiling import SamplingProfiler
+from .ratelimit import RateLimiter
+from .utils import HashGenerator
 
 # Define command line parameters.
 tornado.options.define('port', type=int, default=int(os.environ.get('PORT', 8888)), help='Listen on this port')
@@ -14,8 +37,18 @@ tornado.options.define('domain', type=str, default=str(os.environ.get('DOMAIN',
                        help='The default domain for shortening URLs')
 tornado.options.define('localhostonly', type=bool, default=bool(os.environ.get('LOCALHOSTONLY', False)),
                        help='Listen on localhost only')
+tornado.options.define('processes', type=int, default=int(os.environ.get('PROCESSES', 1)),
+                       help='The number of worker processes to fork, 0 means one per CPU')
+tornado.options.define('reuse_port', type=bool, default=bool(int(os.environ.get('REUSE_PORT', 0))),
+                       help='Let every worker bind the port with SO_REUSEPORT instead of sharing one socket')
+tornado.options.define('shutdown_timeout', type=float, default=float(os.environ.get('SHUTDOWN_TIMEOUT', 10)),
+                       help='The time in seconds to wait for in-flight requests on shutdown')
 tornado.options.define('salt', type=str, default=str(os.environ.get('SALT', '')),
                        help='A string influencing the generated hashes')
+tornado.options.define('storage', type=str, default=str(os.environ.get('STORAGE', 'redis')),
+                       help='Where to store links, redis or memory for an in-process store without persistence')
+tornado.options.define('memory_latency', type=float, default=float(os.environ.get('MEMORY_LATENCY', 0)),
+                       help='The time in seconds every call to the memory storage takes, e.g. to simulate redis')
 tornado.options.define('redis_host', type=str, default=str(os.environ.get('REDIS_HOST', 'localhost')),
                        help='The redis host')
 tornado.options.define('redis_port', type=int, default=int(os.environ.get('REDIS_PORT', 6379)), help='The redis port')
@@ -24,6 +57,83 @@ tornado.options.define('redis_namespace', type=str, default=str(os.environ.get('
                        help='The redis namespace used for all keys')
 tornado.options.define('redis_password', type=str, default=str(os.environ.get('REDIS_PASSWORD', '')),
                        help='The redis password')
+tornado.options.define('redis_nodes', type=str, default=str(os.environ.get('REDIS_NODES', '')),
+                       help='Comma separated redis nodes host:port/db to shard links across')
+tornado.options.define('redis_cluster', type=bool, default=bool(int(os.environ.get('REDIS_CLUSTER', 0))),
+                       help='Connect to a Redis Cluster with redis_host and redis_port as startup node')
+tornado.options.define('redis_async', type=bool, default=bool(int(os.environ.get('REDIS_ASYNC', 1))),
+                       help='Use the asyncio redis client, otherwise fall back to the blocking client')
+tornado.options.define('redis_pool_size', type=int, default=int(os.environ.get('REDIS_POOL_SIZE', 10)),
+                       help='The maximum number of pooled redis connections per process')
+tornado.options.define('redis_timeout', type=float, default=float(os.environ.get('REDIS_TIMEOUT', 2)),
+                       help='The time in seconds a link lookup, store or socket call may take, 0 means no timeout')
+tornado.options.define('breaker_failures', type=int, default=int(os.environ.get('BREAKER_FAILURES', 5)),
+                       help='The number of failed redis calls in a row stopping calls for breaker_reset seconds, '
+                            '0 disables the circuit breaker')
+tornado.options.define('breaker_reset', type=float, default=float(os.environ.get('BREAKER_RESET', 5)),
+                       help='The time in seconds redis is not called after the circuit breaker opened')
+tornado.options.define('cache_size', type=int, default=int(os.environ.get('CACHE_SIZE', 10000)),
+                       help='The maximum number of links cached in process memory, 0 disables the cache')
+tornado.options.define('cache_bytes', type=int, default=int(os.environ.get('CACHE_BYTES', 0)),
+                       help='The maximum approximate size of the link cache in bytes, 0 means no limit')
+tornado.options.define('cache_ttl', type=int, default=int(os.environ.get('CACHE_TTL', 60)),
+                       help='The maximum time in seconds a link is cached')
+tornado.options.define('cache_negative_ttl', type=int, default=int(os.environ.get('CACHE_NEGATIVE_TTL', 5)),
+                       help='The time in seconds an unknown hash is cached')
+tornado.options.define('cache_stale_ttl', type=int, default=int(os.environ.get('CACHE_STALE_TTL', 3600)),
+                       help='The time in seconds expired links are kept to be served while redis is unavailable')
+tornado.options.define('page_cache_size', type=int, default=int(os.environ.get('PAGE_CACHE_SIZE', 1000)),
+                       help='The maximum number of rendered mobile redirect pages cached, 0 disables the cache')
+tornado.options.define('ua_cache_size', type=int, default=int(os.environ.get('UA_CACHE_SIZE', 10000)),
+                       help='The maximum number of classified User-Agents cached, 0 disables the cache')
+tornado.options.define('redirect_status', type=int, default=int(os.environ.get('REDIRECT_STATUS', 301)),
+                       help='The HTTP status of redirects, e.g. 301 or 302')
+tornado.options.define('redirect_max_age', type=int, default=int(os.environ.get('REDIRECT_MAX_AGE', 0)),
+                       help='The time in seconds browsers and CDNs may cache redirects, 0 means no Cache-Control')
+tornado.options.define('legacy_reads', type=bool, default=bool(int(os.environ.get('LEGACY_READS', 1))),
+                       help='Read and migrate links stored in the legacy layout with one redis key per URL')
+tornado.options.define('hash_block_size', type=int, default=int(os.environ.get('HASH_BLOCK_SIZE', 1000)),
+                       help='The number of hash indices leased from redis at once by each process')
+tornado.options.define('batch_limit', type=int, default=int(os.environ.get('BATCH_LIMIT', 10000)),
+                       help='The maximum number of entries in a single batch request')
+tornado.options.define('metrics_dir', type=str, default=str(os.environ.get('METRICS_DIR', '')),
+                       help='A directory shared by all worker processes to merge their metrics')
+tornado.options.define('slow_request_threshold', type=float,
+                       default=float(os.environ.get('SLOW_REQUEST_THRESHOLD', 0)),
+                       help='Log requests slower than this time in seconds with the time per phase, 0 disables it')
+tornado.options.define('admin_token', type=str, default=str(os.environ.get('ADMIN_TOKEN', '')),
+                       help='The bearer token of the admin endpoints, empty disables them')
+tornado.options.define('analytics', type=bool, default=bool(int(os.environ.get('ANALYTICS', 1))),
+                       help='Count clicks per link, day and device')
+tornado.options.define('analytics_flush_interval', type=float,
+                       default=float(os.environ.get('ANALYTICS_FLUSH_INTERVAL', 5)),
+                       help='The time in seconds clicks are buffered before written to redis')
+tornado.options.define('analytics_buffer_size', type=int, default=int(os.environ.get('ANALYTICS_BUFFER_SIZE', 10000)),
+                       help='The maximum number of click counters buffered in process memory')
+tornado.options.define('dedup', type=bool, default=bool(int(os.environ.get('DEDUP', 0))),
+                       help='Return the existing hash when identical URLs are shortened again')
+tornado.options.define('changelog_size', type=int, default=int(os.environ.get('CHANGELOG_SIZE', 0)),
+                       help='Record stored links in a redis stream of about this size for local stores, 0 disables it')
+tornado.options.define('local_store', type=str, default=str(os.environ.get('LOCAL_STORE', '')),
+                       help='The path of a local SQLite database serving links in front of redis')
+tornado.options.define('local_sync_interval', type=float, default=float(os.environ.get('LOCAL_SYNC_INTERVAL', 1)),
+                       help='The time in seconds between syncs of the local store with the redis changelog')
+tornado.options.define('rate_limit_shorten', type=float, default=float(os.environ.get('RATE_LIMIT_SHORTEN', 0)),
+                       help='The requests per second each client may send to /shorten, 0 means no limit')
+tornado.options.define('rate_limit_expand', type=float, default=float(os.environ.get('RATE_LIMIT_EXPAND', 0)),
+                       help='The requests per second each client may send to /expand and /stats, 0 means no limit')
+tornado.options.define('rate_limit_redirect', type=float, default=float(os.environ.get('RATE_LIMIT_REDIRECT', 0)),
+                       help='The redirects per second each client may request, 0 means no limit')
+tornado.options.define('rate_limit_burst', type=float, default=float(os.environ.get('RATE_LIMIT_BURST', 10)),
+                       help='The time in seconds of unused requests a client may send at once')
+tornado.options.define('rate_limit_sync_interval', type=float,
+                       default=float(os.environ.get('RATE_LIMIT_SYNC_INTERVAL', 1)),
+                       help='The time in seconds between syncs of the rate limits of all processes through redis')
+tornado.options.define('warm_connections', type=int, default=int(os.environ.get('WARM_CONNECTIONS', 1)),
+                       help='The number of connections opened to every redis before a worker is ready')
+tornado.options.define('preload_links', type=int, default=int(os.environ.get('PRELOAD_LINKS', 0)),
+                       help='Rank links by clicks and load this many of the most clicked links into the link cache '
+                            'before a worker is ready, 0 disables it')
 tornado.options.define('ttl', type=int, default=int(os.environ.get('TTL', 0)),
                        help='The time to live in days of each link, 0 means forever')
 
@@ -41,7 +151,16 @@ class Application(tornado.web.Application):
     """
 
     def __init__(self, default_domain='localhost', hash_salt='', redis_namespace='SHORT:',
-                 redis_host='localhost', redis_port=6379, redis_db=0, redis_password=None, ttl=0):
+                 redis_host='localhost', redis_port=6379, redis_db=0, redis_password=None, ttl=0,
+                 redis_async=True, redis_pool_size=10, cache_size=10000, cache_bytes=0, cache_ttl=60,
+                 cache_negative_ttl=5, legacy_reads=True, hash_block_size=1000,
+                 batch_limit=10000, page_cache_size=1000, ua_cache_size=10000, device_classifier=None,
+                 metrics_dir=None, analytics=True, analytics_flush_interval=5, analytics_buffer_size=10000,
+                 dedup=False, changelog_size=0, local_store=None, local_sync_interval=1, rate_limits=None,
+                 rate_limit_sync_interval=1, redis_nodes=None, redis_cluster=False, redirect_status=301,
+                 redirect_max_age=0, redis_timeout=0, breaker_failures=0, breaker_reset=5, cache_stale_ttl=0,
+                 storage='redis', memory_latency=0, slow_request_threshold=0, admin_token=None,
+                 warm_connections=1, preload_links=0):
         if not redis_password:
             redis_password = None
             using_redis_password = 'NO'
@@ -51,15 +170,40 @@ class Application(tornado.web.Application):
         logging.info(
             'Starting application with the following parameters: default_domain: {},'
             'hash_salt: {}, redis_namespace: {}, redis_host: {}, redis_port: {},'
-            'redis_db: {}, redis_password: {}, ttl: {}'.format(
+            'redis_db: {}, redis_password: {}, ttl: {}, redis_async: {}, redis_pool_size: {},'
+            'cache_size: {}, cache_bytes: {}, cache_ttl: {}, cache_negative_ttl: {}, legacy_reads: {},'
+            'hash_block_size: {}, batch_limit: {}, page_cache_size: {}, ua_cache_size: {},'
+            'metrics_dir: {}, analytics: {}, analytics_flush_interval: {}, analytics_buffer_size: {},'
+            'dedup: {}, changelog_size: {}, local_store: {}, local_sync_interval: {},'
+            'rate_limits: {}, rate_limit_sync_interval: {}, redis_nodes: {}, redis_cluster: {},'
+            'redirect_status: {}, redirect_max_age: {}, redis_timeout: {}, breaker_failures: {},'
+            'breaker_reset: {}, cache_stale_ttl: {}, storage: {}, memory_latency: {},'
+            'slow_request_threshold: {}, admin_token: {}, warm_connections: {}, preload_links: {}'.format(
                 default_domain, hash_salt, redis_namespace, redis_host, redis_port,
-                redis_db, using_redis_password, ttl))
+                redis_db, using_redis_password, ttl, redis_async, redis_pool_size,
+                cache_size, cache_bytes, cache_ttl, cache_negative_ttl, legacy_reads,
+                hash_block_size, batch_limit, page_cache_size, ua_cache_size, metrics_dir,
+                analytics, analytics_flush_interval, analytics_buffer_size, dedup,
+                changelog_size, local_store, local_sync_interval, rate_limits, rate_limit_sync_interval,
+                redis_nodes, redis_cluster, redirect_status, redirect_max_age, redis_timeout, breaker_failures,
+                breaker_reset, cache_stale_ttl, storage, memory_latency, slow_request_threshold,
+                'YES' if admin_token else 'NO', warm_connections, preload_links))
+        start = time.monotonic()
+        if not 300 <= redirect_status <= 399:
+            raise ValueError('redirect_status must be a redirect status from 300 to 399, not {}'.format(
+                redirect_status))
 
         # Define routes.
         handlers = [
             (r'/$', IndexHandler),
+            (r'/metrics$', MetricsHandler),
+            (r'/healthz$', HealthHandler),
+            (r'/readyz$', ReadyHandler),
+            (r'/admin/profile$', ProfileHandler),
             (r'/expand/$', ExpandHandler),
             (r'/expand', ExpandHandler),
+            (r'/stats/?$', StatsHandler),
+            (r'/shorten/batch/?$', BatchShortHandler),
             (r'/shorten/$', ShortHandler),
             (r'/shorten$', ShortHandler),
             (r'/([a-zA-Z0-9]+)/$', RedirectHandler),
@@ -73,22 +217,283 @@ class Application(tornado.web.Application):
             hash_salt=hash_salt,
             redis_namespace=redis_namespace,
             ttl=ttl,
-            template_path=os.path.join(os.path.dirname(__file__), 'templates'),
+            legacy_reads=legacy_reads,
+            batch_limit=batch_limit,
+            dedup=dedup,
+            redirect_status=redirect_status,
+            redirect_max_age=redirect_max_age,
+            slow_request_threshold=slow_request_threshold,
+            admin_token=admin_token,
+            # Templates are compiled on first use or by warm_up.
+            template_loader=tornado.template.Loader(os.path.join(os.path.dirname(__file__), 'templates')),
         )
 
         # Call super constructor to initiate a Tornado Application.
         tornado.web.Application.__init__(self, handlers, **settings)
 
-        # Connect to Redis.
-        self.redis = redis.StrictRedis(
-            host=redis_host, port=redis_port, db=redis_db, password=redis_password, decode_responses=True)
+        # Connect to Redis. Connections are pooled and created lazily, requests
+        # wait for a free connection once the pool is exhausted. Hash indices,
+        # clicks and rate limits are kept in this Redis even if links are sharded.
+        # All clients by name, opened by warm_up. Sockets time out after
+        # redis_timeout seconds, so calls bypassing the circuit breaker like
+        # hash index leases and click counter flushes never hang.
+        self.connections = {}
+        socket_timeout = redis_timeout or None
+        if storage == 'memory':
+            if redis_nodes or redis_cluster:
+                raise ValueError('The memory storage cannot be sharded')
+            self.redis = MemoryRedis(memory_latency)
+        elif storage != 'redis':
+            raise ValueError('Unknown storage {}'.format(storage))
+        elif redis_cluster:
+            cluster = redis.asyncio.RedisCluster if redis_async else redis.RedisCluster
+            self.redis = cluster(host=redis_host, port=redis_port, password=redis_password,
+                                 max_connections=redis_pool_size, decode_responses=True,
+                                 socket_timeout=socket_timeout, socket_connect_timeout=socket_timeout)
+        else:
+            self.redis = connect_redis(redis_host, redis_port, redis_db, redis_password, redis_async, redis_pool_size,
+                                       socket_timeout)
+        self.connections['{}:{}/{}'.format(redis_host, redis_port, redis_db)] = self.redis
+
+        # Metrics of this process, merged with other processes through metrics_dir.
+        self.metrics = Metrics(metrics_dir)
+        self.metrics.add_collector(self.collect_metrics)
+
+        # Storage of links, sharded across redis_nodes if given and optionally
+        # served from a local store in front of Redis. Every Redis is guarded
+        # by its own circuit breaker.
+        self.breakers = []
+
+        def guard(storage, name):
+            if not redis_timeout and not breaker_failures:
+                return storage
+            self.breakers.append(CircuitBreaker(name, breaker_failures, breaker_reset, redis_timeout))
+            return GuardedStorage(storage, self.breakers[-1])
+
+        if redis_nodes:
+            nodes = {}
+            for node in redis_nodes:
+                host, port, db = parse_node(node)
+                name = '{}:{}/{}'.format(host, port, db)
+                connection = connect_redis(host, port, db, redis_password, redis_async, redis_pool_size,
+                                           socket_timeout)
+                self.connections.setdefault(name, connection)
+                nodes[name] = guard(RedisStorage(connection, redis_namespace, ttl, legacy_reads, changelog_size,
+                                                 self.metrics), name)
+            self.storage = ShardedStorage(nodes)
+        else:
+            self.storage = guard(RedisStorage(self.redis, redis_namespace, ttl, legacy_reads, changelog_size,
+                                              self.metrics, transaction=not redis_cluster),
+                                 '{}:{}/{}'.format(redis_host, redis_port, redis_db))
+        if local_store:
+            self.storage = TieredStorage(self.storage, LocalStore(local_store), local_sync_interval, self.metrics)
+
+        # Hash generator leasing blocks of hash indices from Redis.
+        self.hash_generator = HashGenerator(self.redis, redis_namespace, hash_salt, hash_block_size, self.metrics)
+
+        # In-process cache for hot links.
+        self.link_cache = LinkCache(cache_size, cache_bytes, cache_ttl, cache_negative_ttl, cache_stale_ttl)
+
+        # Coalesces concurrent lookups of the same link.
+        self.single_flight = SingleFlight()
+
+        # Cache for rendered mobile redirect pages and redirect headers, keyed
+        # by template and URLs so entries never get stale.
+        self.page_cache = LinkCache(page_cache_size, ttl=24 * 60 * 60)
+
+        # Classifies requests by User-Agent to choose the redirect.
+        self.device_classifier = device_classifier
+        if device_classifier is None:
+            self.device_classifier = DeviceClassifier(max_entries=ua_cache_size)
+
+        # Buffered click counters, None if analytics are disabled.
+        self.click_counter = None
+        if analytics:
+            self.click_counter = ClickCounter(self.redis, redis_namespace, ttl, analytics_flush_interval,
+                                              analytics_buffer_size, self.metrics, preload_links)
+
+        # Token buckets per client and route, None if no route is limited.
+        self.rate_limiter = None
+        if rate_limits and any(rate for rate, burst in rate_limits.values()):
+            self.rate_limiter = RateLimiter(self.redis, rate_limits, redis_namespace, rate_limit_sync_interval,
+                                            metrics=self.metrics)
+
+        # Samples the stacks of this process on request of an admin.
+        self.profiler = SamplingProfiler()
+
+        # Number of requests currently handled, used for graceful shutdown.
+        self.active_requests = 0
+
+        # Work deferred from startup to warm_up, which makes the application ready.
+        self.warm_connections = warm_connections
+        self.preload_links = preload_links
+        self.ready = False
+
+        # Time in seconds per startup phase.
+        self.startup = {'init': time.monotonic() - start}
+
+    async def warm_up(self):
+        """
+        Does the work deferred from startup before the application is ready:
+        opens warm_connections connections to every redis, retrying until all
+        of them answer, compiles the templates and loads the preload_links most
+        clicked links into the link cache.
+        """
+        start = time.monotonic()
+        for name, connection in self.connections.items():
+            while True:
+                try:
+                    await tornado.gen.multi([utils.maybe_await(connection.ping())
+                                             for i in range(max(self.warm_connections, 1))])
+                    break
+                except Exception:
+                    logging.warning('Redis {} is not available, retrying'.format(name), exc_info=1)
+                    await tornado.gen.sleep(1)
+        loader = self.settings['template_loader']
+        for template_name in os.listdir(loader.root):
+            loader.load(template_name)
+        preloaded = 0
+        if self.preload_links and self.click_counter is not None:
+            try:
+                preloaded = await self.preload(self.preload_links)
+            except Exception:
+                logging.warning('Could not preload links', exc_info=1)
+        self.ready = True
+        self.startup['warm_up'] = time.monotonic() - start
+        self.startup['total'] = time.monotonic() - START_TIME
+        logging.info('Ready after {:.3f}s, init {:.3f}s, warm-up {:.3f}s, {} links preloaded'.format(
+            self.startup['total'], self.startup['init'], self.startup['warm_up'], preloaded))
+
+    async def preload(self, count, batch=1000):
+        """
+        Loads the given number of the most clicked links into the link cache.
+
+        @returns: Returns the number of links loaded.
+        """
+        url_hashes = await self.click_counter.hot(count)
+        loaded = 0
+        for i in range(0, len(url_hashes), batch):
+            chunk = url_hashes[i:i + batch]
+            for url_hash, (urls, expires_in) in zip(chunk, await self.storage.load_many(chunk, True)):
+                if urls[0]:
+                    self.link_cache.set(url_hash, urls, expires_in)
+                    loaded += 1
+        return loaded
+
+    def collect_metrics(self, metrics):
+        """
+        Copies the statistics of the caches into the metrics.
+        """
+        for name, cache in (('link', self.link_cache), ('page', self.page_cache),
+                            ('user_agent', self.device_classifier)):
+            labels = (('cache', name),)
+            metrics.counters[('cache_hits_total', labels)] = cache.hits
+            metrics.counters[('cache_misses_total', labels)] = cache.misses
+            metrics.set('cache_entries', len(cache), labels)
+        for name, cache in (('link', self.link_cache), ('page', self.page_cache)):
+            metrics.counters[('cache_evictions_total', (('cache', name),))] = cache.evictions
+        metrics.set('active_requests', self.active_requests)
+        if self.click_counter is not None:
+            metrics.set('clicks_buffered', len(self.click_counter))
+            metrics.counters[('clicks_dropped_total', ())] = self.click_counter.dropped
+        metrics.counters[('coalesced_lookups_total', ())] = self.single_flight.coalesced
+        for breaker in self.breakers:
+            labels = (('redis', breaker.name),)
+            metrics.set('circuit_breaker_open', int(breaker.is_open), labels)
+            metrics.counters[('circuit_breaker_rejected_total', labels)] = breaker.rejected
+            metrics.counters[('redis_timeouts_total', labels)] = breaker.timeouts
+        if self.rate_limiter is not None:
+            metrics.set('rate_limit_buckets', len(self.rate_limiter))
+            metrics.counters[('rate_limited_total', ())] = self.rate_limiter.rejected
+        metrics.set('ready', int(self.ready))
+        for phase, seconds in self.startup.items():
+            metrics.set('startup_seconds', seconds, (('phase', phase),))
+
+
+def connect_redis(host, port, db, password=None, redis_async=True, pool_size=10, timeout=None):
+    """
+    Returns a redis client with a blocking connection pool of the given size.
+    Connecting and every read or write on a socket may take at most timeout
+    seconds if given.
+    """
+    if redis_async:
+        pool = redis.asyncio.BlockingConnectionPool(max_connections=pool_size, host=host, port=port, db=db,
+                                                    password=password, decode_responses=True,
+                                                    socket_timeout=timeout, socket_connect_timeout=timeout)
+        return redis.asyncio.StrictRedis(connection_pool=pool)
+    pool = redis.BlockingConnectionPool(max_connections=pool_size, host=host, port=port, db=db,
+                                        password=password, decode_responses=True,
+                                        socket_timeout=timeout, socket_connect_timeout=timeout)
+    return redis.StrictRedis(connection_pool=pool)
+
+
+async def shutdown(server, application, timeout=10):
+    """
+    Shuts down the server gracefully: stops accepting connections, waits up
+    to timeout seconds for in-flight requests to finish, releases the hash
+    index lease and flushes buffered clicks before stopping the IOLoop.
+    """
+    logging.info('Shutting down, waiting for {} in-flight requests'.format(application.active_requests))
+    # Load balancers stop routing to this process.
+    application.ready = False
+    server.stop()
+    deadline = time.time() + timeout
+    while application.active_requests and time.time() < deadline:
+        await tornado.gen.sleep(0.05)
+    if application.active_requests:
+        logging.warning('Shutdown timeout, aborting {} requests'.format(application.active_requests))
+    try:
+        await application.hash_generator.release()
+    except Exception:
+        logging.warning('Could not release hash index lease', exc_info=1)
+    if application.click_counter is not None:
+        await application.click_counter.stop()
+    if application.rate_limiter is not None:
+        application.rate_limiter.stop()
+    application.storage.stop()
+    application.metrics.stop()
+    tornado.ioloop.IOLoop.current().stop()
 
 
 def main():
     """
     Main function to start the webserver application and listen on the specified port.
+    With more than one process the workers are forked after binding the port,
+    each worker creates its own application and redis connections.
     """
     tornado.options.parse_command_line()
+    if tornado.options.options.localhostonly:
+        address = '127.0.0.1'
+        logging.info('Listening to localhost only')
+    else:
+        address = ''
+        logging.info('Listening to all addresses on all interfaces')
+
+    # Bind the port before forking unless every worker binds it with SO_REUSEPORT.
+    processes = tornado.options.options.processes
+    if tornado.options.options.storage == 'memory' and processes != 1:
+        logging.error('The memory storage is not shared between processes, use --processes=1')
+        sys.exit(1)
+    reuse_port = tornado.options.options.reuse_port
+    sockets = None
+    if not reuse_port:
+        sockets = tornado.netutil.bind_sockets(tornado.options.options.port, address=address)
+    if tornado.options.options.metrics_dir:
+        # Start with fresh metrics, the files of the last run are left over.
+        for filename in glob.glob(os.path.join(tornado.options.options.metrics_dir, 'metrics.*.json')):
+            os.remove(filename)
+    if processes != 1:
+        fork_workers(processes)
+    if reuse_port:
+        sockets = tornado.netutil.bind_sockets(tornado.options.options.port, address=address, reuse_port=True)
+
+    # Buckets hold rate_limit_burst seconds of requests.
+    burst = tornado.options.options.rate_limit_burst
+    rate_limits = {route: (rate, max(rate * burst, 1)) for route, rate in (
+        ('shorten', tornado.options.options.rate_limit_shorten),
+        ('expand', tornado.options.options.rate_limit_expand),
+        ('redirect', tornado.options.options.rate_limit_redirect))}
+
     application = Application(tornado.options.options.domain,
                               tornado.options.options.salt,
                               tornado.options.options.redis_namespace,
@@ -96,15 +501,64 @@ def main():
                               int(tornado.options.options.redis_port),
                               tornado.options.options.redis_db,
                               tornado.options.options.redis_password,
-                              int(tornado.options.options.ttl))
-    if tornado.options.options.localhostonly:
-        address = '127.0.0.1'
-        logging.info('Listening to localhost only')
-    else:
-        address = ''
-        logging.info('Listening to all addresses on all interfaces')
-    application.listen(tornado.options.options.port, address=address, xheaders=True)
-    tornado.ioloop.IOLoop.instance().start()
+                              int(tornado.options.options.ttl),
+                              redis_async=tornado.options.options.redis_async,
+                              redis_pool_size=int(tornado.options.options.redis_pool_size),
+                              cache_size=int(tornado.options.options.cache_size),
+                              cache_bytes=int(tornado.options.options.cache_bytes),
+                              cache_ttl=int(tornado.options.options.cache_ttl),
+                              cache_negative_ttl=int(tornado.options.options.cache_negative_ttl),
+                              legacy_reads=tornado.options.options.legacy_reads,
+                              hash_block_size=int(tornado.options.options.hash_block_size),
+                              batch_limit=int(tornado.options.options.batch_limit),
+                              page_cache_size=int(tornado.options.options.page_cache_size),
+                              ua_cache_size=int(tornado.options.options.ua_cache_size),
+                              metrics_dir=tornado.options.options.metrics_dir or None,
+                              analytics=tornado.options.options.analytics,
+                              analytics_flush_interval=tornado.options.options.analytics_flush_interval,
+                              analytics_buffer_size=int(tornado.options.options.analytics_buffer_size),
+                              dedup=tornado.options.options.dedup,
+                              changelog_size=int(tornado.options.options.changelog_size),
+                              local_store=tornado.options.options.local_store or None,
+                              local_sync_interval=tornado.options.options.local_sync_interval,
+                              rate_limits=rate_limits,
+                              rate_limit_sync_interval=tornado.options.options.rate_limit_sync_interval,
+                              redis_nodes=[node for node in tornado.options.options.redis_nodes.split(',') if node],
+                              redis_cluster=tornado.options.options.redis_cluster,
+                              redirect_status=tornado.options.options.redirect_status,
+                              redirect_max_age=tornado.options.options.redirect_max_age,
+                              redis_timeout=tornado.options.options.redis_timeout,
+                              breaker_failures=int(tornado.options.options.breaker_failures),
+                              breaker_reset=tornado.options.options.breaker_reset,
+                              cache_stale_ttl=int(tornado.options.options.cache_stale_ttl),
+                              storage=tornado.options.options.storage,
+                              memory_latency=tornado.options.options.memory_latency,
+                              slow_request_threshold=tornado.options.options.slow_request_threshold,
+                              admin_token=tornado.options.options.admin_token or None,
+                              warm_connections=int(tornado.options.options.warm_connections),
+                              preload_links=int(tornado.options.options.preload_links))
+    application.metrics.start()
+    application.storage.start()
+    if application.click_counter is not None:
+        application.click_counter.start()
+    if application.rate_limiter is not None:
+        application.rate_limiter.start()
+    server = tornado.httpserver.HTTPServer(application, xheaders=True)
+    server.add_sockets(sockets)
+
+    # Serve /healthz right away and /readyz once warmed up.
+    tornado.ioloop.IOLoop.current().spawn_callback(application.warm_up)
+
+    # Shut down gracefully on SIGTERM and SIGINT.
+    io_loop = tornado.ioloop.IOLoop.current()
+
+    def handle_signal(signum, frame):
+        signal.signal(signum, signal.SIG_DFL)
+        io_loop.add_callback_from_signal(shutdown, server, application, tornado.options.options.shutdown_timeout)
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    io_loop.start()
 
 
 # Run main method if script is run from command line.
@@ -0,0 +1,340 @@
+import json
+import logging
+import os
+import random
+import re
+import time
+
+import tornado.gen
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.options
+import tornado.testing
+
+from . import app
+from . import utils
+
+# User-Agents used for redirects per device class.
+USER_AGENTS = {
+    'desktop': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+               'Chrome/83.0.4103.116 Safari/537.36',
+    'android': 'Mozilla/5.0 (Linux; Android 10; SM-G973F) AppleWebKit/537.36 (KHTML, like Gecko) '
+               'Chrome/83.0.4103.106 Mobile Safari/537.36',
+    'ios': 'Mozilla/5.0 (iPhone; CPU iPhone OS 13_5 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+           'Version/13.1.1 Mobile/15E148 Safari/604.1',
+}
+
+# Define command line parameters in addition to the ones of the application.
+tornado.options.define('bench_suite', type=str, default='http',
+                       help='The benchmark to run: http for requests or urls for URL parsing')
+tornado.options.define('bench_requests', type=int, default=10000, help='The number of requests to send')
+tornado.options.define('bench_concurrency', type=int, default=50, help='The number of concurrent requests')
+tornado.options.define('bench_links', type=int, default=1000, help='The number of links created for redirects')
+tornado.options.define('bench_mix', type=str, default='redirect=90,expand=5,shorten=5',
+                       help='The weights of the request types redirect, expand and shorten')
+tornado.options.define('bench_devices', type=str, default='desktop=60,android=25,ios=15',
+                       help='The weights of the device classes for redirects')
+tornado.options.define('bench_skew', type=float, default=2.0,
+                       help='The hot key skew of redirects, 1 means uniform, larger values hit fewer links')
+tornado.options.define('bench_url', type=str, default='',
+                       help='Benchmark the server at this URL instead of an in-process application')
+tornado.options.define('bench_output', type=str, default='', help='Save the results as JSON to this file')
+tornado.options.define('bench_compare', type=str, default='', help='Compare the results to this JSON file')
+
+# The regular expression validating URLs before utils.parse_url, compared
+# against in the URL parsing benchmark.
+LEGACY_URL_REGEX = re.compile(
+    r'^(?:http|ftp)s?://'  # http:// or https://
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+'
+    r'(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'  # domain...
+    r'localhost|'  # localhost...
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
+    r'(?::\d+)?'  # optional port
+    r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+
+# URLs parsed in the URL parsing benchmark.
+BENCH_URLS = {
+    'short': 'http://www.familo.net/',
+    'query': 'http://www.familo.net/en/?ref=http%3A%2F%2Ffamilo.net%2F&utm_source=newsletter&utm_medium=email',
+    'unicode': 'http://de.wikipedia.org/wiki/Elf (Begriffsklärung)',
+    'long': 'https://www.example.com/' + 'a/' * 1000,
+    'crafted': 'http://' + ('a' * 30 + '.') * 1000 + 'a' * 100 + '!',
+}
+
+
+def parse_legacy_url(url):
+    url = utils.normalize_url(url)
+    assert LEGACY_URL_REGEX.match(url)
+    return url
+
+
+def parse_url(url):
+    return utils.parse_url(url)
+
+
+def benchmark_urls(calls=10000, seconds=1):
+    """
+    Compares the time per URL of utils.parse_url to normalizing and validating
+    with the legacy regular expression. Each URL is parsed up to the given
+    number of calls or for the given time in seconds. Every call is timed on
+    its own, so the percentiles include the overhead of reading the clock.
+    """
+    results = {'latency': {}}
+    for name, url in BENCH_URLS.items():
+        for function in (parse_legacy_url, parse_url):
+            latencies = []
+            end = time.perf_counter() + seconds
+            while len(latencies) < calls and (not latencies or time.perf_counter() < end):
+                start = time.perf_counter()
+                try:
+                    function(url)
+                except (AssertionError, ValueError):
+                    pass
+                latencies.append(time.perf_counter() - start)
+            latencies.sort()
+            results['latency'][name + ':' + function.__name__] = {
+                'count': len(latencies),
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+            }
+    return results
+
+
+def parse_weights(value):
+    """
+    Parses weights given as comma separated name=weight pairs.
+    """
+    weights = {}
+    for pair in value.split(','):
+        name, weight = pair.split('=')
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def percentile(latencies, p):
+    """
+    Returns the given percentile of a sorted list of latencies.
+    """
+    if not latencies:
+        return None
+    return latencies[min(int(len(latencies) * p / 100.0), len(latencies) - 1)]
+
+
+class Benchmark(object):
+    """
+    Drives a mix of shorten, expand and redirect requests against a server at
+    the given concurrency and collects latencies per request type.
+    """
+
+    def __init__(self, base_url, requests=10000, concurrency=50, links=1000, mix=None, devices=None, skew=2.0,
+                 redis=None):
+        self.base_url = base_url.rstrip('/')
+        self.requests = requests
+        self.concurrency = concurrency
+        self.links = links
+        self.mix = mix or parse_weights('redirect=90,expand=5,shorten=5')
+        self.devices = devices or parse_weights('desktop=60,android=25,ios=15')
+        self.skew = skew
+        self.redis = redis
+        self.hashes = []
+        self.latencies = {}
+        self.errors = 0
+        self.client = tornado.httpclient.AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+
+    async def setup(self):
+        """
+        Creates the links used for redirects and expands in batches.
+        """
+        for start in range(0, self.links, 1000):
+            entries = [{'longUrl': 'http://www.example.com/bench/{}'.format(i),
+                        'androidUrl': 'example://bench/{}'.format(i),
+                        'iosUrl': 'example://bench/{}'.format(i),
+                        'iosFallbackUrl': 'https://itunes.apple.com/app/id{}'.format(i)}
+                       for i in range(start, min(start + 1000, self.links))]
+            response = await self.client.fetch(self.base_url + '/shorten/batch', method='POST',
+                                               body='\n'.join(json.dumps(entry) for entry in entries))
+            self.hashes.extend(result['hash'] for result in json.loads(response.body)['data']['shorten'])
+
+    def pick_hash(self):
+        # Lower indices are hit more often the larger the skew.
+        return self.hashes[int(len(self.hashes) * random.random() ** self.skew)]
+
+    def next_request(self):
+        """
+        Returns the name and request of a random request of the configured mix.
+        """
+        kind = random.choices(list(self.mix), list(self.mix.values()))[0]
+        if kind == 'redirect':
+            device = random.choices(list(self.devices), list(self.devices.values()))[0]
+            return kind + ':' + device, tornado.httpclient.HTTPRequest(
+                self.base_url + '/' + self.pick_hash(), user_agent=USER_AGENTS[device], follow_redirects=False)
+        elif kind == 'expand':
+            return kind, tornado.httpclient.HTTPRequest(self.base_url + '/expand?hash=' + self.pick_hash())
+        return kind, tornado.httpclient.HTTPRequest(
+            self.base_url + '/shorten?longUrl=http%3A%2F%2Fwww.example.com%2F' + str(random.randrange(10 ** 9)))
+
+    async def worker(self, remaining):
+        while remaining:
+            remaining.pop()
+            name, request = self.next_request()
+            start = time.perf_counter()
+            response = await self.client.fetch(request, raise_error=False)
+            self.latencies.setdefault(name, []).append(time.perf_counter() - start)
+            if response.code >= 400 and response.code != 404:
+                self.errors += 1
+
+    async def redis_commands(self):
+        if self.redis is None:
+            return None
+        try:
+            info = await self.redis.info('stats')
+        except Exception:
+            logging.warning('Could not read redis stats', exc_info=1)
+            return None
+        return info['total_commands_processed']
+
+    async def run(self):
+        """
+        Runs the benchmark and returns the results as a dict.
+        """
+        await self.setup()
+        commands_before = await self.redis_commands()
+        remaining = list(range(self.requests))
+        start = time.perf_counter()
+        await tornado.gen.multi([self.worker(remaining) for i in range(self.concurrency)])
+        duration = time.perf_counter() - start
+        commands_after = await self.redis_commands()
+
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        results = {
+            'requests': total,
+            'errors': self.errors,
+            'concurrency': self.concurrency,
+            'duration': duration,
+            'requests_per_second': total / duration if duration else None,
+            # Includes the commands of the redis INFO call itself.
+            'redis_ops_per_request': ((commands_after - commands_before) / total
+                                      if commands_before is not None and commands_after is not None and total
+                                      else None),
+            'latency': {},
+        }
+        for name, latencies in sorted(self.latencies.items()) + [('all', sum(self.latencies.values(), []))]:
+            latencies.sort()
+            results['latency'][name] = {
+                'count': len(latencies),
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+            }
+        self.client.close()
+        return results
+
+
+def report(results, baseline=None):
+    """
+    Logs the results and the relative change to the baseline results if given.
+    """
+    def change(value, base):
+        if value is None or not base:
+            return ''
+        return ' ({:+.1f}%)'.format((value - base) / base * 100)
+
+    baseline = baseline or {}
+    if 'requests_per_second' in results:
+        print('{:.0f} requests/s{}, {} errors, {} redis ops/request{}'.format(
+            results['requests_per_second'],
+            change(results['requests_per_second'], baseline.get('requests_per_second')),
+            results['errors'],
+            '{:.2f}'.format(results['redis_ops_per_request']) if results['redis_ops_per_request'] is not None else '-',
+            change(results['redis_ops_per_request'], baseline.get('redis_ops_per_request'))))
+    for name, stats in results['latency'].items():
+        base = baseline.get('latency', {}).get(name, {})
+        print('{:<26} {:>7} requests  p50 {:9.4f}ms{:<10} p95 {:9.4f}ms{:<10} p99 {:9.4f}ms{}'.format(
+            name, stats['count'],
+            stats['p50'] * 1000, change(stats['p50'], base.get('p50')),
+            stats['p95'] * 1000, change(stats['p95'], base.get('p95')),
+            stats['p99'] * 1000, change(stats['p99'], base.get('p99'))))
+
+
+async def run(options):
+    """
+    Runs the benchmark against the server at bench_url or an application
+    started in-process with the given application options.
+    """
+    server = application = None
+    base_url = options.bench_url
+    if not base_url:
+        application = app.Application(options.domain, options.salt, options.redis_namespace, options.redis_host,
+                                      int(options.redis_port), options.redis_db, options.redis_password,
+                                      int(options.ttl), redis_async=options.redis_async,
+                                      redis_pool_size=int(options.redis_pool_size),
+                                      cache_size=int(options.cache_size), cache_bytes=int(options.cache_bytes),
+                                      cache_ttl=int(options.cache_ttl),
+                                      cache_negative_ttl=int(options.cache_negative_ttl),
+                                      legacy_reads=options.legacy_reads,
+                                      hash_block_size=int(options.hash_block_size),
+                                      batch_limit=int(options.batch_limit),
+                                      page_cache_size=int(options.page_cache_size),
+                                      ua_cache_size=int(options.ua_cache_size),
+                                      analytics=options.analytics,
+                                      analytics_flush_interval=options.analytics_flush_interval,
+                                      analytics_buffer_size=int(options.analytics_buffer_size),
+                                      dedup=options.dedup,
+                                      redis_nodes=[node for node in options.redis_nodes.split(',') if node],
+                                      redis_cluster=options.redis_cluster,
+                                      redirect_status=options.redirect_status,
+                                      redirect_max_age=options.redirect_max_age,
+                                      redis_timeout=options.redis_timeout,
+                                      breaker_failures=int(options.breaker_failures),
+                                      breaker_reset=options.breaker_reset,
+                                      cache_stale_ttl=int(options.cache_stale_ttl),
+                                      storage=options.storage,
+                                      memory_latency=options.memory_latency,
+                                      slow_request_threshold=options.slow_request_threshold)
+        sock, port = tornado.testing.bind_unused_port()
+        server = tornado.httpserver.HTTPServer(application)
+        server.add_sockets([sock])
+        if application.click_counter is not None:
+            application.click_counter.start()
+        base_url = 'http://127.0.0.1:{}'.format(port)
+
+    benchmark = Benchmark(base_url, options.bench_requests, options.bench_concurrency, options.bench_links,
+                          parse_weights(options.bench_mix), parse_weights(options.bench_devices),
+                          options.bench_skew, application.redis if application else None)
+    try:
+        return await benchmark.run()
+    finally:
+        if server:
+            server.stop()
+            await application.hash_generator.release()
+            if application.click_counter is not None:
+                await application.click_counter.stop()
+
+
+def main():
+    """
+    Main function to run the benchmark from the command line.
+    """
+    tornado.options.parse_command_line()
+    options = tornado.options.options
+    if options.bench_suite == 'urls':
+        results = benchmark_urls()
+    else:
+        results = tornado.ioloop.IOLoop.current().run_sync(lambda: run(options))
+    results['options'] = {name: value for name, value in options.as_dict().items()
+                          if name.startswith(('bench_', 'cache_', 'redis_')) and name != 'redis_password'}
+    baseline = None
+    if options.bench_compare and os.path.exists(options.bench_compare):
+        with open(options.bench_compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if options.bench_output:
+        with open(options.bench_output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+# Run main method if script is run from command line.
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import datetime
+import logging
+import time
+
+import tornado.gen
+import tornado.util
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a backend while its circuit breaker is open.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Guards calls to a backend like redis with a timeout per call and stops
+    calling it after max_failures failed or timed out calls in a row. While
+    the breaker is open calls fail immediately with CircuitOpenError, so
+    requests neither wait for an unavailable backend nor pile up on it.
+    After reset_timeout seconds a single trial call is let through, closing
+    the breaker on success and opening it again on failure.
+    """
+
+    def __init__(self, name='redis', max_failures=5, reset_timeout=5, timeout=0):
+        self.name = name
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.timeout = timeout
+        self.failures = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    async def call(self, function, *args, **kwargs):
+        """
+        Calls the given coroutine function unless the breaker is open.
+        """
+        trial = False
+        if self.opened_at is not None:
+            if self._trial or time.monotonic() < self.opened_at + self.reset_timeout:
+                self.rejected += 1
+                raise CircuitOpenError('Circuit breaker {} is open'.format(self.name))
+            trial = self._trial = True
+        try:
+            if self.timeout:
+                # The call goes on in the background after a timeout, its errors are expected.
+                result = await tornado.gen.with_timeout(datetime.timedelta(seconds=self.timeout),
+                                                        function(*args, **kwargs), quiet_exceptions=Exception)
+            else:
+                result = await function(*args, **kwargs)
+        except Exception as e:
+            if isinstance(e, tornado.util.TimeoutError):
+                self.timeouts += 1
+            self.failures += 1
+            if self.max_failures and (trial or self.failures >= self.max_failures):
+                if self.opened_at is None:
+                    logging.warning('Opening circuit breaker {} after {} failures'.format(self.name, self.failures))
+                self.opened_at = time.monotonic()
+            raise
+        finally:
+            if trial:
+                self._trial = False
+        if self.opened_at is not None:
+            logging.info('Closing circuit breaker {}'.format(self.name))
+        self.failures = 0
+        self.opened_at = None
+        return result
@@ -0,0 +1,159 @@
+import asyncio
+import collections
+import time
+
+from tornado.concurrent import Future
+
+# Rough per entry overhead of the dict slot, tuple and string objects in bytes.
+ENTRY_OVERHEAD = 256
+
+
+class LinkCache(object):
+    """
+    A bounded in-process LRU cache for resolved links. Values are the URL tuples
+    returned by BaseHandler.load_urls, or other tuples of strings or bytes, and
+    every entry has its own time to live.
+    Missing links are cached as well (negative caching) but for a shorter time.
+    Expired entries are kept for another stale_ttl seconds to be served by
+    get_stale while the storage is unavailable.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=0, ttl=60, negative_ttl=5, stale_ttl=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Returns the cached value for the given key or None if the key is not
+        cached or expired. Note that a cached missing link is returned as an
+        empty tuple which is falsy, so check with `is None` for a cache miss.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires, size = entry
+        now = time.monotonic()
+        if expires < now:
+            if expires + self.stale_ttl < now:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def get_stale(self, key):
+        """
+        Returns the cached value for the given key like get, including
+        entries expired less than stale_ttl seconds ago.
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[1] + self.stale_ttl < time.monotonic():
+            return None
+        return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """
+        Caches the given value. A falsy value marks the key as missing. The
+        entry lives for the given ttl in seconds but never longer than the
+        configured maximum.
+        """
+        if not self.max_entries:
+            return
+        if not value:
+            value = ()
+            ttl = self.negative_ttl
+        elif ttl is None or ttl > self.ttl:
+            ttl = self.ttl
+        if ttl <= 0:
+            return
+        size = ENTRY_OVERHEAD + len(key) + sum(len(v) for v in value if v)
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, time.monotonic() + ttl, size)
+        self.size += size
+        while len(self._entries) > self.max_entries or (self.max_bytes and self.size > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Removes the given key from the cache.
+        """
+        if key in self._entries:
+            self._remove(key)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def _remove(self, key):
+        value, expires, size = self._entries.pop(key)
+        self.size -= size
+
+
+class CallCancelledError(Exception):
+    """
+    Raised to callers waiting for a coalesced call that was cancelled.
+    """
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key, e.g. lookups of a hot link
+    missing in the cache, into a single call whose result or error is shared
+    by all callers.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key, function, *args):
+        """
+        Calls the given coroutine function unless a call for the key is in
+        flight already, in which case its result is awaited instead. If the
+        call is cancelled, callers waiting for it get a CallCancelledError.
+        """
+        future = self._calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            # A cancelled caller must not cancel the call shared with others.
+            return await asyncio.shield(future)
+        future = self._calls[key] = Future()
+        try:
+            result = await function(*args)
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the error as retrieved in case nobody else waits for it.
+            future.exception()
+            raise
+        except BaseException:
+            # Cancelled, let the callers waiting for it fail like on errors.
+            future.set_exception(CallCancelledError(key))
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
@@ -0,0 +1,72 @@
+import collections
+import re
+
+# Device classes returned by DeviceClassifier.classify.
+DESKTOP = 'desktop'
+ANDROID = 'android'
+IOS = 'ios'
+BOT = 'bot'
+
+# Patterns matched against the User-Agent in order, the first match wins. Bots
+# come first so crawlers posing as mobile browsers get a plain redirect.
+# Windows Phone claims to be Android and iPhone, so it is treated as desktop.
+# Crawlers are named explicitly, as phones like the CUBOT end in "bot" too.
+DEFAULT_PATTERNS = (
+    (BOT, r'\bbot\b|Googlebot|bingbot|YandexBot|Applebot|DuckDuckBot|Twitterbot|LinkedInBot|TelegramBot'
+          r'|AhrefsBot|SemrushBot|PetalBot|MJ12bot|crawl|spider|slurp|facebookexternalhit|facebookcatalog'
+          r'|embedly|WhatsApp|Slack|Discord|Google-InspectionTool|HeadlessChrome|curl/|Wget/|python-requests'
+          r'|Go-http-client|okhttp/'),
+    (DESKTOP, r'Windows Phone|IEMobile'),
+    (ANDROID, r'Android'),
+    (IOS, r'iPhone|iPad|iPod'),
+)
+
+# User-Agents longer than this are classified but not cached.
+MAX_CACHED_LENGTH = 1024
+
+
+class DeviceClassifier(object):
+    """
+    Classifies requests by their User-Agent into one of the device classes
+    DESKTOP, ANDROID, IOS or BOT. Patterns are compiled once and results are
+    kept in a bounded LRU cache keyed by the full User-Agent, as a small set
+    of User-Agents makes up most traffic.
+    Subclass and override match or pass other patterns to route other devices.
+    """
+
+    def __init__(self, patterns=DEFAULT_PATTERNS, max_entries=10000, default=DESKTOP):
+        self.patterns = [(device, re.compile(pattern, re.IGNORECASE)) for device, pattern in patterns]
+        self.max_entries = max_entries
+        self.default = default
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def classify(self, user_agent):
+        """
+        Returns the device class for the given User-Agent.
+        """
+        device = self._entries.get(user_agent)
+        if device is not None:
+            self._entries.move_to_end(user_agent)
+            self.hits += 1
+            return device
+        self.misses += 1
+        device = self.match(user_agent)
+        if self.max_entries and len(user_agent) <= MAX_CACHED_LENGTH:
+            self._entries[user_agent] = device
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return device
+
+    def match(self, user_agent):
+        """
+        Matches the User-Agent against all patterns without using the cache.
+        """
+        for device, pattern in self.patterns:
+            if pattern.search(user_agent):
+                return device
+        return self.default
+
+    def __len__(self):
+        return len(self._entries)
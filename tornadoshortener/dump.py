@@ -0,0 +1,311 @@
+import gzip
+import json
+import logging
+import sys
+import time
+
+import redis
+import tornado.options
+
+from . import app  # noqa: F401, defines the redis parameters.
+from .storage import LEGACY_SUFFIXES, LINK_FIELDS, HashRing, parse_node
+
+# Define command line parameters in addition to the ones of the application.
+tornado.options.define('dump_file', type=str, default='-',
+                       help='The gzip compressed NDJSON file to dump to or load from, - meaning stdout or stdin')
+tornado.options.define('dump_batch', type=int, default=1000,
+                       help='The number of keys scanned or loaded per redis round trip')
+tornado.options.define('reshard_drain', type=str, default='',
+                       help='Comma separated redis nodes host:port/db removed from redis_nodes to move all links from')
+tornado.options.define('reshard_delete', type=bool, default=True,
+                       help='Delete links from their previous node after copying them to their new node')
+
+# Sets a day counter only if the given value is larger, so hashes handed out
+# since the dump never collide with new hashes.
+SET_MAX_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if tonumber(ARGV[1]) > current then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+"""
+
+
+def scan(connection, match, count):
+    """
+    Yields batches of keys matching the given pattern.
+    """
+    cursor = 0
+    while True:
+        cursor, keys = connection.scan(cursor, match=match, count=count)
+        if keys:
+            yield keys
+        if not cursor:
+            break
+
+
+def expire_at(pttl, now):
+    # The absolute expiry in milliseconds or None if the key does not expire.
+    return now + pttl if pttl >= 0 else None
+
+
+def dump_records(connection, namespace, batch=1000, types=('link', 'digest', 'counter')):
+    """
+    Yields all links, legacy links, dedup digests and hash day counters as
+    dicts, reading one batch of keys per redis round trip. Only records of
+    the given types are dumped.
+    """
+    # Links stored in a single redis hash.
+    prefix = namespace + 'LINK:'
+    for keys in scan(connection, prefix + '*', batch) if 'link' in types else ():
+        pipe = connection.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+            pipe.pttl(key)
+        result = pipe.execute()
+        now = int(time.time() * 1000)
+        for i, key in enumerate(keys):
+            if result[i * 2]:
+                yield {'type': 'link', 'hash': key[len(prefix):], 'urls': result[i * 2],
+                       'expire_at': expire_at(result[i * 2 + 1], now)}
+
+    # Links in the legacy layout with one key per URL, read with one MGET each.
+    prefix = namespace + 'URLS:'
+    for keys in scan(connection, prefix + '*', batch) if 'link' in types else ():
+        hashes = [key[len(prefix):] for key in keys if ':' not in key[len(prefix):]]
+        pipe = connection.pipeline(transaction=False)
+        for url_hash in hashes:
+            pipe.mget([prefix + url_hash + suffix for suffix in LEGACY_SUFFIXES])
+            pipe.pttl(prefix + url_hash)
+        result = pipe.execute() if hashes else []
+        now = int(time.time() * 1000)
+        for i, url_hash in enumerate(hashes):
+            urls = {field: url for field, url in zip(LINK_FIELDS, result[i * 2]) if url}
+            if urls.get('l'):
+                yield {'type': 'link', 'hash': url_hash, 'urls': urls, 'expire_at': expire_at(result[i * 2 + 1], now)}
+
+    # Dedup digests.
+    prefix = namespace + 'DIGEST:'
+    for keys in scan(connection, prefix + '*', batch) if 'digest' in types else ():
+        pipe = connection.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+            pipe.pttl(key)
+        result = pipe.execute()
+        now = int(time.time() * 1000)
+        for i, key in enumerate(keys):
+            if result[i * 2]:
+                yield {'type': 'digest', 'digest': key[len(prefix):], 'hash': result[i * 2],
+                       'expire_at': expire_at(result[i * 2 + 1], now)}
+
+    # Hash day counters including the counters of unused indices.
+    prefix = namespace + 'HI:'
+    for keys in scan(connection, prefix + '*', batch) if 'counter' in types else ():
+        for key, value in zip(keys, connection.mget(keys)):
+            if value is not None:
+                yield {'type': 'counter', 'key': key[len(namespace):], 'value': int(value)}
+
+
+def load_records(connection, namespace, records, batch=1000):
+    """
+    Writes records as yielded by dump_records with one redis pipeline per
+    batch of records. Expired records are skipped and day counters are only
+    ever raised.
+
+    @returns: Returns the number of records loaded per type.
+    """
+    set_max = connection.register_script(SET_MAX_SCRIPT)
+    counts = {}
+    pipe = connection.pipeline(transaction=False)
+    pending = 0
+    for record in records:
+        now = int(time.time() * 1000)
+        if record.get('expire_at') is not None and record['expire_at'] <= now:
+            continue
+        if record['type'] == 'link':
+            key = namespace + 'LINK:' + record['hash']
+            pipe.delete(key)
+            pipe.hset(key, mapping=record['urls'])
+        elif record['type'] == 'digest':
+            key = namespace + 'DIGEST:' + record['digest']
+            pipe.set(key, record['hash'])
+        elif record['type'] == 'counter':
+            set_max(keys=[namespace + record['key']], args=[record['value']], client=pipe)
+            key = None
+        else:
+            logging.warning('Skipping record of unknown type %s', record['type'])
+            continue
+        if key and record.get('expire_at') is not None:
+            pipe.pexpireat(key, record['expire_at'])
+        counts[record['type']] = counts.get(record['type'], 0) + 1
+        pending += 1
+        if pending >= batch:
+            pipe.execute()
+            pipe = connection.pipeline(transaction=False)
+            pending = 0
+    if pending:
+        pipe.execute()
+    return counts
+
+
+def load_sharded(connections, namespace, records, ring, primary, batch=1000):
+    """
+    Writes records like load_records, links and dedup digests to the node
+    owning them on the given ring and day counters to the primary node.
+    Connections are given as a dict {name: connection}.
+
+    @returns: Returns the number of records loaded per type.
+    """
+    counts = {}
+    pending = {}
+
+    def flush(name):
+        for kind, count in load_records(connections[name], namespace, pending.pop(name), batch).items():
+            counts[kind] = counts.get(kind, 0) + count
+
+    for record in records:
+        if record['type'] == 'link':
+            name = ring.get(record['hash'])
+        elif record['type'] == 'digest':
+            name = ring.get(record['digest'])
+        else:
+            name = primary
+        pending.setdefault(name, []).append(record)
+        if len(pending[name]) >= batch:
+            flush(name)
+    for name in list(pending):
+        flush(name)
+    return counts
+
+
+def reshard(connections, namespace, ring, batch=1000, delete=True):
+    """
+    Moves links and dedup digests stored on a node other than the node owning
+    them on the given ring to their owner. Connections are given as a dict
+    {name: connection} including nodes not on the ring anymore.
+
+    @returns: Returns the number of keys moved from each node.
+    """
+    moved = {}
+    for name, connection in connections.items():
+        moved[name] = 0
+        for kind, prefix in (('link', namespace + 'LINK:'), ('digest', namespace + 'DIGEST:')):
+            for keys in scan(connection, prefix + '*', batch):
+                misplaced = [key for key in keys if ring.get(key[len(prefix):]) != name]
+                if not misplaced:
+                    continue
+                pipe = connection.pipeline(transaction=False)
+                for key in misplaced:
+                    if kind == 'link':
+                        pipe.hgetall(key)
+                    else:
+                        pipe.get(key)
+                    pipe.pttl(key)
+                result = pipe.execute()
+                now = int(time.time() * 1000)
+                records = {}
+                for i, key in enumerate(misplaced):
+                    if not result[i * 2]:
+                        continue
+                    record = {'type': kind, 'expire_at': expire_at(result[i * 2 + 1], now)}
+                    if kind == 'link':
+                        record.update(hash=key[len(prefix):], urls=result[i * 2])
+                    else:
+                        record.update(digest=key[len(prefix):], hash=result[i * 2])
+                    records.setdefault(ring.get(key[len(prefix):]), []).append(record)
+                for owner, owned in records.items():
+                    load_records(connections[owner], namespace, owned, batch)
+                if delete:
+                    connection.delete(*misplaced)
+                moved[name] += len(misplaced)
+    return moved
+
+
+def connect(options, node=None):
+    host, port, db = parse_node(node) if node else (options.redis_host, options.redis_port, options.redis_db)
+    return redis.StrictRedis(host=host, port=port, db=db, password=options.redis_password or None,
+                             decode_responses=True)
+
+
+def connect_nodes(options):
+    """
+    Connects to redis_host and, if links are sharded, to all redis_nodes.
+
+    @returns: Returns a tuple (primary, nodes, connections) with the name of
+              redis_host, the names of the redis_nodes and a dict {name:
+              connection} of all of them.
+    """
+    primary = '{}:{}/{}'.format(options.redis_host, options.redis_port, options.redis_db)
+    connections = {primary: connect(options)}
+    nodes = []
+    for node in options.redis_nodes.split(','):
+        if node:
+            nodes.append('{}:{}/{}'.format(*parse_node(node)))
+            connections.setdefault(nodes[-1], connect(options, node))
+    return primary, list(dict.fromkeys(nodes)), connections
+
+
+def dump_main():
+    """
+    Main function to dump all links as gzip compressed NDJSON. If links are
+    sharded, links and dedup digests are dumped from every node.
+    """
+    tornado.options.parse_command_line()
+    options = tornado.options.options
+    primary, nodes, connections = connect_nodes(options)
+    if nodes:
+        # Hash day counters are kept in the primary redis only.
+        sources = [(connections[primary], ('counter',))] + [(connections[name], ('link', 'digest'))
+                                                            for name in nodes]
+    else:
+        sources = [(connections[primary], ('link', 'digest', 'counter'))]
+    out = sys.stdout.buffer if options.dump_file == '-' else open(options.dump_file, 'wb')
+    counts = {}
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        for connection, types in sources:
+            for record in dump_records(connection, options.redis_namespace, options.dump_batch, types):
+                f.write(json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n')
+                counts[record['type']] = counts.get(record['type'], 0) + 1
+    if out is not sys.stdout.buffer:
+        out.close()
+    logging.info('Dumped {}'.format(counts))
+
+
+def load_main():
+    """
+    Main function to load links dumped with tornadoshortener-dump. If links
+    are sharded, links and dedup digests are loaded into the node owning
+    them.
+    """
+    tornado.options.parse_command_line()
+    options = tornado.options.options
+    primary, nodes, connections = connect_nodes(options)
+    source = sys.stdin.buffer if options.dump_file == '-' else open(options.dump_file, 'rb')
+    with gzip.GzipFile(fileobj=source, mode='rb') as f:
+        records = (json.loads(line) for line in f if line.strip())
+        if nodes:
+            counts = load_sharded(connections, options.redis_namespace, records, HashRing(nodes), primary,
+                                  options.dump_batch)
+        else:
+            counts = load_records(connections[primary], options.redis_namespace, records, options.dump_batch)
+    if source is not sys.stdin.buffer:
+        source.close()
+    logging.info('Loaded {}'.format(counts))
+
+
+def reshard_main():
+    """
+    Main function to move links to their node after redis_nodes changed.
+    """
+    tornado.options.parse_command_line()
+    options = tornado.options.options
+    nodes = [node for node in options.redis_nodes.split(',') if node]
+    drain = [node for node in options.reshard_drain.split(',') if node]
+    if not nodes:
+        logging.error('No redis_nodes given')
+        sys.exit(1)
+    connections = {}
+    for node in nodes + drain:
+        connections['{}:{}/{}'.format(*parse_node(node))] = connect(options, node)
+    ring = HashRing(['{}:{}/{}'.format(*parse_node(node)) for node in nodes])
+    moved = reshard(connections, options.redis_namespace, ring, options.dump_batch, options.reshard_delete)
+    logging.info('Moved {}'.format(moved))
@@ -1,98 +1,203 @@
+import base64
+import gzip
+import hashlib
+import hmac
 import logging
-
+import math
+import os
+import re
 import time
+
+from tornado.web import GZipContentEncoding
 from tornado.web import HTTPError
 from tornado.web import RequestHandler
 
+from . import device
+from . import profiling
 from . import utils
+from .breaker import CircuitOpenError
+
+# Custom aliases are valid hashes of short URLs of limited length.
+ALIAS_PATTERN = re.compile(r'[a-zA-Z0-9]{1,64}\Z')
+
+# Aliases shadowed by other endpoints.
+RESERVED_ALIASES = frozenset(('shorten', 'expand', 'stats', 'metrics', 'healthz', 'readyz', 'admin'))
+
+# Longest time in seconds a profile may take.
+MAX_PROFILE_SECONDS = 300
+
+# Logger for requests slower than slow_request_threshold.
+slow_log = logging.getLogger('tornadoshortener.slow')
 
 
 class BaseHandler(RequestHandler):
     """
     A base class with common methods for all request handlers.
     """
+    # The route whose rate limit applies to this handler, None means no limit.
+    rate_limit = None
+
+    # Time spent per phase of this request, None unless slow requests are logged.
+    trace = None
+
     def set_default_headers(self):
         self.set_header("Access-Control-Allow-Origin", "*")
         self.set_header("Access-Control-Allow-Headers", "Authorization, Credentials, Content-Type")
         self.set_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS, DELETE, PUT')
 
+    def prepare(self):
+        self.application.active_requests += 1
+        self._active = True
+        if self.settings['slow_request_threshold']:
+            self.trace = profiling.RequestTrace()
+            profiling.current_trace.set(self.trace)
+        if self.rate_limit and self.application.rate_limiter is not None:
+            self.check_rate_limit()
+
+    def on_finish(self):
+        if getattr(self, '_active', False):
+            self.application.active_requests -= 1
+            self._active = False
+        handler = type(self).__name__
+        metrics = self.application.metrics
+        metrics.inc('requests_total', (('handler', handler), ('method', self.request.method),
+                                       ('code', self.get_status())))
+        duration = self.request.request_time()
+        metrics.observe('request_duration_seconds', duration, (('handler', handler),))
+        if self.trace is not None:
+            profiling.current_trace.set(None)
+            if duration >= self.settings['slow_request_threshold']:
+                metrics.inc('slow_requests_total', (('handler', handler),))
+                slow_log.warning('Slow request %d %s %.2fms %s', self.get_status(), self._request_summary(),
+                                 duration * 1000, self.trace.format(duration))
+
+    def write(self, chunk):
+        if self.trace is None or not isinstance(chunk, dict):
+            return super().write(chunk)
+        # Dicts are encoded as JSON.
+        start = time.perf_counter()
+        super().write(chunk)
+        self.trace.add('json', time.perf_counter() - start)
+
+    def rate_limit_client(self):
+        """
+        Returns the client a request is counted for. The IP is taken from the
+        X-Real-IP or X-Forwarded-For header behind a load balancer.
+        """
+        return self.request.remote_ip
+
+    def check_rate_limit(self, tokens=1):
+        """
+        Takes tokens from the bucket of the client and finishes the request
+        with status 429 if the client exceeded its limit.
+
+        @returns: Returns True if the request may proceed.
+        """
+        retry_after = self.application.rate_limiter.consume(self.rate_limit, self.rate_limit_client(), tokens)
+        if not retry_after:
+            return True
+        self.set_status(429)
+        self.set_header('Retry-After', str(math.ceil(retry_after)))
+        self.finish({'status_code': 429, 'status_txt': 'RATE_LIMIT_EXCEEDED', 'data': []})
+        return False
+
+    def check_batch_rate_limit(self, count):
+        """
+        Charges a batch request one token per entry, one was taken in prepare.
+
+        @returns: Returns True if the request may proceed.
+        """
+        if count > 1 and self.rate_limit and self.application.rate_limiter is not None:
+            return self.check_rate_limit(count - 1)
+        return True
+
     def options(self, *args, **kwargs):
         # no body
         self.set_status(204)
         self.finish()
 
-    def store_url(self, url_hash, long_url, android_url=None,
-                  android_fallback_url=None, ios_url=None, ios_fallback_url=None):
+    async def store_url(self, url_hash, long_url, android_url=None,
+                        android_fallback_url=None, ios_url=None, ios_fallback_url=None):
         """
         Stores a long URL for the given url hash. You can specify additional URLS
         for ios and android devices.
+        All URLs of a link are stored in a single redis hash.
         """
-        ttl = int(time.time()) + self.settings['ttl'] * 24 * 60 * 60
-        key_prefix = self.settings['redis_namespace'] + 'URLS:' + url_hash
-        pipe = self.application.redis.pipeline()
+        await self.store_urls([(url_hash, (long_url, android_url, android_fallback_url, ios_url, ios_fallback_url))])
 
-        k = key_prefix + ''
-        pipe.set(k, long_url)
-        if self.settings['ttl']:
-            pipe.expireat(k, ttl)
-
-        if android_url:
-            k = key_prefix + ':android_url'
-            pipe.set(k, android_url)
-            if self.settings['ttl']:
-                pipe.expireat(k, ttl)
-
-        if android_fallback_url:
-            k = key_prefix + ':android_fallback_url'
-            pipe.set(k, android_fallback_url)
-            if self.settings['ttl']:
-                pipe.expireat(k, ttl)
-
-        if ios_url:
-            k = key_prefix + ':ios_url'
-            pipe.set(k, ios_url)
-            if self.settings['ttl']:
-                pipe.expireat(k, ttl)
+    async def store_urls(self, links, digests=None):
+        """
+        Stores many links at once. Links are given as a list of tuples
+        (url_hash, urls) where urls is a tuple like the one returned by load_urls.
+        If digests are given, one per link, the links are added to the index
+        used to deduplicate links.
+        """
+        await self.application.storage.store_many(links, digests)
+        for url_hash, urls in links:
+            self.application.link_cache.invalidate(url_hash)
 
-        if ios_fallback_url:
-            k = key_prefix + ':ios_fallback_url'
-            pipe.set(k, ios_fallback_url)
-            if self.settings['ttl']:
-                pipe.expireat(k, ttl)
+    async def reserve_urls(self, links):
+        """
+        Stores links with custom hashes like store_urls unless their hash is
+        taken, checked and written atomically without any extra round trip.
 
-        pipe.execute()
+        @returns: Returns a list with True for every link stored and False for
+                  every link whose hash is taken.
+        """
+        reserved = await self.application.storage.reserve_many(links)
+        for url_hash, urls in links:
+            self.application.link_cache.invalidate(url_hash)
+        return reserved
 
-    def load_url(self, url_hash):
+    async def load_url(self, url_hash):
         """
         Loads the long URL for the given URL hash.
         """
-        return self.application.redis.get(self.settings['redis_namespace'] + 'URLS:' + url_hash)
+        return (await self.load_urls(url_hash))[0]
 
-    def load_urls(self, url_hash):
+    async def load_urls(self, url_hash, with_expiry=False):
         """
         Loads the long URL for the given URL hash as well as the alternative URLs
         for ios and android devices.
 
         @returns: Returns the URLs as a tuple
                   (long_url, android_url, android_fallback_url, ios_url, ios_fallback_url)
+                  If with_expiry is True a tuple (urls, expires_in) is returned
+                  where expires_in is the remaining time to live of the link in
+                  seconds or None if the link does not expire.
         """
-        key_prefix = self.settings['redis_namespace'] + 'URLS:' + url_hash
-        pipe = self.application.redis.pipeline()
+        return (await self.load_urls_many([url_hash], with_expiry))[0]
 
-        k = key_prefix + ''
-        pipe.get(k)
-        k = key_prefix + ':android_url'
-        pipe.get(k)
-        k = key_prefix + ':android_fallback_url'
-        pipe.get(k)
-        k = key_prefix + ':ios_url'
-        pipe.get(k)
-        k = key_prefix + ':ios_fallback_url'
-        pipe.get(k)
+    async def load_urls_many(self, url_hashes, with_expiry=False):
+        """
+        Loads the URLs for many URL hashes at once.
 
-        result = pipe.execute()
+        @returns: Returns a list with one result per URL hash like load_urls.
+        """
+        return await self.application.storage.load_many(url_hashes, with_expiry)
 
-        return (result[0], result[1], result[2], result[3], result[4])
+    async def load_urls_cached(self, url_hash):
+        """
+        Same as load_urls but serves hot links from the in-process link cache.
+        Missing links are cached as well for a short time. Concurrent lookups
+        of the same link share a single call to the storage. If the storage
+        fails, links expired in the cache are served for a while.
+        """
+        cache = self.application.link_cache
+        urls = cache.get(url_hash) if cache.max_entries else None
+        if urls is None:
+            try:
+                urls, expires_in = await self.application.single_flight.do(url_hash, self.load_urls, url_hash, True)
+            except Exception as e:
+                urls = cache.get_stale(url_hash)
+                if urls is None:
+                    logging.warning('Could not load link %s', url_hash, exc_info=not isinstance(e, CircuitOpenError))
+                    raise HTTPError(503)
+                logging.debug('Serving stale link %s', url_hash, exc_info=1)
+                self.application.metrics.inc('stale_links_served_total')
+                return urls or (None, None, None, None, None)
+            cache.set(url_hash, urls if urls[0] else None, expires_in)
+        return urls or (None, None, None, None, None)
 
 
 class IndexHandler(BaseHandler):
@@ -104,59 +209,186 @@ class RedirectHandler(BaseHandler):
     """
     Handles API requests for the / API endpoint.
     """
+    rate_limit = 'redirect'
+
+    def set_default_headers(self):
+        # Browsers follow redirects without CORS, so the headers of BaseHandler are skipped.
+        pass
 
-    def get(self, url_hash):
+    async def get(self, url_hash):
         """
         Redirects a short URL based on the given url hash.
         """
-        long_url, android_url, android_fallback_url, ios_url, ios_fallback_url = self.load_urls(str(url_hash))
+        urls = await self.load_urls_cached(str(url_hash))
+        long_url, android_url, android_fallback_url, ios_url, ios_fallback_url = urls
 
+        device_class = self.application.device_classifier.classify(self.request.headers.get('User-Agent', ''))
         if not long_url:
+            self.count_redirect(device_class, '404')
             raise HTTPError(404)
         else:
-            user_agent = self.request.headers.get('User-Agent', '')
-            if android_url and 'Android' in user_agent:
+            if self.application.click_counter is not None:
+                self.application.click_counter.record(url_hash, device_class)
+            if android_url and device_class == device.ANDROID:
                 logging.debug('Redirect Android device')
+                self.count_redirect(device_class, 'android')
                 self.redirect_android(android_url, android_fallback_url)
                 return
-            elif ios_url and ('iPhone' in user_agent or 'iPad' in user_agent):
+            elif ios_url and device_class == device.IOS:
                 logging.debug('Redirect iOS device')
+                self.count_redirect(device_class, 'ios')
                 self.redirect_ios(ios_url, ios_fallback_url)
                 return
             else:
                 logging.debug('Default redirect')
-                self.redirect(long_url, permanent=True)
+                self.count_redirect(device_class, str(self.settings['redirect_status']))
+                # Links with alternative URLs depend on the device and must not be cached.
+                self.write_redirect(long_url, cacheable=not android_url and not ios_url)
+
+    def count_redirect(self, device_class, outcome):
+        self.application.metrics.inc('redirects_total', (('device', device_class), ('outcome', outcome)))
+
+    def write_redirect(self, url, cacheable=True):
+        """
+        Writes a redirect to the given absolute URL without the checks and
+        URL joining of redirect(). Cacheable redirects get a Cache-Control
+        header if redirect_max_age is set.
+        """
+        self.set_status(self.settings['redirect_status'])
+        self.set_header('Location', url)
+        if cacheable and self.settings['redirect_max_age']:
+            self.set_header('Cache-Control', 'max-age={}'.format(self.settings['redirect_max_age']))
+        self.finish()
 
     def redirect_android(self, url, url_fallback=None):
         if url_fallback:
-            self.render('redirect.android.fallback.html', url=url, url_fallback=url_fallback)
+            self.write_page('redirect.android.fallback.html', url, url_fallback)
         else:
-            self.render('redirect.android.html', url=url, url_fallback=url_fallback)
+            self.write_page('redirect.android.html', url, url_fallback)
 
     def redirect_ios(self, url, url_fallback=None):
         if url_fallback:
-            self.render('redirect.ios.fallback.html', url=url, url_fallback=url_fallback)
+            self.write_page('redirect.ios.fallback.html', url, url_fallback)
         else:
-            self.render('redirect.ios.html', url=url, url_fallback=url_fallback)
+            self.write_page('redirect.ios.html', url, url_fallback)
+
+    def write_page(self, template_name, url, url_fallback=None):
+        """
+        Writes a redirect page. Pages are rendered once per template and URLs and
+        cached as ready to send bytes, gzip compressed if worth it, with an ETag.
+        """
+        cache = self.application.page_cache
+        key = '\n'.join((template_name, url, url_fallback or ''))
+        page = cache.get(key)
+        if page is None:
+            start = time.perf_counter()
+            body = self.render_string(template_name, url=url, url_fallback=url_fallback)
+            duration = time.perf_counter() - start
+            self.application.metrics.observe('render_duration_seconds', duration, (('template', template_name),))
+            if self.trace is not None:
+                self.trace.add('render', duration)
+            body_gzip = gzip.compress(body) if len(body) >= GZipContentEncoding.MIN_LENGTH else None
+            page = (body, body_gzip, '"' + hashlib.sha1(body).hexdigest() + '"')
+            cache.set(key, page, cache.ttl)
+        body, body_gzip, etag = page
+
+        self.set_header('Content-Type', 'text/html; charset=UTF-8')
+        # The gzip output transform adds Vary: Accept-Encoding.
+        self.set_header('Etag', etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return self.finish()
+        if body_gzip and 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            # The gzip output transform skips responses with a Content-Encoding.
+            self.set_header('Content-Encoding', 'gzip')
+            body = body_gzip
+        self.finish(body)
+
+
+class MetricsHandler(RequestHandler):
+    """
+    Handles requests for the /metrics endpoint in the Prometheus text format.
+    """
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.finish(self.application.metrics.render())
+
+
+class HealthHandler(RequestHandler):
+    """
+    Handles requests for the /healthz endpoint, answering as long as the
+    process serves requests.
+    """
+
+    def get(self):
+        self.finish('OK')
+
+
+class ReadyHandler(RequestHandler):
+    """
+    Handles requests for the /readyz endpoint with status 503 until the
+    application is warmed up and again while it shuts down.
+    """
+
+    def get(self):
+        if not self.application.ready:
+            self.set_status(503)
+            return self.finish('NOT READY')
+        self.finish('READY')
+
+
+class ProfileHandler(RequestHandler):
+    """
+    Handles requests for the /admin/profile endpoint. Samples the stacks of
+    this process for the given number of seconds and returns them collapsed,
+    ready for flamegraph.pl or speedscope. The admin token is required as
+    bearer token, without a configured token the endpoint does not exist.
+    """
+
+    async def get(self):
+        token = self.settings['admin_token']
+        if not token:
+            raise HTTPError(404)
+        authorization = self.request.headers.get('Authorization', '')
+        if not hmac.compare_digest(authorization.encode('utf-8'), ('Bearer ' + token).encode('utf-8')):
+            raise HTTPError(403)
+        try:
+            seconds = float(self.get_argument('seconds', 10))
+            interval = float(self.get_argument('interval', 0.005))
+        except ValueError:
+            raise HTTPError(400)
+        if not 0 < seconds <= MAX_PROFILE_SECONDS or not 0.001 <= interval <= 1:
+            raise HTTPError(400)
+        profiler = self.application.profiler
+        if profiler.running:
+            raise HTTPError(409)
+        stacks = await profiler.profile(seconds, interval)
+        self.set_header('Content-Type', 'text/plain; charset=utf-8')
+        self.set_header('Content-Disposition', 'attachment; filename="profile-{}.folded"'.format(os.getpid()))
+        self.finish(stacks)
 
 
 class ExpandHandler(BaseHandler):
     """
     Handles API requests for the /expand API endpoint.
     """
+    rate_limit = 'expand'
 
-    def get(self):
+    async def get(self):
         """
-        Given a shortened URL or hash, returns the target (long) URL.
+        Given one or more shortened URLs or hashes, returns the target (long) URLs.
         """
-        short_url = self.get_argument('shortUrl', None)  # Is decoded by Tornado.
-        url_hash = self.get_argument('hash', None)
+        short_urls = [short_url for short_url in self.get_arguments('shortUrl') if short_url]  # Decoded by Tornado.
+        url_hashes = [url_hash for url_hash in self.get_arguments('hash') if url_hash]
 
         # validate short url and hash.
-        if not short_url and not url_hash:
+        if not short_urls and not url_hashes:
             return self.finish(
                 {'status_code': 500, 'status_txt': 'MISSING_ARG_SHORTURL_OR_HASH', 'data': []})
-        if short_url:
+        if len(short_urls) == 1 and len(url_hashes) <= 1:
+            short_url = short_urls[0]
+            url_hash = url_hashes[0] if url_hashes else None
             try:
                 url_hash_from_url = utils.get_hash_from_url(short_url)
             except Exception:
@@ -167,42 +399,139 @@ class ExpandHandler(BaseHandler):
                 # TODO: Response differs from bitly
                 return self.finish(
                     {'status_code': 500, 'status_txt': 'ARGS_DONT_MATCH', 'data': []})
+            entries = [{'hash': url_hash_from_url, 'short_url': short_url}]
+        else:
+            entries = self.parse_entries([{'shortUrl': short_url} for short_url in short_urls] +
+                                         [{'hash': url_hash} for url_hash in url_hashes])
+        await self.expand(entries)
+
+    async def post(self):
+        """
+        Given a JSON array or newline delimited JSON of hashes or objects with a
+        shortUrl or hash, returns the target (long) URLs in order.
+        """
+        try:
+            body = utils.parse_json_entries(self.request.body)
+        except Exception:
+            logging.info('Invalid batch', exc_info=1)
+            return self.finish({'status_code': 500, 'status_txt': 'INVALID_ARG_BATCH', 'data': []})
+        if not body:
+            return self.finish(
+                {'status_code': 500, 'status_txt': 'MISSING_ARG_SHORTURL_OR_HASH', 'data': []})
+        await self.expand(self.parse_entries(body))
+
+    def parse_entries(self, body):
+        """
+        Parses the entries of a batch request. Each entry is either a hash or an
+        object with a shortUrl or hash.
+
+        @returns: Returns a list of dicts with the hash and short URL of each
+                  entry or an error.
+        """
+        entries = []
+        for entry in body:
+            if not isinstance(entry, dict):
+                entry = {'hash': entry}
+            short_url = entry.get('shortUrl')
+            url_hash = entry.get('hash')
+            if short_url:
+                try:
+                    url_hash = utils.get_hash_from_url(short_url)
+                except Exception:
+                    entries.append({'error': 'INVALID_ARG_SHORTURL', 'short_url': short_url})
+                    continue
+            if not url_hash or not isinstance(url_hash, str):
+                entries.append({'error': 'MISSING_ARG_SHORTURL_OR_HASH'})
+                continue
+            entries.append({'hash': url_hash, 'short_url': short_url})
+        return entries
+
+    async def expand(self, entries):
+        """
+        Loads the URLs for all valid entries in a single pipeline and finishes
+        the request with the results in order.
+        """
+        if len(entries) > self.settings['batch_limit']:
+            return self.finish({'status_code': 500, 'status_txt': 'BATCH_TOO_LARGE', 'data': []})
+        # Every entry counts as a request.
+        if not self.check_batch_rate_limit(len(entries)):
+            return
+        valid = [entry for entry in entries if 'error' not in entry]
+        results = await self.load_urls_many([entry['hash'] for entry in valid])
+
+        expand = []
+        found = iter(results)
+        for entry in entries:
+            if 'error' in entry:
+                expand.append(entry)
+                continue
+            long_url, android_url, android_fallback_url, ios_url, ios_fallback_url = next(found)
+            if not long_url:
+                expand.append({'error': 'NOT_FOUND', 'hash': entry['hash']})
             else:
-                url_hash = url_hash_from_url
+                expand.append({
+                    'long_url': long_url,
+                    'android_url': android_url,
+                    'android_fallback_url': android_fallback_url,
+                    'ios_url': ios_url,
+                    'ios_fallback_url': ios_fallback_url,
+                    'hash': entry['hash'],
+                    'short_url': entry['short_url']
+                })
+
+        return self.finish({
+            'status_code': 200,
+            'status_txt': 'OK',
+            'data': {
+                'expand': expand
+            }
+        })
+
+
+class StatsHandler(BaseHandler):
+    """
+    Handles API requests for the /stats API endpoint.
+    """
+    rate_limit = 'expand'
 
-        long_url, android_url, android_fallback_url, ios_url, ios_fallback_url = self.load_urls(url_hash)
-        if not long_url:
-            return self.finish({
-                'status_code': 200,
-                'status_txt': 'OK',
-                'data': {
-                    'expand': [{'error': 'NOT_FOUND', 'hash': url_hash}]
-                }
-            })
-        else:
-            return self.finish({
-                'status_code': 200,
-                'status_txt': 'OK',
-                'data': {
-                    'expand': [{
-                        'long_url': long_url,
-                        'android_url': android_url,
-                        'android_fallback_url': android_fallback_url,
-                        'ios_url': ios_url,
-                        'ios_fallback_url': ios_fallback_url,
-                        'hash': url_hash,
-                        'short_url': short_url
-                    }]
-                }
-            })
+    async def get(self):
+        """
+        Given a shortened URL or hash, returns the clicks per day and device.
+        """
+        short_url = self.get_argument('shortUrl', None)  # Decoded by Tornado.
+        url_hash = self.get_argument('hash', None)
+        if not short_url and not url_hash:
+            return self.finish(
+                {'status_code': 500, 'status_txt': 'MISSING_ARG_SHORTURL_OR_HASH', 'data': []})
+        if short_url:
+            try:
+                url_hash = utils.get_hash_from_url(short_url)
+            except Exception:
+                return self.finish(
+                    {'status_code': 500, 'status_txt': 'INVALID_ARG_SHORTURL', 'data': []})
+        if self.application.click_counter is None:
+            return self.finish({'status_code': 500, 'status_txt': 'ANALYTICS_DISABLED', 'data': []})
+
+        days = await self.application.click_counter.load(url_hash)
+        self.finish({
+            'status_code': 200,
+            'status_txt': 'OK',
+            'data': {
+                'hash': url_hash,
+                'short_url': short_url,
+                'clicks': sum(sum(devices.values()) for devices in days.values()),
+                'days': days
+            }
+        })
 
 
 class ShortHandler(BaseHandler):
     """
     Handles API requests for the /shorten API endpoint.
     """
+    rate_limit = 'shorten'
 
-    def get(self):
+    async def get(self):
         """
         Given a long URL, returns a short URL.
         """
@@ -212,27 +541,11 @@ class ShortHandler(BaseHandler):
         ios_url = self.get_argument('iosUrl', None)  # decoded by Tornado.
         ios_fallback_url = self.get_argument('iosFallbackUrl', None)  # decoded by Tornado.
         domain = self.get_argument('domain', self.settings['default_domain'])
+        alias = self.get_argument('alias', None)
 
         # Normalize and validate long_url.
         try:
-            long_url = utils.normalize_url(long_url)
-            assert utils.validate_url(long_url) is True
-            if android_url:
-                # TODO: Validate and normalize!
-                pass
-                # android_url = utils.normalize_url(android_url)
-                # assert utils.validate_url(android_url) is True
-            if android_fallback_url:
-                android_fallback_url = utils.normalize_url(android_fallback_url)
-                assert utils.validate_url(android_fallback_url) is True
-            if ios_url:
-                # TODO: Validate and normalize!
-                pass
-                # ios_url = utils.normalize_url(ios_url)
-                # assert utils.validate_url(ios_url) is True
-            if ios_fallback_url:
-                ios_fallback_url = utils.normalize_url(ios_fallback_url)
-                assert utils.validate_url(ios_fallback_url) is True
+            urls = self.normalize_urls(long_url, android_url, android_fallback_url, ios_url, ios_fallback_url)
         except Exception:
             logging.info('Wrong URL', exc_info=1)
             return self.finish({'status_code': 500, 'status_txt': 'INVALID_URI', 'data': []})
@@ -242,23 +555,180 @@ class ShortHandler(BaseHandler):
             return self.finish(
                 {'status_code': 500, 'status_txt': 'INVALID_ARG_DOMAIN', 'data': []})
 
+        # Store the link with a custom alias instead of a generated hash.
+        if alias is not None:
+            if not self.valid_alias(alias):
+                return self.finish({'status_code': 500, 'status_txt': 'INVALID_ARG_ALIAS', 'data': []})
+            if not (await self.reserve_urls([(alias, urls)]))[0]:
+                return self.finish({'status_code': 409, 'status_txt': 'ALIAS_TAKEN', 'data': []})
+            return self.finish({'status_code': 200, 'status_txt': 'OK', 'data': self.link_data(alias, urls, domain)})
+
+        # Reuse the hash of an identical link if deduplication is enabled.
+        digests = None
+        if self.settings['dedup']:
+            digests = [self.digest(urls, domain)]
+            url_hash = (await self.find_duplicates(digests))[0]
+            if url_hash:
+                return self.finish(
+                    {'status_code': 200, 'status_txt': 'OK', 'data': self.link_data(url_hash, urls, domain)})
+
         # Generate a unique hash, assemble short url and store result in Redis.
-        url_hash = utils.generate_hash(self.application.redis,
-                                       self.settings['redis_namespace'],
-                                       self.settings['hash_salt'])
-        short_url = 'http://' + domain + '/' + url_hash
-        self.store_url(url_hash, long_url, android_url,
-                       android_fallback_url, ios_url, ios_fallback_url)
+        url_hash = await self.application.hash_generator.generate()
+        await self.store_urls([(url_hash, urls)], digests)
 
         # Return success response.
-        data = {
+        self.finish({'status_code': 200, 'status_txt': 'OK', 'data': self.link_data(url_hash, urls, domain)})
+
+    def normalize_urls(self, long_url, android_url=None, android_fallback_url=None,
+                       ios_url=None, ios_fallback_url=None):
+        """
+        Normalizes and validates the URLs of a link. The Android and iOS URLs
+        may use custom schemes to open apps.
+
+        @returns: Returns the normalized URLs as a tuple like load_urls.
+        @raises: Raises an exception if an URL is invalid.
+        """
+        start = time.perf_counter() if self.trace is not None else None
+        try:
+            long_url = utils.parse_url(long_url)
+            if android_url:
+                android_url = utils.parse_url(android_url, app=True)
+            if android_fallback_url:
+                android_fallback_url = utils.parse_url(android_fallback_url)
+            if ios_url:
+                ios_url = utils.parse_url(ios_url, app=True)
+            if ios_fallback_url:
+                ios_fallback_url = utils.parse_url(ios_fallback_url)
+        finally:
+            if start is not None:
+                self.trace.add('normalize', time.perf_counter() - start)
+        return long_url, android_url, android_fallback_url, ios_url, ios_fallback_url
+
+    def valid_alias(self, alias):
+        """
+        Checks if a custom alias may be used as hash. Aliases must not shadow
+        other endpoints nor be valid generated hashes, which could be handed
+        out later.
+        """
+        return (isinstance(alias, str) and ALIAS_PATTERN.match(alias) is not None and alias not in RESERVED_ALIASES
+                and not self.application.hash_generator.hashids.decode(alias))
+
+    def digest(self, urls, domain):
+        """
+        Returns a compact digest of the normalized URLs and the domain of a
+        link, identifying identical links.
+        """
+        payload = '\n'.join(url or '' for url in urls + (domain,)).encode('utf-8')
+        return base64.urlsafe_b64encode(hashlib.sha1(payload).digest()).decode('ascii').rstrip('=')
+
+    async def find_duplicates(self, digests):
+        """
+        Looks up the hashes of links with the given digests.
+
+        @returns: Returns a list with the hash or None for every digest.
+        """
+        return await self.application.storage.find_digests(digests)
+
+    def link_data(self, url_hash, urls, domain):
+        """
+        Returns the response data for a shortened link.
+        """
+        long_url, android_url, android_fallback_url, ios_url, ios_fallback_url = urls
+        return {
             'long_url': long_url,
             'android_url': android_url,
             'android_fallback_url': android_fallback_url,
             'ios_url': ios_url,
             'ios_fallback_url': ios_fallback_url,
-            'url': short_url,
+            'url': 'http://' + domain + '/' + url_hash,
             'hash': url_hash,
             'global_hash': url_hash
         }
-        self.finish({'status_code': 200, 'status_txt': 'OK', 'data': data})
+
+
+class BatchShortHandler(ShortHandler):
+    """
+    Handles API requests for the /shorten/batch API endpoint.
+    """
+
+    async def post(self):
+        """
+        Given a JSON array or newline delimited JSON objects with the same
+        parameters as /shorten, returns a short URL for every entry in order.
+        """
+        try:
+            entries = utils.parse_json_entries(self.request.body)
+            assert all(isinstance(entry, dict) for entry in entries)
+        except Exception:
+            logging.info('Invalid batch', exc_info=1)
+            return self.finish({'status_code': 500, 'status_txt': 'INVALID_ARG_BATCH', 'data': []})
+        if not entries:
+            return self.finish({'status_code': 500, 'status_txt': 'MISSING_ARG_BATCH', 'data': []})
+        if len(entries) > self.settings['batch_limit']:
+            return self.finish({'status_code': 500, 'status_txt': 'BATCH_TOO_LARGE', 'data': []})
+        # Every entry counts as a request.
+        if not self.check_batch_rate_limit(len(entries)):
+            return
+
+        # Normalize and validate all entries.
+        results = []
+        links = []
+        aliased = []
+        valid_domains = {}
+        for entry in entries:
+            domain = entry.get('domain')
+            if domain is None:
+                domain = self.settings['default_domain']
+            try:
+                urls = self.normalize_urls(entry.get('longUrl'), entry.get('androidUrl'),
+                                           entry.get('androidFallbackUrl'), entry.get('iosUrl'),
+                                           entry.get('iosFallbackUrl'))
+            except Exception:
+                results.append({'error': 'INVALID_URI', 'long_url': entry.get('longUrl')})
+                continue
+            if isinstance(domain, str) and domain not in valid_domains:
+                valid_domains[domain] = utils.validate_url('http://' + domain)
+            if not isinstance(domain, str) or not valid_domains[domain]:
+                results.append({'error': 'INVALID_ARG_DOMAIN', 'long_url': entry.get('longUrl')})
+                continue
+            alias = entry.get('alias')
+            if alias is not None and not self.valid_alias(alias):
+                results.append({'error': 'INVALID_ARG_ALIAS', 'long_url': entry.get('longUrl')})
+                continue
+            results.append(None)
+            if alias is not None:
+                aliased.append((len(results) - 1, alias, urls, domain))
+            else:
+                links.append((len(results) - 1, urls, domain))
+
+        # Store the links with custom aliases, each alias taken reported as error.
+        if aliased:
+            reserved = await self.reserve_urls([(alias, urls) for i, alias, urls, domain in aliased])
+            for stored, (i, alias, urls, domain) in zip(reserved, aliased):
+                results[i] = (self.link_data(alias, urls, domain) if stored else
+                              {'error': 'ALIAS_TAKEN', 'long_url': entries[i].get('longUrl')})
+
+        # Reuse the hashes of identical links if deduplication is enabled.
+        digests = None
+        hashes = [None] * len(links)
+        if self.settings['dedup'] and links:
+            digests = [self.digest(urls, domain) for i, urls, domain in links]
+            hashes = await self.find_duplicates(digests)
+
+        # Generate all new hashes at once and store all new links in one
+        # pipeline. Identical links within the batch share one hash.
+        new = {}
+        for j, url_hash in enumerate(hashes):
+            if not url_hash:
+                new.setdefault(digests[j] if digests else j, []).append(j)
+        generated = await self.application.hash_generator.generate_many(len(new))
+        for url_hash, indices in zip(generated, new.values()):
+            for j in indices:
+                hashes[j] = url_hash
+        stored = [indices[0] for indices in new.values()]
+        await self.store_urls([(hashes[j], links[j][1]) for j in stored],
+                              [digests[j] for j in stored] if digests else None)
+        for url_hash, (i, urls, domain) in zip(hashes, links):
+            results[i] = self.link_data(url_hash, urls, domain)
+
+        self.finish({'status_code': 200, 'status_txt': 'OK', 'data': {'shorten': results}})
@@ -0,0 +1,295 @@
+import logging
+import sys
+import time
+import urllib.parse
+
+import tornado.options
+
+from .dump import connect
+from .storage import LEGACY_SUFFIXES, HashRing, parse_node
+from .utils import get_hashids
+
+# Define command line parameters in addition to the ones of the application.
+tornado.options.define('maintain_batch', type=int, default=100,
+                       help='The largest number of keys scanned or changed per redis round trip')
+tornado.options.define('maintain_rate', type=float, default=1000,
+                       help='The number of keys per second scanned or changed at most, 0 meaning no limit')
+tornado.options.define('maintain_budget', type=float, default=5,
+                       help='The time in milliseconds a round trip may take before batches get smaller')
+tornado.options.define('maintain_dry_run', type=bool, default=False,
+                       help='Count the keys that would be changed without changing them')
+tornado.options.define('expire_counters', type=bool, default=True,
+                       help='Delete hash day counters older than counter_days days')
+tornado.options.define('counter_days', type=int, default=2,
+                       help='The number of past days whose hash day counters are kept')
+tornado.options.define('apply_ttl', type=bool, default=False,
+                       help='Apply the ttl to all existing links, counted from the day of their hash')
+tornado.options.define('purge_pattern', type=str, default='',
+                       help='Delete all links whose hash matches this glob-style pattern')
+tornado.options.define('purge_domain', type=str, default='',
+                       help='Delete all links whose long URL is on this domain or its subdomains')
+
+
+class Throttle(object):
+    """
+    Paces a walk through the keyspace so it does not slow down redis for the
+    application: at most rate keys per second are scanned or changed, and the
+    batch size is halved whenever a round trip takes longer than budget
+    seconds and doubled again up to max_batch while round trips are fast.
+    """
+
+    def __init__(self, rate=1000, budget=0.005, max_batch=100):
+        self.rate = rate
+        self.budget = budget
+        self.max_batch = max(max_batch, 1)
+        self.batch = self.max_batch
+        self.round_trips = 0
+        self.slow_round_trips = 0
+
+    def pace(self, keys, duration):
+        """
+        Adapts the batch size to the duration of a round trip handling the
+        given number of keys and sleeps for the rest of its share of time.
+        """
+        self.round_trips += 1
+        if self.budget and duration > self.budget:
+            self.slow_round_trips += 1
+            self.batch = max(self.batch // 2, 1)
+        elif self.batch < self.max_batch:
+            self.batch = min(self.batch * 2, self.max_batch)
+        if self.rate:
+            time.sleep(max(keys / self.rate - duration, 0))
+
+
+def walk(connection, match, throttle):
+    """
+    Yields batches of keys matching the given pattern with one paced SCAN per
+    batch.
+    """
+    cursor = 0
+    while True:
+        start = time.monotonic()
+        cursor, keys = connection.scan(cursor, match=match, count=throttle.batch)
+        throttle.pace(len(keys), time.monotonic() - start)
+        if keys:
+            yield keys
+        if not cursor:
+            break
+
+
+def execute_each(connection, throttle, command, items):
+    """
+    Calls the given pipeline command for every item, e.g. a key or a tuple of
+    arguments, in paced pipelines of at most throttle.batch commands.
+
+    @returns: Returns the results in order.
+    """
+    results = []
+    for i in range(0, len(items), throttle.batch):
+        pipe = connection.pipeline(transaction=False)
+        pipe_items = items[i:i + throttle.batch]
+        for item in pipe_items:
+            getattr(pipe, command)(*(item if isinstance(item, tuple) else (item,)))
+        start = time.monotonic()
+        results.extend(pipe.execute())
+        throttle.pace(len(pipe_items), time.monotonic() - start)
+    return results
+
+
+def record_changes(connection, namespace, throttle, changelog_size, url_hashes):
+    """
+    Appends the given changed links to the changelog CHANGES followed by
+    local stores, if changelog_size is set.
+    """
+    if changelog_size and url_hashes:
+        execute_each(connection, throttle, 'xadd', [(namespace + 'CHANGES', {'h': url_hash}, '*', changelog_size)
+                                                    for url_hash in url_hashes])
+
+
+def expire_counters(connection, namespace, throttle, keep_days=2, dry_run=False):
+    """
+    Deletes the counters HI:<day> and HI:<day>:unused of days more than
+    keep_days days ago. New hashes are only ever generated for the current
+    day, so these counters are not needed anymore.
+
+    @returns: Returns the number of counters deleted.
+    """
+    oldest = int(time.time() / 86400) - keep_days
+    prefix = namespace + 'HI:'
+    deleted = 0
+    for keys in walk(connection, prefix + '*', throttle):
+        stale = [key for key in keys if key[len(prefix):].split(':')[0].isdigit() and
+                 int(key[len(prefix):].split(':')[0]) < oldest]
+        if stale and not dry_run:
+            execute_each(connection, throttle, 'delete', stale)
+        deleted += len(stale)
+    return deleted
+
+
+def apply_ttl(connection, namespace, ttl, throttle, hash_salt='', dry_run=False, changelog_size=0):
+    """
+    Applies a changed ttl in days to all links, their click counters and
+    their dedup digests. Links expire ttl days after the day encoded in their
+    hash, so links older than that are deleted right away. Links with other
+    hashes expire ttl days from now unless they already expire earlier. A ttl
+    of 0 makes all links persistent.
+    Changed links are recorded in the changelog if changelog_size is set.
+
+    @returns: Returns the number of keys updated.
+    """
+    hashids = get_hashids(hash_salt)
+    now = int(time.time())
+
+    def expire_at(url_hash):
+        decoded = hashids.decode(url_hash)
+        return (decoded[0] + ttl) * 86400 if len(decoded) == 2 else None
+
+    def update(keys, url_hashes):
+        if dry_run:
+            return
+        if not ttl:
+            execute_each(connection, throttle, 'persist', keys)
+            return
+        expiry = [expire_at(url_hash) for url_hash in url_hashes]
+        # Custom hashes carry no creation day, so they keep an earlier expiry
+        # instead of getting a new one on every run.
+        custom = [i for i, expire in enumerate(expiry) if expire is None]
+        remaining = execute_each(connection, throttle, 'ttl', [keys[i] for i in custom])
+        for i, seconds in zip(custom, remaining):
+            expiry[i] = now + (min(seconds, ttl * 86400) if seconds >= 0 else ttl * 86400)
+        execute_each(connection, throttle, 'expireat', list(zip(keys, expiry)))
+
+    updated = 0
+    # Keys named by the hash of their link, i.e. <prefix><hash>[:<suffix>].
+    for prefix, is_link in ((namespace + 'LINK:', True), (namespace + 'STATS:', False),
+                            (namespace + 'URLS:', True)):
+        for keys in walk(connection, prefix + '*', throttle):
+            url_hashes = [key[len(prefix):].split(':')[0] for key in keys]
+            update(keys, url_hashes)
+            if is_link and not dry_run:
+                # Legacy links have one key per URL.
+                record_changes(connection, namespace, throttle, changelog_size, list(dict.fromkeys(url_hashes)))
+            updated += len(keys)
+    # Digests hold the hash of their link.
+    for keys in walk(connection, namespace + 'DIGEST:*', throttle):
+        url_hashes = execute_each(connection, throttle, 'get', keys)
+        found = [(key, url_hash) for key, url_hash in zip(keys, url_hashes) if url_hash]
+        update([key for key, url_hash in found], [url_hash for key, url_hash in found])
+        updated += len(found)
+    return updated
+
+
+def on_domain(url, domain):
+    """
+    Checks if the given URL is on the given domain or one of its subdomains.
+    """
+    try:
+        hostname = urllib.parse.urlsplit(url).hostname or ''
+    except ValueError:
+        return False
+    domain = domain.lower()
+    return hostname == domain or hostname.endswith('.' + domain)
+
+
+def purge(connection, namespace, throttle, pattern='*', domain=None, dry_run=False, stats_connection=None,
+          changelog_size=0):
+    """
+    Deletes all links whose hash matches the given glob-style pattern and, if
+    given, whose long URL is on the given domain, including links in the
+    legacy layout and their click counters, which are kept in the given
+    stats_connection if links are sharded. Deleted links are recorded in the
+    changelog if changelog_size is set.
+
+    @returns: Returns the number of links deleted.
+    """
+    deleted = 0
+    for prefix, field in ((namespace + 'LINK:', 'l'), (namespace + 'URLS:', None)):
+        for keys in walk(connection, prefix + pattern, throttle):
+            # Legacy links have one key per URL, the long URL has no suffix.
+            keys = [key for key in keys if ':' not in key[len(prefix):]]
+            if domain:
+                if field:
+                    urls = execute_each(connection, throttle, 'hget', [(key, field) for key in keys])
+                else:
+                    urls = execute_each(connection, throttle, 'get', keys)
+                keys = [key for key, url in zip(keys, urls) if url and on_domain(url, domain)]
+            if not keys:
+                continue
+            if not dry_run:
+                execute_each(connection, throttle, 'delete', [
+                    (key,) if field else tuple(key + suffix for suffix in LEGACY_SUFFIXES) for key in keys])
+                execute_each(stats_connection or connection, throttle, 'delete',
+                             [namespace + 'STATS:' + key[len(prefix):] for key in keys])
+                record_changes(connection, namespace, throttle, changelog_size, [key[len(prefix):] for key in keys])
+            deleted += len(keys)
+    return deleted
+
+
+def purge_digests(connections, namespace, throttle, owner=None, dry_run=False):
+    """
+    Deletes dedup digests of links that do not exist anymore, so purged links
+    are not handed out again. Connections are given as a dict {name:
+    connection}, owner returns the name of the node storing a link.
+
+    @returns: Returns the number of digests deleted.
+    """
+    deleted = 0
+    for connection in connections.values():
+        for keys in walk(connection, namespace + 'DIGEST:*', throttle):
+            url_hashes = execute_each(connection, throttle, 'get', keys)
+            by_owner = {}
+            for key, url_hash in zip(keys, url_hashes):
+                if url_hash:
+                    by_owner.setdefault(owner(url_hash) if owner else None, []).append((key, url_hash))
+            dangling = []
+            for name, digests in by_owner.items():
+                link_connection = connections[name] if name else connection
+                exists = execute_each(link_connection, throttle, 'exists', [
+                    (namespace + 'LINK:' + url_hash, namespace + 'URLS:' + url_hash) for key, url_hash in digests])
+                dangling.extend(key for (key, url_hash), found in zip(digests, exists) if not found)
+            if dangling and not dry_run:
+                execute_each(connection, throttle, 'delete', dangling)
+            deleted += len(dangling)
+    return deleted
+
+
+def maintain_main():
+    """
+    Main function to expire hash day counters, apply a changed ttl to existing
+    links and purge links, walking the keyspace in small paced batches.
+    """
+    tornado.options.parse_command_line()
+    options = tornado.options.options
+    throttle = Throttle(options.maintain_rate, options.maintain_budget / 1000, options.maintain_batch)
+    namespace = options.redis_namespace
+    dry_run = options.maintain_dry_run
+    # Links may be sharded, hash day counters and clicks are kept in the primary redis.
+    primary = connect(options)
+    primary_name = '{}:{}/{}'.format(options.redis_host, options.redis_port, options.redis_db)
+    nodes = [node for node in options.redis_nodes.split(',') if node]
+    if nodes:
+        connections = {'{}:{}/{}'.format(*parse_node(node)): connect(options, node) for node in nodes}
+        owner = HashRing(list(connections)).get
+    else:
+        connections = {primary_name: primary}
+        owner = None
+    purging = options.purge_pattern or options.purge_domain
+    if options.purge_pattern == '*' and not options.purge_domain:
+        logging.error('Refusing to purge all links')
+        sys.exit(1)
+
+    results = {}
+    if options.expire_counters:
+        results['counters_deleted'] = expire_counters(primary, namespace, throttle, options.counter_days, dry_run)
+    if options.apply_ttl:
+        results['ttl_applied'] = sum(apply_ttl(connection, namespace, options.ttl, throttle, options.salt, dry_run,
+                                               options.changelog_size)
+                                     for connection in list(connections.values()) +
+                                     ([primary] if primary_name not in connections else []))
+    if purging:
+        results['links_purged'] = sum(purge(connection, namespace, throttle, options.purge_pattern or '*',
+                                            options.purge_domain or None, dry_run, primary, options.changelog_size)
+                                      for connection in connections.values())
+        results['digests_purged'] = purge_digests(connections, namespace, throttle, owner, dry_run)
+    logging.info('{}{} in {} round trips, {} over budget'.format(
+        'Dry run: ' if dry_run else '', results, throttle.round_trips, throttle.slow_round_trips))
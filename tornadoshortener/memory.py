@@ -0,0 +1,346 @@
+import fnmatch
+import time
+
+import redis.exceptions
+import tornado.gen
+
+from .storage import RESERVE_SCRIPT, stream_id
+
+# Commands implemented by MemoryRedis, called like the methods of the asyncio
+# redis client with decode_responses enabled.
+COMMANDS = frozenset((
+    'get', 'set', 'delete', 'exists', 'expire', 'expireat', 'pexpireat', 'ttl', 'pttl', 'incr', 'incrby',
+    'hset', 'hget', 'hgetall', 'hdel', 'hincrby', 'zincrby', 'zrevrange', 'zremrangebyrank', 'xadd', 'xrange',
+    'xrevrange', 'xread', 'scan', 'info', 'flushdb', 'ping', 'eval',
+))
+
+
+class SortedSet(dict):
+    """
+    The scores of a sorted set by member.
+    """
+
+
+class MemoryRedis(object):
+    """
+    An in-process stand-in for the asyncio redis client, implementing the
+    strings, hashes, sorted sets, streams and expiry commands used by this application
+    with the semantics of redis. Pipelines are executed at once and are
+    atomic like MULTI. Every call or pipeline waits for the given latency in
+    seconds first, e.g. to simulate network round trips.
+
+    Everything is lost when the process exits and nothing is shared between
+    processes.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.commands = 0
+        self._data = {}
+        self._expires = {}
+        self._writes = 0
+
+    def __getattr__(self, name):
+        if name not in COMMANDS:
+            raise AttributeError(name)
+
+        async def command(*args, **kwargs):
+            if self.latency:
+                await tornado.gen.sleep(self.latency)
+            return self.execute_command(name, *args, **kwargs)
+        return command
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def execute_command(self, name, *args, **kwargs):
+        self.commands += 1
+        return getattr(self, '_' + name)(*args, **kwargs)
+
+    def _exists_key(self, key):
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.time():
+            self._remove(key)
+        return key in self._data
+
+    def _remove(self, key):
+        self._data.pop(key, None)
+        self._expires.pop(key, None)
+
+    def _value(self, key, kind, default=None):
+        if not self._exists_key(key):
+            return default
+        value = self._data[key]
+        if type(value) is not kind:
+            raise redis.exceptions.ResponseError(
+                'WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    def _write(self, key, value):
+        self._data[key] = value
+        # Purge expired keys nobody reads once in a while, amortized over all writes.
+        self._writes += 1
+        if self._writes > max(len(self._data), 1000):
+            self._writes = 0
+            now = time.time()
+            for expired in [key for key, expires in self._expires.items() if expires <= now]:
+                self._remove(expired)
+
+    # Strings.
+
+    def _get(self, key):
+        return self._value(key, str)
+
+    def _set(self, key, value, ex=None, px=None, nx=False, xx=False, keepttl=False, exat=None, pxat=None):
+        exists = self._exists_key(key)
+        if (nx and exists) or (xx and not exists):
+            return None
+        self._write(key, str(value))
+        if not keepttl:
+            self._expires.pop(key, None)
+        if ex is not None:
+            self._expires[key] = time.time() + ex
+        elif px is not None:
+            self._expires[key] = time.time() + px / 1000
+        elif exat is not None:
+            self._expires[key] = exat
+        elif pxat is not None:
+            self._expires[key] = pxat / 1000
+        return True
+
+    def _incrby(self, key, amount=1):
+        try:
+            value = int(self._value(key, str, '0')) + amount
+        except ValueError:
+            raise redis.exceptions.ResponseError('value is not an integer or out of range')
+        self._write(key, str(value))
+        return value
+
+    _incr = _incrby
+
+    # Keys and expiry.
+
+    def _delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            if self._exists_key(key):
+                self._remove(key)
+                deleted += 1
+        return deleted
+
+    def _exists(self, *keys):
+        return sum(1 for key in keys if self._exists_key(key))
+
+    def _pexpireat(self, key, when):
+        if not self._exists_key(key):
+            return False
+        self._expires[key] = when / 1000
+        self._exists_key(key)
+        return True
+
+    def _expireat(self, key, when):
+        if hasattr(when, 'timestamp'):
+            when = when.timestamp()
+        return self._pexpireat(key, when * 1000)
+
+    def _expire(self, key, seconds):
+        if hasattr(seconds, 'total_seconds'):
+            seconds = seconds.total_seconds()
+        return self._pexpireat(key, (time.time() + seconds) * 1000)
+
+    def _pttl(self, key):
+        if not self._exists_key(key):
+            return -2
+        expires = self._expires.get(key)
+        if expires is None:
+            return -1
+        return int((expires - time.time()) * 1000)
+
+    def _ttl(self, key):
+        pttl = self._pttl(key)
+        return pttl if pttl < 0 else (pttl + 500) // 1000
+
+    def _scan(self, cursor=0, match=None, count=None, _type=None):
+        # Returns all keys at once.
+        return 0, [key for key in list(self._data) if self._exists_key(key) and
+                   (match is None or fnmatch.fnmatchcase(key, match))]
+
+    def _info(self, section=None):
+        return {'total_commands_processed': self.commands, 'db0': {'keys': len(self._data)}}
+
+    def _eval(self, script, numkeys, *keys_and_args):
+        # Scripts are implemented in Python, looked up by their source.
+        function = {RESERVE_SCRIPT: self._reserve}.get(script)
+        if function is None:
+            raise redis.exceptions.ResponseError('Unknown script')
+        return function(keys_and_args[:numkeys], keys_and_args[numkeys:])
+
+    def _reserve(self, keys, args):
+        if any(self._exists_key(key) for key in keys):
+            return 0
+        self._hset(keys[0], mapping=dict(zip(args[1::2], args[2::2])))
+        if str(args[0]) != '0':
+            self._expireat(keys[0], int(args[0]))
+        return 1
+
+    def _ping(self):
+        return True
+
+    def _flushdb(self, asynchronous=False):
+        self._data.clear()
+        self._expires.clear()
+        return True
+
+    # Hashes.
+
+    def _hset(self, name, key=None, value=None, mapping=None):
+        fields = self._value(name, dict)
+        if fields is None:
+            fields = {}
+            self._write(name, fields)
+        items = dict(mapping or {}, **({key: value} if key is not None else {}))
+        added = sum(1 for field in items if field not in fields)
+        fields.update((field, str(value)) for field, value in items.items())
+        return added
+
+    def _hget(self, name, key):
+        return self._value(name, dict, {}).get(key)
+
+    def _hgetall(self, name):
+        return dict(self._value(name, dict, {}))
+
+    def _hdel(self, name, *keys):
+        fields = self._value(name, dict, {})
+        deleted = sum(1 for key in keys if fields.pop(key, None) is not None)
+        if not fields:
+            self._remove(name)
+        return deleted
+
+    def _hincrby(self, name, key, amount=1):
+        fields = self._value(name, dict)
+        if fields is None:
+            fields = {}
+            self._write(name, fields)
+        fields[key] = str(int(fields.get(key, 0)) + amount)
+        return int(fields[key])
+
+    # Sorted sets.
+
+    def _zincrby(self, name, amount, value):
+        scores = self._value(name, SortedSet)
+        if scores is None:
+            scores = SortedSet()
+            self._write(name, scores)
+        scores[value] = scores.get(value, 0) + amount
+        return scores[value]
+
+    def _ranked(self, name):
+        # Members by ascending score, members with equal scores in lexicographical order.
+        return sorted(self._value(name, SortedSet, {}).items(), key=lambda item: (item[1], item[0]))
+
+    @staticmethod
+    def _ranks(length, start, end):
+        if start < 0:
+            start = max(length + start, 0)
+        if end < 0:
+            end += length
+        return start, min(end, length - 1) + 1
+
+    def _zrevrange(self, name, start, end, withscores=False, score_cast_func=float):
+        ranked = self._ranked(name)[::-1]
+        start, stop = self._ranks(len(ranked), start, end)
+        ranked = ranked[start:stop]
+        if withscores:
+            return [(member, score_cast_func(score)) for member, score in ranked]
+        return [member for member, score in ranked]
+
+    def _zremrangebyrank(self, name, min, max):
+        ranked = self._ranked(name)
+        start, stop = self._ranks(len(ranked), min, max)
+        removed = ranked[start:stop]
+        if removed:
+            scores = self._data[name]
+            for member, score in removed:
+                del scores[member]
+            if not scores:
+                self._remove(name)
+        return len(removed)
+
+    # Streams, stored as lists of (id, fields) in order.
+
+    def _xadd(self, name, fields, id='*', maxlen=None, approximate=True, nomkstream=False, minid=None,
+              limit=None):
+        entries = self._value(name, list)
+        if entries is None:
+            entries = []
+            self._write(name, entries)
+        milliseconds = int(time.time() * 1000)
+        sequence = 0
+        if entries:
+            last = stream_id(entries[-1][0])
+            if milliseconds <= last[0]:
+                milliseconds, sequence = last[0], last[1] + 1
+        entry_id = '{}-{}'.format(milliseconds, sequence)
+        entries.append((entry_id, {str(key): str(value) for key, value in fields.items()}))
+        if maxlen is not None and len(entries) > maxlen:
+            del entries[:len(entries) - maxlen]
+        return entry_id
+
+    def _xrange(self, name, min='-', max='+', count=None):
+        low = (0, 0) if min == '-' else stream_id(min)
+        high = None if max == '+' else stream_id(max)
+        entries = [(entry_id, dict(fields)) for entry_id, fields in self._value(name, list, [])
+                   if low <= stream_id(entry_id) and (high is None or stream_id(entry_id) <= high)]
+        return entries[:count] if count else entries
+
+    def _xrevrange(self, name, max='+', min='-', count=None):
+        entries = self._xrange(name, min, max)[::-1]
+        return entries[:count] if count else entries
+
+    def _xread(self, streams, count=None, block=None):
+        result = []
+        for name, last_id in streams.items():
+            last = stream_id(last_id)
+            entries = [(entry_id, dict(fields)) for entry_id, fields in self._value(name, list, [])
+                       if stream_id(entry_id) > last]
+            if entries:
+                result.append([name, entries[:count] if count else entries])
+        return result
+
+
+class MemoryPipeline(object):
+    """
+    Buffers commands like a redis pipeline and executes them at once.
+    """
+
+    def __init__(self, memory_redis):
+        self.redis = memory_redis
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __getattr__(self, name):
+        if name not in COMMANDS:
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return command
+
+    async def execute(self, raise_on_error=True):
+        if self.redis.latency:
+            await tornado.gen.sleep(self.redis.latency)
+        commands, self.commands = self.commands, []
+        results = []
+        for name, args, kwargs in commands:
+            try:
+                results.append(self.redis.execute_command(name, *args, **kwargs))
+            except redis.exceptions.ResponseError as e:
+                results.append(e)
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
@@ -0,0 +1,226 @@
+import bisect
+import glob
+import json
+import logging
+import os
+import time
+
+import tornado.ioloop
+
+from . import profiling
+from . import utils
+
+# Prefix of all metric names.
+PREFIX = 'tornadoshortener_'
+
+# Upper bounds of the histogram buckets for latencies in seconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Upper bounds of the histogram buckets for the number of commands in a redis pipeline.
+SIZE_BUCKETS = (1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+
+class Histogram(object):
+    """
+    A histogram counting observations per bucket. Buckets are not cumulative,
+    they are summed up when rendered.
+    """
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """
+    Collects counters, gauges and histograms of a single process. All updates
+    happen on the IOLoop thread, so plain dicts are used without any locking.
+    Metrics are keyed by name and a tuple of (label, value) pairs.
+
+    In multi-process deployments every process periodically writes a snapshot
+    to the given directory and the metrics of all processes are merged when
+    rendered, no matter which process serves the /metrics request.
+    """
+
+    def __init__(self, path=None, interval=5):
+        self.path = path
+        self.interval = interval
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+        self._periodic = None
+
+    def inc(self, name, labels=(), value=1):
+        """
+        Increments a counter.
+        """
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels=()):
+        """
+        Sets a gauge.
+        """
+        self.gauges[(name, labels)] = value
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        """
+        Records an observation, e.g. a latency in seconds, in a histogram.
+        """
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram(buckets)
+        histogram.observe(value)
+
+    def add_collector(self, collector):
+        """
+        Adds a function called with this instance before every snapshot, e.g.
+        to copy cache statistics into counters and gauges.
+        """
+        self.collectors.append(collector)
+
+    async def execute(self, pipe, operation):
+        """
+        Executes a redis pipeline and records its latency and size, in the
+        trace of the current request as well if slow requests are logged.
+        """
+        labels = (('operation', operation),)
+        size = len(pipe)
+        start = time.perf_counter()
+        try:
+            return await utils.maybe_await(pipe.execute())
+        finally:
+            duration = time.perf_counter() - start
+            self.observe('redis_duration_seconds', duration, labels)
+            profiling.record_phase('redis:' + operation, duration)
+            self.observe('redis_pipeline_commands', size, labels, SIZE_BUCKETS)
+
+    def snapshot(self):
+        """
+        Returns all metrics of this process as a JSON serializable dict.
+        """
+        for collector in self.collectors:
+            collector(self)
+        return {
+            'time': time.time(),
+            'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+            'gauges': [[name, labels, value] for (name, labels), value in self.gauges.items()],
+            'histograms': [[name, labels, histogram.buckets, histogram.counts, histogram.sum]
+                           for (name, labels), histogram in self.histograms.items()],
+        }
+
+    def start(self):
+        """
+        Starts writing snapshots periodically if a directory is configured.
+        """
+        if self.path and not self._periodic:
+            os.makedirs(self.path, exist_ok=True)
+            self._periodic = tornado.ioloop.PeriodicCallback(self.write_snapshot, self.interval * 1000)
+            self._periodic.start()
+
+    def stop(self):
+        if self._periodic:
+            self._periodic.stop()
+            self._periodic = None
+        if self.path:
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        filename = os.path.join(self.path, 'metrics.{}.json'.format(os.getpid()))
+        try:
+            with open(filename + '.tmp', 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(filename + '.tmp', filename)
+        except OSError:
+            logging.warning('Could not write metrics snapshot', exc_info=1)
+
+    def read_snapshots(self):
+        """
+        Returns the snapshots of all processes. Snapshots of exited processes
+        are kept so counters never go backwards.
+        """
+        self.write_snapshot()
+        snapshots = []
+        for filename in glob.glob(os.path.join(self.path, 'metrics.*.json')):
+            try:
+                with open(filename) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                logging.warning('Could not read metrics snapshot %s', filename, exc_info=1)
+        return snapshots
+
+    def render(self):
+        """
+        Returns the metrics of all processes in the Prometheus text format.
+        """
+        snapshots = self.read_snapshots() if self.path else [self.snapshot()]
+        return render(merge(snapshots, time.time() - 3 * self.interval))
+
+
+def merge(snapshots, gauges_since=0):
+    """
+    Merges the snapshots of many processes by summing up all values. Gauges
+    are only taken from snapshots written after gauges_since, as the gauges
+    of exited processes are meaningless.
+    """
+    counters = {}
+    gauges = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        if snapshot['time'] >= gauges_since:
+            for name, labels, value in snapshot['gauges']:
+                key = (name, tuple(map(tuple, labels)))
+                gauges[key] = gauges.get(key, 0) + value
+        for name, labels, buckets, counts, total in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram(tuple(buckets))
+            histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+            histogram.sum += total
+    return counters, gauges, histograms
+
+
+def format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for label, value in labels) + '}'
+
+
+def render(merged):
+    """
+    Renders merged metrics in the Prometheus text exposition format.
+    """
+    counters, gauges, histograms = merged
+    lines = []
+    for kind, values in (('counter', counters), ('gauge', gauges)):
+        last_name = None
+        for (name, labels), value in sorted(values.items()):
+            if name != last_name:
+                lines.append('# TYPE {}{} {}'.format(PREFIX, name, kind))
+                last_name = name
+            lines.append('{}{}{} {}'.format(PREFIX, name, format_labels(labels), value))
+    last_name = None
+    for (name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+        if name != last_name:
+            lines.append('# TYPE {}{} histogram'.format(PREFIX, name))
+            last_name = name
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+            cumulative += count
+            lines.append('{}{}_bucket{} {}'.format(PREFIX, name, format_labels(labels, (('le', bound),)), cumulative))
+        lines.append('{}{}_sum{} {}'.format(PREFIX, name, format_labels(labels), histogram.sum))
+        lines.append('{}{}_count{} {}'.format(PREFIX, name, format_labels(labels), cumulative))
+    return '\n'.join(lines) + '\n'
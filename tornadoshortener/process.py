@@ -0,0 +1,75 @@
+import logging
+import os
+import signal
+import sys
+
+import tornado.process
+
+
+def fork_workers(num_processes, max_restarts=100):
+    """
+    Forks the given number of worker processes, 0 meaning one per CPU, and
+    supervises them like tornado.process.fork_processes: workers exiting
+    abnormally are restarted. In addition SIGTERM and SIGINT received by the
+    parent are forwarded to all workers so they can shut down gracefully.
+
+    @returns: Returns the task id of the worker (0 to num_processes - 1) in each
+              worker process. The parent process exits once all workers exited.
+    """
+    if not num_processes or num_processes <= 0:
+        num_processes = tornado.process.cpu_count()
+    logging.info('Starting {} worker processes'.format(num_processes))
+
+    children = {}
+    stopping = []
+    original_handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+
+    def forward_signal(signum, frame):
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def start_child(task_id):
+        pid = os.fork()
+        if pid == 0:
+            # Workers install their own handlers for graceful shutdown.
+            for signum, handler in original_handlers.items():
+                signal.signal(signum, handler)
+            return True
+        children[pid] = task_id
+        return False
+
+    for signum in original_handlers:
+        signal.signal(signum, forward_signal)
+    for i in range(num_processes):
+        if start_child(i):
+            return i
+
+    restarts = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        if pid not in children:
+            continue
+        task_id = children.pop(pid)
+        if os.WIFSIGNALED(status):
+            logging.warning('Worker {} (pid {}) killed by signal {}'.format(task_id, pid, os.WTERMSIG(status)))
+        elif os.WEXITSTATUS(status) != 0:
+            logging.warning('Worker {} (pid {}) exited with status {}'.format(
+                task_id, pid, os.WEXITSTATUS(status)))
+        else:
+            logging.info('Worker {} (pid {}) exited normally'.format(task_id, pid))
+            continue
+        if stopping:
+            continue
+        restarts += 1
+        if restarts > max_restarts:
+            raise RuntimeError('Too many worker restarts, giving up')
+        if start_child(task_id):
+            return task_id
+    sys.exit(0)
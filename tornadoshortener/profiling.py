@@ -0,0 +1,90 @@
+import collections
+import contextvars
+import os
+import sys
+import threading
+
+import tornado.gen
+
+# The trace of the request handled in the current context, None unless slow
+# requests are logged.
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class RequestTrace(object):
+    """
+    Sums up the time spent per phase of a request, e.g. redis:load_urls,
+    render or json, to log slow requests with a breakdown.
+    """
+    __slots__ = ('phases',)
+
+    def __init__(self):
+        self.phases = {}
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def format(self, total):
+        """
+        Returns the phases in milliseconds, the remaining time as other.
+        """
+        other = total - sum(self.phases.values())
+        return ' '.join('{}={:.2f}ms'.format(phase, seconds * 1000)
+                        for phase, seconds in sorted(self.phases.items()) + [('other', other)])
+
+
+def record_phase(phase, seconds):
+    """
+    Adds the time of a phase to the trace of the current request if any.
+    """
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(phase, seconds)
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stack of the IOLoop thread from a background thread while
+    profiling and counts identical stacks. The result is in the collapsed
+    stack format of flamegraph.pl and speedscope, one line per stack with
+    frames separated by semicolons followed by the number of samples.
+    No thread runs and nothing is sampled unless a profile is requested.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.running = False
+
+    async def profile(self, seconds, interval=None):
+        """
+        Profiles the calling thread for the given time in seconds.
+
+        @returns: Returns the collapsed stacks as a string.
+        """
+        if self.running:
+            raise RuntimeError('Already profiling')
+        self.running = True
+        counts = collections.Counter()
+        stop = threading.Event()
+        thread = threading.Thread(target=self._sample, name='profiler', daemon=True,
+                                  args=(threading.get_ident(), interval or self.interval, stop, counts))
+        thread.start()
+        try:
+            await tornado.gen.sleep(seconds)
+        finally:
+            stop.set()
+            thread.join()
+            self.running = False
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in counts.most_common())
+
+    @staticmethod
+    def _sample(thread_id, interval, stop, counts):
+        while not stop.wait(interval):
+            frame = sys._current_frames().get(thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if frames:
+                counts[';'.join(reversed(frames))] += 1
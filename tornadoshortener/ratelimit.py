@@ -0,0 +1,147 @@
+import collections
+import logging
+import time
+
+import tornado.ioloop
+
+from . import utils
+
+
+class Bucket(object):
+    """
+    The token bucket of a client for a route.
+    """
+    __slots__ = ('tokens', 'updated', 'consumed', 'window', 'own', 'foreign')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        # Tokens consumed since the last sync.
+        self.consumed = 0
+        # Tokens consumed in the current sync window by this process and others.
+        self.window = None
+        self.own = 0
+        self.foreign = 0
+
+
+class RateLimiter(object):
+    """
+    Limits requests per client and route with token buckets held in process
+    memory, so checking a limit never costs a redis round trip. Limits are
+    given as a dict {route: (rate, burst)} with the rate in requests per
+    second and the burst as the bucket size.
+
+    Every sync_interval seconds the tokens consumed by each client are added
+    to a redis hash RL:<route>:<window> shared by all processes, which returns
+    the consumption of all processes in the current window. Tokens consumed by
+    other processes are then taken from the local bucket, so the limits hold
+    across processes and nodes up to one sync interval.
+    """
+
+    def __init__(self, redis_connection, limits, redis_namespace='SHORT:', sync_interval=1, window=60,
+                 max_buckets=100000, metrics=None):
+        self.redis = redis_connection
+        self.limits = {route: limit for route, limit in limits.items() if limit and limit[0] > 0}
+        self.redis_namespace = redis_namespace
+        self.sync_interval = sync_interval
+        self.window = window
+        self.max_buckets = max_buckets
+        self.metrics = metrics
+        self.rejected = 0
+        self._buckets = collections.OrderedDict()
+        self._periodic = None
+        self._syncing = False
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def consume(self, route, client, tokens=1):
+        """
+        Takes the given number of tokens from the bucket of the client. Never
+        more than the burst is taken, so large requests stay possible.
+
+        @returns: Returns 0 if the request is allowed, otherwise the time in
+                  seconds until enough tokens are available.
+        """
+        limit = self.limits.get(route)
+        if not limit:
+            return 0
+        rate, burst = limit
+        tokens = min(tokens, burst)
+        now = time.monotonic()
+        key = (route, client)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = Bucket(burst, now)
+            if len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+            bucket.updated = now
+        if bucket.tokens < tokens:
+            self.rejected += 1
+            return (tokens - bucket.tokens) / rate
+        bucket.tokens -= tokens
+        bucket.consumed += tokens
+        return 0
+
+    async def sync(self):
+        """
+        Shares the tokens consumed since the last sync with all processes
+        through redis and takes the tokens consumed by other processes from
+        the local buckets.
+        """
+        if self._syncing or not self._buckets:
+            return
+        self._syncing = True
+        try:
+            await self._sync()
+        except Exception:
+            logging.warning('Could not sync rate limits', exc_info=1)
+        finally:
+            self._syncing = False
+
+    async def _sync(self):
+        window = int(time.time() / self.window)
+        now = time.monotonic()
+        active = []
+        pipe = self.redis.pipeline(transaction=False)
+        for (route, client), bucket in list(self._buckets.items()):
+            rate, burst = self.limits[route]
+            if bucket.window != window:
+                bucket.window, bucket.own, bucket.foreign = window, 0, 0
+            if not bucket.consumed and bucket.tokens + (now - bucket.updated) * rate >= burst:
+                # Idle buckets are full again and forgotten.
+                del self._buckets[(route, client)]
+                continue
+            key = '{}RL:{}:{}'.format(self.redis_namespace, route, window)
+            pipe.hincrby(key, client, bucket.consumed)
+            pipe.expire(key, self.window * 2)
+            bucket.own += bucket.consumed
+            bucket.consumed = 0
+            active.append(bucket)
+        if not active:
+            return
+        if self.metrics:
+            result = await self.metrics.execute(pipe, 'sync_rate_limits')
+        else:
+            result = await utils.maybe_await(pipe.execute())
+        for bucket, total in zip(active, result[::2]):
+            foreign = total - bucket.own
+            if foreign > bucket.foreign:
+                bucket.tokens -= foreign - bucket.foreign
+                bucket.foreign = foreign
+
+    def start(self):
+        """
+        Starts syncing periodically.
+        """
+        if not self._periodic and self.limits and self.sync_interval:
+            self._periodic = tornado.ioloop.PeriodicCallback(self.sync, self.sync_interval * 1000)
+            self._periodic.start()
+
+    def stop(self):
+        if self._periodic:
+            self._periodic.stop()
+            self._periodic = None
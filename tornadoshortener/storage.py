@@ -0,0 +1,564 @@
+import bisect
+import hashlib
+import logging
+import sqlite3
+import time
+
+import tornado.gen
+import tornado.ioloop
+
+from . import utils
+
+# Fields of the redis hash holding all URLs of a link, in the order of the
+# tuple returned by load_urls. Kept short to save memory.
+LINK_FIELDS = ('l', 'a', 'af', 'i', 'if')
+
+# Key suffixes of the legacy layout storing each URL of a link in its own key.
+LEGACY_SUFFIXES = ('', ':android_url', ':android_fallback_url', ':ios_url', ':ios_fallback_url')
+
+# URLs of a link not found.
+NOT_FOUND = (None, None, None, None, None)
+
+# Writes all fields of a link and its expiry at once unless one of the keys,
+# the link and optionally the link in the legacy layout, exists.
+RESERVE_SCRIPT = """
+for i, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        return 0
+    end
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+if ARGV[1] ~= '0' then
+    redis.call('EXPIREAT', KEYS[1], ARGV[1])
+end
+return 1
+"""
+
+
+class RedisStorage(object):
+    """
+    Stores links in redis, each link in a single redis hash LINK:<hash>.
+    All storage backends implement load_many, store_many, reserve_many,
+    find_digests, start and stop.
+
+    If changelog_size is set every stored link is also appended to the redis
+    stream CHANGES, capped at about that many entries, which local stores of
+    other nodes follow to stay in sync.
+
+    Set transaction to False for Redis Cluster, where keys of a pipeline live
+    in different slots and cannot be written in a single MULTI.
+    """
+
+    def __init__(self, redis_connection, redis_namespace='SHORT:', ttl=0, legacy_reads=True, changelog_size=0,
+                 metrics=None, transaction=True):
+        self.redis = redis_connection
+        self.redis_namespace = redis_namespace
+        self.ttl = ttl
+        self.legacy_reads = legacy_reads
+        self.changelog_size = changelog_size
+        self.metrics = metrics
+        self.transaction = transaction
+
+    async def execute(self, pipe, operation):
+        if self.metrics:
+            return await self.metrics.execute(pipe, operation)
+        return await utils.maybe_await(pipe.execute())
+
+    async def store_many(self, links, digests=None):
+        """
+        Stores many links in a single redis pipeline. Links are given as a list
+        of tuples (url_hash, urls) where urls is a tuple like the one returned
+        by load_urls.
+        If digests are given, one per link, the links are added to the index
+        used to deduplicate links, expiring with the links.
+        """
+        if not links:
+            return
+        expire_at = int(time.time()) + self.ttl * 24 * 60 * 60
+        pipe = self.redis.pipeline(transaction=self.transaction)
+        for url_hash, urls in links:
+            key = self.redis_namespace + 'LINK:' + url_hash
+            pipe.hset(key, mapping={field: url for field, url in zip(LINK_FIELDS, urls) if url})
+            if self.ttl:
+                pipe.expireat(key, expire_at)
+        if digests:
+            self._add_digests(pipe, [url_hash for url_hash, urls in links], digests, expire_at)
+        if self.changelog_size:
+            for url_hash, urls in links:
+                pipe.xadd(self.redis_namespace + 'CHANGES', {'h': url_hash}, maxlen=self.changelog_size,
+                          approximate=True)
+        await self.execute(pipe, 'store_urls')
+
+    async def reserve_many(self, links):
+        """
+        Stores links with custom hashes like store_many unless their hash is
+        taken. Every link is checked and written by a single atomic script, all
+        links in a single redis pipeline.
+
+        @returns: Returns a list with True for every link stored and False for
+                  every link whose hash is taken.
+        """
+        if not links:
+            return []
+        expire_at = int(time.time()) + self.ttl * 24 * 60 * 60 if self.ttl else 0
+        pipe = self.redis.pipeline(transaction=self.transaction)
+        for url_hash, urls in links:
+            keys = [self.redis_namespace + 'LINK:' + url_hash]
+            # The legacy key lives in another Redis Cluster slot.
+            if self.legacy_reads and self.transaction:
+                keys.append(self.redis_namespace + 'URLS:' + url_hash)
+            fields = [value for field, url in zip(LINK_FIELDS, urls) if url for value in (field, url)]
+            pipe.eval(RESERVE_SCRIPT, len(keys), *keys, expire_at, *fields)
+        if self.changelog_size:
+            # Local stores reload the link, so the entry of a taken hash does no harm.
+            for url_hash, urls in links:
+                pipe.xadd(self.redis_namespace + 'CHANGES', {'h': url_hash}, maxlen=self.changelog_size,
+                          approximate=True)
+        result = await self.execute(pipe, 'reserve_urls')
+        return [bool(reserved) for reserved in result[:len(links)]]
+
+    async def store_digests(self, url_hashes, digests):
+        """
+        Adds links stored elsewhere to the index used to deduplicate links,
+        one digest per URL hash.
+        """
+        pipe = self.redis.pipeline(transaction=self.transaction)
+        self._add_digests(pipe, url_hashes, digests, int(time.time()) + self.ttl * 24 * 60 * 60)
+        await self.execute(pipe, 'store_digests')
+
+    def _add_digests(self, pipe, url_hashes, digests, expire_at):
+        for url_hash, digest in zip(url_hashes, digests):
+            # One SET NX EXAT, so an existing digest keeps its own expiry.
+            pipe.set(self.redis_namespace + 'DIGEST:' + digest, url_hash, nx=True,
+                     exat=expire_at if self.ttl else None)
+
+    async def load_many(self, url_hashes, with_expiry=False):
+        """
+        Loads the URLs for many URL hashes in a single redis pipeline.
+
+        @returns: Returns a list with one result per URL hash like load_urls.
+        """
+        pipe = self.redis.pipeline(transaction=self.transaction)
+        for url_hash in url_hashes:
+            key = self.redis_namespace + 'LINK:' + url_hash
+            pipe.hgetall(key)
+            if with_expiry:
+                pipe.ttl(key)
+        result = await self.execute(pipe, 'load_urls') if url_hashes else []
+
+        step = 2 if with_expiry else 1
+        results = []
+        missing = []
+        for i, url_hash in enumerate(url_hashes):
+            fields = result[i * step]
+            if fields:
+                urls = tuple(fields.get(field) for field in LINK_FIELDS)
+                expires_in = result[i * step + 1] if with_expiry and result[i * step + 1] >= 0 else None
+            else:
+                urls, expires_in = NOT_FOUND, None
+                missing.append(i)
+            results.append((urls, expires_in))
+
+        if missing and self.legacy_reads:
+            legacy = await self.load_legacy_many([url_hashes[i] for i in missing])
+            for i, legacy_result in zip(missing, legacy):
+                results[i] = legacy_result
+
+        if with_expiry:
+            return results
+        return [urls for urls, expires_in in results]
+
+    async def load_legacy_many(self, url_hashes):
+        """
+        Loads the URLs of links stored in the legacy layout with one redis key
+        per URL and migrates found links to a single redis hash, keeping their TTL.
+
+        @returns: Returns a list of tuples (urls, expires_in) like load_urls.
+        """
+        pipe = self.redis.pipeline(transaction=self.transaction)
+        for url_hash in url_hashes:
+            key_prefix = self.redis_namespace + 'URLS:' + url_hash
+            for suffix in LEGACY_SUFFIXES:
+                pipe.get(key_prefix + suffix)
+            pipe.ttl(key_prefix)
+        result = await self.execute(pipe, 'load_legacy_urls')
+
+        results = []
+        pipe = self.redis.pipeline(transaction=self.transaction)
+        migrated = False
+        for i, url_hash in enumerate(url_hashes):
+            urls = tuple(result[i * 6:i * 6 + 5])
+            expires_in = result[i * 6 + 5] if result[i * 6 + 5] >= 0 else None
+            results.append((urls, expires_in))
+            if urls[0]:
+                key = self.redis_namespace + 'LINK:' + url_hash
+                key_prefix = self.redis_namespace + 'URLS:' + url_hash
+                pipe.hset(key, mapping={field: url for field, url in zip(LINK_FIELDS, urls) if url})
+                if expires_in is not None:
+                    pipe.expire(key, max(expires_in, 1))
+                for suffix in LEGACY_SUFFIXES:
+                    pipe.delete(key_prefix + suffix)
+                logging.debug('Migrating legacy link %s', url_hash)
+                migrated = True
+        if migrated:
+            await self.execute(pipe, 'migrate_legacy_urls')
+        return results
+
+    async def find_digests(self, digests):
+        """
+        Looks up the hashes of links with the given digests in a single
+        redis pipeline.
+
+        @returns: Returns a list with the hash or None for every digest.
+        """
+        pipe = self.redis.pipeline(transaction=self.transaction)
+        for digest in digests:
+            pipe.get(self.redis_namespace + 'DIGEST:' + digest)
+        return await self.execute(pipe, 'find_duplicates')
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class GuardedStorage(object):
+    """
+    Calls a storage backend through a breaker.CircuitBreaker, so every call
+    has a timeout and fails fast while the backend is unavailable. All other
+    attributes are taken from the guarded storage.
+    """
+
+    def __init__(self, storage, breaker):
+        self.storage = storage
+        self.breaker = breaker
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    async def store_many(self, links, digests=None):
+        return await self.breaker.call(self.storage.store_many, links, digests)
+
+    async def reserve_many(self, links):
+        return await self.breaker.call(self.storage.reserve_many, links)
+
+    async def store_digests(self, url_hashes, digests):
+        return await self.breaker.call(self.storage.store_digests, url_hashes, digests)
+
+    async def load_many(self, url_hashes, with_expiry=False):
+        return await self.breaker.call(self.storage.load_many, url_hashes, with_expiry)
+
+    async def find_digests(self, digests):
+        return await self.breaker.call(self.storage.find_digests, digests)
+
+
+class HashRing(object):
+    """
+    A consistent hash ring mapping keys to nodes. Every node is placed on the
+    ring replicas times, so keys spread evenly and adding a node only moves
+    the keys the new node takes over, about 1/n of all keys. The ring only
+    depends on the node names, not on their order.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        points = sorted((ring_hash('{}#{}'.format(node, i)), node) for node in nodes for i in range(replicas))
+        self._points = [point for point, node in points]
+        self._nodes = [node for point, node in points]
+
+    def get(self, key):
+        """
+        Returns the node owning the given key.
+        """
+        return self._nodes[bisect.bisect(self._points, ring_hash(key)) % len(self._points)]
+
+
+class ShardedStorage(object):
+    """
+    Shards links across many redis nodes, each given as a RedisStorage in a
+    dict {name: storage}. Links are routed to their node by hash and dedup
+    digests by digest on a consistent hash ring. Batches are split by node
+    and all nodes are queried concurrently, so a batch still costs a single
+    round trip.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        self.nodes = nodes
+        self.ring = HashRing(nodes, replicas)
+        self.ttl = next(iter(nodes.values())).ttl
+
+    def group(self, keys):
+        """
+        Returns a dict {name: indices} with the indices of the keys owned by each node.
+        """
+        groups = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(self.ring.get(key), []).append(i)
+        return groups
+
+    async def store_many(self, links, digests=None):
+        calls = [self.nodes[name].store_many([links[i] for i in indices])
+                 for name, indices in self.group([url_hash for url_hash, urls in links]).items()]
+        if digests:
+            calls += [self.nodes[name].store_digests([links[i][0] for i in indices], [digests[i] for i in indices])
+                      for name, indices in self.group(digests).items()]
+        await tornado.gen.multi(calls)
+
+    async def reserve_many(self, links):
+        groups = self.group([url_hash for url_hash, urls in links])
+        node_results = await tornado.gen.multi([
+            self.nodes[name].reserve_many([links[i] for i in indices]) for name, indices in groups.items()])
+        results = [None] * len(links)
+        for indices, node_result in zip(groups.values(), node_results):
+            for i, result in zip(indices, node_result):
+                results[i] = result
+        return results
+
+    async def load_many(self, url_hashes, with_expiry=False):
+        groups = self.group(url_hashes)
+        node_results = await tornado.gen.multi([
+            self.nodes[name].load_many([url_hashes[i] for i in indices], with_expiry)
+            for name, indices in groups.items()])
+        results = [None] * len(url_hashes)
+        for indices, node_result in zip(groups.values(), node_results):
+            for i, result in zip(indices, node_result):
+                results[i] = result
+        return results
+
+    async def find_digests(self, digests):
+        groups = self.group(digests)
+        node_results = await tornado.gen.multi([
+            self.nodes[name].find_digests([digests[i] for i in indices]) for name, indices in groups.items()])
+        results = [None] * len(digests)
+        for indices, node_result in zip(groups.values(), node_results):
+            for i, result in zip(indices, node_result):
+                results[i] = result
+        return results
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class LocalStore(object):
+    """
+    An embedded SQLite database in WAL mode holding copies of links. Reads are
+    served from the OS page cache in a few microseconds and many processes can
+    share the same file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('PRAGMA busy_timeout=1000')
+        self.db.execute('CREATE TABLE IF NOT EXISTS links (hash TEXT PRIMARY KEY, l TEXT, a TEXT, af TEXT, '
+                        'i TEXT, "if" TEXT, expires_at REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS links_expires_at ON links (expires_at)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def get_many(self, url_hashes):
+        """
+        Returns a dict mapping the found and not expired hashes to tuples
+        (urls, expires_in) like load_urls.
+        """
+        now = time.time()
+        found = {}
+        for start in range(0, len(url_hashes), 500):
+            chunk = url_hashes[start:start + 500]
+            rows = self.db.execute('SELECT hash, l, a, af, i, "if", expires_at FROM links WHERE hash IN ({})'.format(
+                ','.join('?' * len(chunk))), chunk)
+            for row in rows:
+                expires_at = row[6]
+                if expires_at is None or expires_at > now:
+                    found[row[0]] = (tuple(row[1:6]), int(expires_at - now) if expires_at is not None else None)
+        return found
+
+    def put_many(self, links):
+        """
+        Stores links given as tuples (url_hash, urls, expires_in).
+        """
+        now = time.time()
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany(
+                'INSERT OR REPLACE INTO links (hash, l, a, af, i, "if", expires_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(url_hash,) + tuple(urls) + (now + expires_in if expires_in is not None else None,)
+                 for url_hash, urls, expires_in in links])
+
+    def delete_many(self, url_hashes):
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany('DELETE FROM links WHERE hash = ?', [(url_hash,) for url_hash in url_hashes])
+
+    def purge_expired(self):
+        self.db.execute('DELETE FROM links WHERE expires_at < ?', (time.time(),))
+
+    def clear(self):
+        self.db.execute('DELETE FROM links')
+
+    def get_meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def close(self):
+        self.db.close()
+
+
+class TieredStorage(object):
+    """
+    Serves links from a local store in front of a remote storage like
+    RedisStorage. Links not found locally are loaded from the remote storage
+    and copied to the local store. Stored links are written to both.
+
+    The local store follows the changelog of the remote storage every
+    sync_interval seconds, so links changed or deleted on other nodes are
+    updated locally. While the remote storage is unavailable links found
+    locally are still served.
+    """
+
+    def __init__(self, remote, local, sync_interval=1, metrics=None):
+        self.remote = remote
+        self.local = local
+        self.sync_interval = sync_interval
+        self.metrics = metrics
+        self._periodic = None
+        self._syncing = False
+
+    async def store_many(self, links, digests=None):
+        await self.remote.store_many(links, digests)
+        expires_in = self.remote.ttl * 24 * 60 * 60 if self.remote.ttl else None
+        self.local.put_many([(url_hash, urls, expires_in) for url_hash, urls in links])
+
+    async def reserve_many(self, links):
+        reserved = await self.remote.reserve_many(links)
+        expires_in = self.remote.ttl * 24 * 60 * 60 if self.remote.ttl else None
+        self.local.put_many([(url_hash, urls, expires_in) for (url_hash, urls), stored in zip(links, reserved)
+                             if stored])
+        return reserved
+
+    async def load_many(self, url_hashes, with_expiry=False):
+        start = time.perf_counter()
+        found = self.local.get_many(url_hashes)
+        if self.metrics:
+            self.metrics.observe('local_store_duration_seconds', time.perf_counter() - start)
+            self.metrics.inc('local_store_hits_total', value=len(found))
+            self.metrics.inc('local_store_misses_total', value=len(url_hashes) - len(found))
+
+        missing = [url_hash for url_hash in url_hashes if url_hash not in found]
+        if missing:
+            results = await self.remote.load_many(missing, with_expiry=True)
+            self.local.put_many([(url_hash, urls, expires_in)
+                                 for url_hash, (urls, expires_in) in zip(missing, results) if urls[0]])
+            found.update(zip(missing, results))
+
+        results = [found[url_hash] for url_hash in url_hashes]
+        if with_expiry:
+            return results
+        return [urls for urls, expires_in in results]
+
+    async def find_digests(self, digests):
+        return await self.remote.find_digests(digests)
+
+    async def sync(self):
+        """
+        Applies the changes recorded in the changelog of the remote storage
+        since the last sync to the local store.
+        """
+        if self._syncing:
+            return
+        self._syncing = True
+        try:
+            await self._sync()
+        except Exception:
+            logging.warning('Could not sync local store', exc_info=1)
+        finally:
+            self._syncing = False
+
+    async def _sync(self):
+        # A sharded storage has one changelog per node.
+        nodes = getattr(self.remote, 'nodes', None)
+        if nodes is None:
+            await self._sync_node(self.remote, 'changelog_id')
+        else:
+            for name, node in nodes.items():
+                await self._sync_node(node, 'changelog_id:' + name)
+        self.local.purge_expired()
+
+    async def _sync_node(self, remote, meta_key):
+        redis = remote.redis
+        stream = remote.redis_namespace + 'CHANGES'
+        last_id = self.local.get_meta(meta_key)
+        if last_id is None:
+            # Start following the changelog, links stored before are copied on first access.
+            entries = await utils.maybe_await(redis.xrevrange(stream, count=1))
+            self.local.set_meta(meta_key, entries[0][0] if entries else '0-0')
+            return
+
+        entries = await utils.maybe_await(redis.xrange(stream, count=1))
+        if entries and stream_id(entries[0][0]) > stream_id(last_id) and last_id != '0-0':
+            # Changes were trimmed from the changelog before they were applied.
+            logging.warning('Local store fell behind the changelog, clearing it')
+            self.local.clear()
+
+        while True:
+            entries = await utils.maybe_await(redis.xread({stream: last_id}, count=1000))
+            if not entries:
+                break
+            entries = entries[0][1]
+            url_hashes = list({fields['h'] for entry_id, fields in entries})
+            results = await remote.load_many(url_hashes, with_expiry=True)
+            self.local.put_many([(url_hash, urls, expires_in)
+                                 for url_hash, (urls, expires_in) in zip(url_hashes, results) if urls[0]])
+            self.local.delete_many([url_hash for url_hash, (urls, expires_in) in zip(url_hashes, results)
+                                    if not urls[0]])
+            last_id = entries[-1][0]
+            self.local.set_meta(meta_key, last_id)
+            if len(entries) < 1000:
+                break
+
+    def start(self):
+        """
+        Starts following the changelog periodically.
+        """
+        if not self._periodic and self.sync_interval:
+            self._periodic = tornado.ioloop.PeriodicCallback(self.sync, self.sync_interval * 1000)
+            self._periodic.start()
+
+    def stop(self):
+        if self._periodic:
+            self._periodic.stop()
+            self._periodic = None
+        self.local.close()
+
+
+def ring_hash(value):
+    """
+    Returns the position of a key on the hash ring.
+    """
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+def parse_node(node, default_port=6379):
+    """
+    Parses a redis node given as host[:port][/db].
+
+    @returns: Returns a tuple (host, port, db).
+    """
+    node, _, db = node.strip().partition('/')
+    host, _, port = node.rpartition(':') if ':' in node else (node, '', '')
+    return host, int(port or default_port), int(db or 0)
+
+
+def stream_id(value):
+    """
+    Returns a redis stream id like 1526919030474-55 as a comparable tuple.
+    """
+    milliseconds, sequence = value.split('-')
+    return int(milliseconds), int(sequence)
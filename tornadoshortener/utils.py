@@ -1,32 +1,161 @@
+import functools
+import inspect
+import json
 import re
+import string
 import urllib.error
 import urllib.parse
 import urllib.request
 
 import time
+import tornado.locks
 from hashids import Hashids
 
-# Compile the regular expression for validating URLs.
-url_regex = re.compile(
-    r'^(?:http|ftp)s?://'  # http:// or https://
-    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+'
-    r'(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'  # domain...
-    r'localhost|'  # localhost...
-    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
-    r'(?::\d+)?'  # optional port
-    r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+# Schemes of long URLs and fallback URLs.
+WEB_SCHEMES = frozenset(('http', 'https', 'ftp', 'ftps'))
 
+# Schemes never accepted for app URLs as browsers run or load them directly.
+UNSAFE_SCHEMES = frozenset(('javascript', 'vbscript', 'data', 'file', 'blob', 'about'))
+
+SCHEME_CHARS = frozenset(string.ascii_letters + string.digits + '+-.')
+HOST_CHARS = frozenset(string.ascii_lowercase + string.digits + '-.')
+
+# Characters not quoted when normalizing URLs.
+SAFE_CHARS = "%/:=&?~#+!$,;'@()*[]"
+
+# Matches the scheme and authority of common web URLs. The groups match
+# disjoint characters, so matching runs in linear time without backtracking.
+# ASCII only, otherwise \d matches other digits and ignoring case matches
+# letters like U+017F with s, which must go through IDNA encoding.
+web_url_regex = re.compile(r'(https?|ftps?)://([a-z0-9.-]+)(?::(\d{1,5}))?', re.IGNORECASE | re.ASCII)
+
+# Matches characters quoted when normalizing URLs.
+unsafe_regex = re.compile(r"[^A-Za-z0-9_.~\-%/:=&?#+!$,;'@()*\[\]]")
+
+whitespace_regex = re.compile(r'\s')
 
-def validate_url(url):
-    """
-    Validates a given URL.
 
-    :see https://github.com/django/django/blob/master/django/core/validators.py#L58
+def valid_host(host):
     """
-    if url_regex.match(url):
+    Validates a host made of lower case letters, digits, dots and hyphens:
+    localhost, an IPv4 address or a domain name with at least two labels.
+    Uses string operations only, so it runs in linear time.
+    """
+    if host.endswith('.'):
+        # A trailing dot is allowed.
+        host = host[:-1]
+    if host == 'localhost':
         return True
-    else:
+    if host.replace('.', '').isdigit():
+        labels = host.split('.')
+        return len(labels) == 4 and all(0 < len(label) <= 3 for label in labels)
+    dot = host.rfind('.')
+    if dot <= 0 or len(host) - dot < 3:
+        return False
+    if host[0] == '-' or '..' in host or '-.' in host or '.-' in host:
+        return False
+    return len(host) <= 63 or all(len(label) <= 63 for label in host.split('.'))
+
+
+def parse_host(authority):
+    """
+    Validates and normalizes the host and optional port of an URL. Hosts are
+    converted to lower case and IDNA encoded if needed.
+
+    @returns: Returns the normalized authority.
+    @raises: Raises a ValueError if the authority is invalid.
+    """
+    host, colon, port = authority.partition(':')
+    if colon and not (port.isascii() and port.isdigit() and 0 < int(port) < 65536):
+        raise ValueError('Invalid port')
+    if not host.isascii():
+        try:
+            host = host.encode('idna').decode('ascii')
+        except UnicodeError:
+            raise ValueError('Invalid host')
+    host = host.lower()
+    if not HOST_CHARS.issuperset(host) or not valid_host(host):
+        raise ValueError('Invalid host')
+    return host + colon + port
+
+
+def split_url(url):
+    """
+    Splits an URL into its lower case scheme, its authority if it has one and
+    the rest without parsing the rest.
+
+    @raises: Raises a ValueError if the scheme is invalid.
+    """
+    scheme, colon, rest = url.partition(':')
+    if not colon or not scheme or scheme[0] not in string.ascii_letters or not SCHEME_CHARS.issuperset(scheme):
+        raise ValueError('Invalid scheme')
+    scheme = scheme.lower()
+    if not rest.startswith('//'):
+        return scheme, None, rest
+    end = len(rest)
+    for delimiter in '/?#':
+        i = rest.find(delimiter, 2)
+        if 0 <= i < end:
+            end = i
+    return scheme, rest[2:end], rest[end:]
+
+
+def parse_url(url, app=False, charset='utf-8'):
+    """
+    Normalizes and validates an URL in a single pass with linear run time.
+    Web URLs need an http(s) or ftp(s) scheme and a valid host, unsafe
+    characters are quoted like normalize_url does.
+    If app is True URLs with custom schemes like familonet:// opening apps are
+    accepted as well, except for schemes browsers would run like javascript:.
+
+    >>> parse_url('HTTP://De.Wikipedia.org/wiki/Elf (Begriffsklärung)')
+    'http://de.wikipedia.org/wiki/Elf%20(Begriffskl%C3%A4rung)'
+
+    @returns: Returns the normalized URL.
+    @raises: Raises a ValueError if the URL is invalid.
+    """
+    if not url or not isinstance(url, str):
+        raise ValueError('Missing URL')
+    match = web_url_regex.match(url)
+    if match and url[match.end():match.end() + 1] in ('', '/', '?', '#'):
+        # Fast path for web URLs with an ASCII host.
+        scheme, host, port = match.groups()
+        host = host.lower()
+        if not valid_host(host):
+            raise ValueError('Invalid host')
+        if port is not None:
+            if not 0 < int(port) < 65536:
+                raise ValueError('Invalid port')
+            host += ':' + port
+        rest = url[match.end():]
+        if unsafe_regex.search(rest):
+            rest = urllib.parse.quote(rest.encode(charset, 'ignore'), safe=SAFE_CHARS)
+        return scheme.lower() + '://' + host + rest
+
+    scheme, authority, rest = split_url(url)
+    if scheme in WEB_SCHEMES:
+        if authority is None:
+            raise ValueError('Missing host')
+        rest = urllib.parse.quote(rest.encode(charset, 'ignore'), safe=SAFE_CHARS)
+        return scheme + '://' + parse_host(authority) + rest
+    if not app or scheme in UNSAFE_SCHEMES:
+        raise ValueError('Invalid scheme')
+    return urllib.parse.quote(url.encode(charset, 'ignore'), safe=SAFE_CHARS)
+
+
+def validate_url(url):
+    """
+    Validates a given web URL without normalizing it, so it must not contain
+    any whitespace. Runs in linear time.
+    """
+    try:
+        scheme, authority, rest = split_url(url)
+        if scheme not in WEB_SCHEMES or authority is None:
+            return False
+        parse_host(authority)
+    except ValueError:
         return False
+    return not whitespace_regex.search(rest)
 
 
 def normalize_url(url, charset='utf-8'):
@@ -45,19 +174,128 @@ def normalize_url(url, charset='utf-8'):
     """
     if isinstance(url, str):
         url = url.encode(charset, 'ignore')
-    return urllib.parse.quote(url, safe="%/:=&?~#+!$,;'@()*[]")
+    return urllib.parse.quote(url, safe=SAFE_CHARS)
+
+
+async def maybe_await(result):
+    """
+    Returns the result of a redis call. The asyncio client returns awaitables
+    whereas the blocking client returns the result right away.
+    """
+    if inspect.isawaitable(result):
+        return await result
+    return result
 
 
-def generate_hash(redis_connection, redis_namespace=':short', hash_salt=''):
+@functools.lru_cache(maxsize=16)
+def get_hashids(hash_salt=''):
+    """
+    Returns a shared Hashids instance for the given salt.
+    """
+    return Hashids(salt=hash_salt)
+
+
+async def generate_hash(redis_connection, redis_namespace=':short', hash_salt=''):
     """
     Generates an URL hash.
     This will increase the hash counter for the current day no mater if the hash
     will be used or not.
     """
     days_since_epoch = int(time.time() / 86400)
-    day_index = redis_connection.incr(redis_namespace + 'HI:' + str(days_since_epoch))
-    hashids = Hashids(salt=hash_salt)
-    return hashids.encode(days_since_epoch, day_index)
+    day_index = await maybe_await(redis_connection.incr(redis_namespace + 'HI:' + str(days_since_epoch)))
+    return get_hashids(hash_salt).encode(days_since_epoch, day_index)
+
+
+class HashGenerator(object):
+    """
+    Generates URL hashes like generate_hash but leases a block of day indices
+    from redis at once and hands them out locally. The blocks are reserved with
+    an atomic INCRBY on the day counter, so hashes stay unique across all
+    processes sharing the same redis. Indices left over when a lease is
+    abandoned are counted in the HI:<day>:unused key.
+    Redis calls are recorded in the given metrics.Metrics instance if any.
+    """
+
+    def __init__(self, redis_connection, redis_namespace=':short', hash_salt='', block_size=1000, metrics=None):
+        self.redis = redis_connection
+        self.redis_namespace = redis_namespace
+        self.hashids = get_hashids(hash_salt)
+        self.block_size = max(block_size, 1)
+        self.metrics = metrics
+        self.day = None
+        self.next_index = 1
+        self.end_index = 0
+        self._lock = tornado.locks.Lock()
+
+    async def generate(self):
+        """
+        Generates an URL hash, leasing a new block of day indices if needed.
+        """
+        if self.next_index > self.end_index or self.day != int(time.time() / 86400):
+            async with self._lock:
+                days_since_epoch = int(time.time() / 86400)
+                if self.next_index > self.end_index or self.day != days_since_epoch:
+                    await self._lease(days_since_epoch, self.block_size)
+        day_index = self.next_index
+        self.next_index += 1
+        return self.hashids.encode(self.day, day_index)
+
+    async def generate_many(self, count):
+        """
+        Generates the given number of URL hashes with at most one redis round
+        trip, leasing a block large enough for all of them if needed.
+        """
+        hashes = []
+        async with self._lock:
+            days_since_epoch = int(time.time() / 86400)
+            while len(hashes) < count:
+                if self.next_index > self.end_index or self.day != days_since_epoch:
+                    await self._lease(days_since_epoch, max(self.block_size, count - len(hashes)))
+                hashes.append(self.hashids.encode(self.day, self.next_index))
+                self.next_index += 1
+        return hashes
+
+    async def release(self):
+        """
+        Abandons the current lease, e.g. on shutdown, and accounts for the
+        unused indices.
+        """
+        async with self._lock:
+            if self.next_index <= self.end_index:
+                await maybe_await(self.redis.incrby(self._unused_key(), self.end_index - self.next_index + 1))
+            self.next_index, self.end_index = 1, 0
+
+    async def _lease(self, days_since_epoch, size):
+        # No transaction, the counters may live in different Redis Cluster slots.
+        pipe = self.redis.pipeline(transaction=False)
+        if self.next_index <= self.end_index:
+            pipe.incrby(self._unused_key(), self.end_index - self.next_index + 1)
+        pipe.incrby(self.redis_namespace + 'HI:' + str(days_since_epoch), size)
+        if self.metrics:
+            end_index = (await self.metrics.execute(pipe, 'lease_hashes'))[-1]
+        else:
+            end_index = (await maybe_await(pipe.execute()))[-1]
+        self.day = days_since_epoch
+        self.next_index = end_index - size + 1
+        self.end_index = end_index
+
+    def _unused_key(self):
+        return self.redis_namespace + 'HI:' + str(self.day) + ':unused'
+
+
+def parse_json_entries(body):
+    """
+    Parses a request body holding either a JSON array or newline delimited
+    JSON values (NDJSON) and returns the entries as a list.
+    """
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    body = body.strip()
+    if body.startswith('['):
+        entries = json.loads(body)
+        assert isinstance(entries, list)
+        return entries
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
 
 
 def get_hash_from_url(short_url):